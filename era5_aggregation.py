@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+STATISTICS = ("mean", "min", "max", "sum")
+# Suffix of the non-daily outputs, e.g. t2m_monthly
+FREQUENCIES = {"D": "daily", "W": "weekly", "M": "monthly", "dekad": "dekadal"}
+
+# variable: statistics, the first one keeps the variable name and the others
+# get a suffix (t2m, t2m_max). Hourly accumulations are summed, not averaged
+DEFAULT_STATISTICS = ("mean",)
+DEFAULT_RULES = {"tp": ("sum",), "tp_mm": ("sum",)}
+
+
+def period_start(times, frequency="D"):
+    '''First day of the period every timestamp falls in.
+
+    Weeks start on Monday, dekads on the 1st, 11th and 21st (the third dekad
+    runs to the end of the month).
+    '''
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"Unknown frequency {frequency}, use {', '.join(FREQUENCIES)}")
+    days = np.asarray(times, dtype="datetime64[ns]").astype("datetime64[D]")
+    if frequency == "D":
+        return days
+    if frequency == "W":
+        # 1970-01-01 was a Thursday
+        return days - (days.astype("int64") + 3) % 7
+    months = days.astype("datetime64[M]").astype("datetime64[D]")
+    if frequency == "M":
+        return months
+    return months + np.minimum((days - months).astype("int64") // 10, 2) * 10
+
+
+def period_dates(first_date, last_date, frequency="D"):
+    '''Start of every period overlapping the days from first_date to last_date'''
+    days = pd.date_range(first_date, last_date, freq="D").values
+    return np.unique(period_start(days, frequency))
+
+
+def output_name(variable, statistic, rules=None, frequency="D"):
+    statistics = resolve_rules(rules).get(variable, DEFAULT_STATISTICS)
+    name = variable if statistic == statistics[0] else f"{variable}_{statistic}"
+    return name if frequency == "D" else f"{name}_{FREQUENCIES[frequency]}"
+
+
+def resolve_rules(rules=None):
+    '''DEFAULT_RULES updated with ``rules``, checking the statistic names'''
+    resolved = {**DEFAULT_RULES, **(rules or {})}
+    for variable, statistics in resolved.items():
+        unknown = [s for s in statistics if s not in STATISTICS]
+        if unknown or not statistics:
+            raise ValueError(f"Unknown statistics {unknown} for {variable}, use {', '.join(STATISTICS)}")
+    return resolved
+
+
+def reduce_periods(values, starts, statistics):
+    '''All ``statistics`` of (time, ...) values over the periods beginning at the
+    ``starts`` time indices, in one reduceat per statistic.
+
+    NaN steps are left out, a cell without any valid step gets NaN.
+    '''
+    values = np.asarray(values, dtype="float64")
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid, starts, axis=0)
+    result = {}
+    if "sum" in statistics or "mean" in statistics:
+        total = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if "sum" in statistics:
+                result["sum"] = np.where(count > 0, total, np.nan)
+            if "mean" in statistics:
+                result["mean"] = np.where(count > 0, total / count, np.nan)
+    # fmin/fmax only return NaN when every step is NaN
+    if "min" in statistics:
+        result["min"] = np.fmin.reduceat(values, starts, axis=0)
+    if "max" in statistics:
+        result["max"] = np.fmax.reduceat(values, starts, axis=0)
+
+    return result
+
+
+def aggregate(ds, frequency="D", rules=None, start=None, end=None):
+    '''Aggregate an hourly (valid_time, ...) Dataset to ``frequency`` periods.
+
+    Every variable gets the statistics of its rule (``DEFAULT_RULES`` updated
+    with ``rules``, ``DEFAULT_STATISTICS`` otherwise), all computed in a single
+    pass over the sorted time axis. valid_time becomes the period start. With
+    ``start``/``end`` only the periods of those days are kept, hours just
+    outside a window do not leave a partial period behind.
+    '''
+    rules = resolve_rules(rules)
+    ds = ds.sortby("valid_time")
+    labels = period_start(ds["valid_time"].values, frequency)
+    keep = np.ones(len(labels), dtype=bool)
+    if start is not None:
+        keep &= labels >= period_start([np.datetime64(start, "ns")], frequency)[0]
+    if end is not None:
+        keep &= labels <= period_start([np.datetime64(end, "ns")], frequency)[0]
+    ds, labels = ds.isel(valid_time=np.flatnonzero(keep)), labels[keep]
+    if not len(labels):
+        return xr.Dataset()
+
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    coords = {"valid_time": labels[starts].astype("datetime64[ns]")}
+    data = {}
+    for variable in ds.data_vars:
+        da = ds[variable].transpose("valid_time", ...)
+        coords.update({dim: da[dim].values for dim in da.dims[1:] if dim in da.coords})
+        statistics = rules.get(variable, DEFAULT_STATISTICS)
+        reduced = reduce_periods(da.values, starts, statistics)
+        for statistic in statistics:
+            data[output_name(variable, statistic, rules, frequency)] = xr.DataArray(
+                reduced[statistic], dims=da.dims,
+                attrs={"variable": variable, "statistic": statistic, "frequency": frequency})
+
+    return xr.Dataset(data, coords=coords)
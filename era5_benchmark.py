@@ -0,0 +1,281 @@
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _run_stage(queue, func, args, kwargs, workdir):
+    try:
+        os.chdir(workdir)
+        rss_before = _peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        func(*args, **kwargs)
+        queue.put({
+            "wall_s": round(time.perf_counter() - wall, 3),
+            "cpu_s": round(time.process_time() - cpu, 3),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "baseline_rss_mb": round(rss_before, 1),
+        })
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def measure(func, *args, **kwargs):
+    '''Run ``func`` in a fresh process and report its wall time, CPU time and peak RSS.
+
+    The peak RSS of a process never goes down, a new process per measurement
+    keeps the stages from hiding each other.
+    '''
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    with tempfile.TemporaryDirectory(prefix="era5_bench_") as workdir:
+        proc = ctx.Process(target=_run_stage, args=(queue, func, args, kwargs, workdir))
+        proc.start()
+        result = queue.get()
+        proc.join()
+
+    return result
+
+
+def _extract(filename, mode):
+    from era5_grib_extractor import ERA5GribExtractor
+    ERA5GribExtractor(output_dir="temp_results").process(filename=filename, mode=mode)
+
+
+def bench_extractor(filename, modes=("dataframe", "array")):
+    results = {}
+    for mode in modes:
+        print(f"[i] ERA5GribExtractor.process mode={mode}")
+        results[mode] = measure(_extract, os.path.abspath(filename), mode)
+        print(f"    {results[mode]}")
+
+    if "dataframe" in results and "array" in results and "error" not in results["dataframe"] and "error" not in results["array"]:
+        base, new = results["dataframe"], results["array"]
+        results["speedup"] = round(base["wall_s"] / max(new["wall_s"], 1e-9), 2)
+        results["peak_rss_reduction_mb"] = round(base["peak_rss_mb"] - new["peak_rss_mb"], 1)
+        print(f"[i] speedup x{results['speedup']}, peak RSS -{results['peak_rss_reduction_mb']} MB")
+
+    return results
+
+
+def _regrid_cached(paths, target_raster, method, scale):
+    from era5_regrid import regrid_rasters
+    regrid_rasters(paths, target_raster, output_dir="regrid", method=method, scale=scale, cache_dir="weights")
+
+
+def _regrid_reproject(paths, target_raster, method, scale):
+    import rasterio
+    import rioxarray
+    from era5_regrid import target_grid
+    from rasterio.transform import Affine
+
+    grid = target_grid(target_raster, scale=scale)
+    match = rioxarray.open_rasterio(target_raster).rio.reproject(
+        grid["crs"], shape=(grid["height"], grid["width"]), transform=Affine(*grid["transform"]))
+    resampling = rasterio.enums.Resampling.bilinear if method == "bilinear" else rasterio.enums.Resampling.average
+    os.makedirs("regrid")
+    for path in paths:
+        da = rioxarray.open_rasterio(path).rio.reproject_match(match, resampling=resampling)
+        da.rio.to_raster(os.path.join("regrid", os.path.basename(path)), compress="deflate", tiled=True)
+
+
+def bench_regrid(paths, target_raster, method="bilinear", scale=1):
+    '''Cached-weights regridding against one ``rio.reproject`` per file'''
+    paths = [os.path.abspath(p) for p in paths]
+    target_raster = os.path.abspath(target_raster)
+    results = {}
+    for name, func in (("reproject", _regrid_reproject), ("cached_weights", _regrid_cached)):
+        print(f"[i] regrid {name} method={method}, {len(paths)} rasters")
+        results[name] = measure(func, paths, target_raster, method, scale)
+        print(f"    {results[name]}")
+
+    if "error" not in results["reproject"] and "error" not in results["cached_weights"]:
+        results["speedup"] = round(results["reproject"]["wall_s"] / max(results["cached_weights"]["wall_s"], 1e-9), 2)
+        print(f"[i] speedup x{results['speedup']}")
+
+    return results
+
+
+# Stages of the benchmark suite, run on the era5_synthetic fixtures
+def _stage_extract(filename):
+    from era5_grib_extractor import ERA5GribExtractor
+    ERA5GribExtractor(output_dir="temp_results").process(filename=filename)
+
+
+def check_windowed(filename, memory_budget_mb=1e-6, output_dir="temp_results"):
+    '''Extract ``filename`` in one pass and in windows of ``memory_budget_mb``
+    (one day per window by default), raise ValueError when the rasters differ'''
+    import glob
+    import numpy as np
+    import rasterio
+    from era5_grib_extractor import ERA5GribExtractor
+
+    rasters = {}
+    for name, budget in (("single", None), ("windowed", memory_budget_mb)):
+        dirpath = os.path.join(output_dir, name)
+        ERA5GribExtractor(output_dir=dirpath, memory_budget_mb=budget, metadata_store=False).process(filename=filename)
+        rasters[name] = {os.path.basename(p): p for p in glob.glob(os.path.join(dirpath, "raster", "*.TIF"))}
+
+    if sorted(rasters["single"]) != sorted(rasters["windowed"]):
+        raise ValueError(f"Windowed extraction wrote {len(rasters['windowed'])} rasters, "
+                         f"single pass {len(rasters['single'])}")
+    for name, path in rasters["single"].items():
+        with rasterio.open(path) as single, rasterio.open(rasters["windowed"][name]) as windowed:
+            if single.transform != windowed.transform or not np.array_equal(single.read(), windowed.read(), equal_nan=True):
+                raise ValueError(f"Windowed extraction differs from the single pass on {name}")
+
+    return len(rasters["single"])
+
+
+def _stage_grid_split(raster_path, bounds_mode):
+    from raster_boundaries import RasterBoundaries
+    RasterBoundaries(bounds_mode=bounds_mode).raster_grid_split(source=raster_path)
+
+
+def _stage_tabular(dirpath):
+    import era5_tabular
+    era5_tabular.process(dirpath=dirpath)
+
+
+def _stage_search_cache(cache_dir, queries):
+    from era5_cache_catalog import CacheCatalog
+    from era5_reanalysis_v3 import Reanalysis
+    reanalysis = Reanalysis()
+    reanalysis.catalog = CacheCatalog(cache_dir)
+    for query in queries:
+        reanalysis._search_cache(**query)
+
+
+def _cache_queries(docs, n_queries=200):
+    '''Lookups of cached entries and of areas outside every entry, half each'''
+    queries = []
+    for doc in docs[:n_queries // 2]:
+        queries.append({"area_bounds": doc["area_bounds"], "start_date": doc["start_date"],
+                        "end_date": doc["end_date"], "variables": doc["variables"]})
+        shifted = {k: v + (90.0 if k in ("north", "south") else 0.0) for k, v in doc["area_bounds"].items()}
+        queries.append({**queries[-1], "area_bounds": shifted})
+    return queries
+
+
+def suite_stages(fixtures):
+    '''name: (function, args) of every stage of the suite'''
+    return {
+        "extract": (_stage_extract, (fixtures["grib"],)),
+        # Fails the suite when the windows change the rasters
+        "extract_windowed": (check_windowed, (fixtures["grib"],)),
+        "grid_split_header": (_stage_grid_split, (fixtures["raster"], "header")),
+        "grid_split_reproject": (_stage_grid_split, (fixtures["raster"], "reproject")),
+        "tabular": (_stage_tabular, (fixtures["metadata_dir"],)),
+        "search_cache": (_stage_search_cache, (fixtures["cache_dir"], _cache_queries(fixtures["cache_docs"]))),
+    }
+
+
+def run_suite(size="small", fixtures_dir=None, stages=None, repeat=3):
+    '''Run the suite stages on synthetic fixtures of ``size``.
+
+    The fixtures are generated in ``fixtures_dir`` (a temporary directory by
+    default) before anything is measured. Every stage runs ``repeat`` times in
+    a fresh process, the fastest run is kept.
+    '''
+    from era5_synthetic import make_fixtures
+
+    with tempfile.TemporaryDirectory(prefix="era5_fixtures_") as tmpdir:
+        print(f"[i] Generating {size} fixtures")
+        fixtures = make_fixtures(os.path.abspath(fixtures_dir or tmpdir), size=size)
+        results = {}
+        for name, (func, args) in suite_stages(fixtures).items():
+            if stages and name not in stages:
+                continue
+            runs = [measure(func, *args) for _ in range(repeat)]
+            ok = [run for run in runs if "error" not in run]
+            results[name] = min(ok, key=lambda run: run["wall_s"]) if ok else runs[0]
+            results[name]["runs"] = len(runs)
+            print(f"[i] {name}: {results[name]}")
+
+    return {"size": size, "stages": results}
+
+
+def compare(suite, baseline, tolerance=0.25, min_delta_s=0.05, min_delta_mb=10.0):
+    '''Regressions of a suite run against a baseline run of the same size.
+
+    A stage regresses when its wall time or peak RSS grows by more than
+    ``tolerance`` and by more than the absolute noise floor.
+    '''
+    if baseline.get("size") != suite["size"]:
+        print(f"[W] Baseline size {baseline.get('size')} differs from {suite['size']}")
+    regressions = []
+    for name, result in suite["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if "error" in result:
+            regressions.append(f"{name} failed: {result['error']}")
+            continue
+        if not base or "error" in base:
+            continue
+        for key, floor in (("wall_s", min_delta_s), ("peak_rss_mb", min_delta_mb)):
+            delta = result[key] - base[key]
+            if delta > floor and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {base[key]} -> {result[key]} (+{round(100 * delta / base[key])}%)")
+
+    return regressions
+
+
+def save_results(results, path):
+    doc = {"created_at": datetime.now().isoformat(timespec="seconds"), "results": results}
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=4)
+
+    return path
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="ERA5 processing benchmarks")
+    parser.add_argument('-f', '--file', dest="filename", type=str, default=None, help="one year hourly GRIB file")
+    parser.add_argument('-o', '--output', dest="output", type=str, default=None)
+    parser.add_argument('-rp', '--raster-path', dest="raster_path", type=str, default=None,
+                        help="target raster of the regrid benchmark")
+    parser.add_argument('-r', '--rasters', dest="rasters", type=str, default=os.path.join("temp_results", "raster", "*.TIF"),
+                        help="extracted ERA5 rasters to regrid")
+    parser.add_argument('-s', '--suite', dest="suite", type=str, default=None, choices=["small", "medium", "large"],
+                        help="run the suite on synthetic fixtures of this size")
+    parser.add_argument('--stages', dest="stages", type=str, nargs="*", default=None)
+    parser.add_argument('--repeat', dest="repeat", type=int, default=3)
+    parser.add_argument('--fixtures-dir', dest="fixtures_dir", type=str, default=None)
+    parser.add_argument('-b', '--baseline', dest="baseline", type=str, default=None,
+                        help="results file of an earlier run to compare the suite with")
+    parser.add_argument('-t', '--tolerance', dest="tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = {}
+    if args.filename:
+        results["extractor"] = bench_extractor(args.filename)
+    if args.raster_path:
+        import glob
+        results["regrid"] = bench_regrid(sorted(glob.glob(args.rasters)), args.raster_path, scale=2)
+    if args.suite:
+        results["suite"] = run_suite(args.suite, fixtures_dir=args.fixtures_dir, stages=args.stages, repeat=args.repeat)
+    if args.output:
+        save_results(results, args.output)
+
+    if args.suite and args.baseline:
+        regressions = compare(results["suite"], load_results(args.baseline).get("suite", {}), tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"[E] Regression {regression}")
+        if regressions:
+            sys.exit(1)
+        print("[i] No regression against the baseline")
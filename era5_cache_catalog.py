@@ -0,0 +1,415 @@
+import calendar
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from era5_grib_reader import open_era5_dataset
+
+# The single-date requests (era5_ingest.py) only ask CDS for the 13:00 step,
+# older meta files did not record it.
+LEGACY_SINGLE_DATE_TIME = "13:00"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    request_key TEXT PRIMARY KEY,
+    north REAL NOT NULL,
+    west REAL NOT NULL,
+    south REAL NOT NULL,
+    east REAL NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT,
+    variables TEXT NOT NULL,
+    data_path TEXT NOT NULL,
+    meta_path TEXT,
+    size INTEGER,
+    checksum TEXT,
+    meta TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_date ON cache_entries (start_date, end_date, north);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_time ON cache_entries (start_time, end_time);
+"""
+
+
+def file_checksum(path, chunk_size=1024*1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def normalize_date(value, bound="start", default_time=None):
+    '''Turn the date formats found in the meta files into "YYYY-MM-DDTHH:MM"'''
+    try:
+        date_part, _, time_part = str(value).partition("__")
+        year, month, day = [int(v) for v in date_part.split("-")]
+        # v3 requests every month with day 1..31, clamp to the real month end
+        day = min(day, calendar.monthrange(year, month)[1])
+        if not time_part:
+            time_part = default_time or ("00:00" if bound == "start" else "23:00")
+        hour, minute = [int(v) for v in time_part.split(":")]
+        return datetime(year, month, day, hour, minute).strftime("%Y-%m-%dT%H:%M")
+    except Exception:
+        return None
+
+
+def request_key(area_bounds, start_date, end_date, variables=None):
+    doc = [
+        [round(float(area_bounds[k]), 6) for k in ("north", "west", "south", "east")],
+        str(start_date), str(end_date), sorted(variables or []),
+    ]
+    return hashlib.sha1(json.dumps(doc).encode("utf-8")).hexdigest()
+
+
+def meta_dates(meta):
+    '''Return the (start_date, end_date, default_time) recorded in a meta document'''
+    if "start_date" in meta:
+        return meta["start_date"], meta.get("end_date", meta["start_date"]), meta.get("time")
+    if "date" in meta:
+        return meta["date"], meta["date"], meta.get("time", LEGACY_SINGLE_DATE_TIME)
+    return None
+
+
+class CacheCatalog:
+    '''Persistent index of the files kept in an ERA5 cache directory.
+
+    Replaces the scan of every ``*_meta.json`` file, the catalog is rebuilt
+    from those files the first time it is opened. Afterwards meta files
+    written by other processes are indexed by the next lookup, and only when
+    the cache directory changed since the last look.
+    '''
+
+    def __init__(self, cache_dir, tolerance=1e-6, catalog_name="catalog.sqlite"):
+        self.cache_dir = cache_dir
+        self.tolerance = tolerance
+        self.path = os.path.join(cache_dir, catalog_name)
+        self._lock = threading.Lock()
+        self._synced_mtime = None
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        is_new = not os.path.exists(self.path)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        if is_new:
+            self.rebuild()
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps the catalog usable from worker threads
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _resolve_path(self, data_path):
+        if os.path.isabs(data_path) or os.path.exists(data_path):
+            return data_path
+        return os.path.join(self.cache_dir, data_path)
+
+    def _row(self, meta, meta_path=None, checksum=None, data_path=None, file_path=None):
+        # file_path is the file to measure when it is not at data_path yet
+        dates = meta_dates(meta)
+        if dates is None:
+            return None
+        start_date, end_date, default_time = dates
+
+        data_path = data_path or self._resolve_path(meta.get("data_path") or meta["ncfile"])
+        file_path = file_path or data_path
+        if not os.path.exists(file_path):
+            return None
+        size = os.path.getsize(file_path)
+        if checksum is None and meta.get("checksum") and meta.get("size") == size:
+            # Verified when it was downloaded
+            checksum = meta["checksum"]
+        if checksum is None:
+            checksum = file_checksum(file_path)
+
+        area_bounds = meta["area_bounds"]
+        variables = sorted(meta.get("variables", []))
+        return (
+            request_key(area_bounds, start_date, end_date, variables),
+            float(area_bounds["north"]), float(area_bounds["west"]),
+            float(area_bounds["south"]), float(area_bounds["east"]),
+            str(start_date), str(end_date),
+            normalize_date(start_date, "start", default_time),
+            normalize_date(end_date, "end", default_time),
+            json.dumps(variables), data_path, meta_path,
+            size, checksum,
+            json.dumps(meta), datetime.now().isoformat(timespec="seconds"),
+        )
+
+    def _insert(self, conn, row):
+        conn.execute(f"INSERT OR REPLACE INTO cache_entries VALUES ({','.join('?'*len(row))})", row)
+
+    def add(self, meta, meta_path=None, checksum=None):
+        row = self._row(meta, meta_path, checksum)
+        if row is None:
+            return None
+        with self._lock, self._connect() as conn:
+            self._insert(conn, row)
+
+        return row[0]
+
+    def commit_download(self, part_path, data_path, meta, meta_path, checksum=None):
+        '''Move a verified download into the cache together with its meta file and entry.
+
+        The data file is renamed before the meta file, so a crash in between
+        leaves an orphan data file and never a meta file pointing at nothing.
+        Nothing is moved when the entry can not be built, the partial file is
+        removed and a ValueError raised.
+        '''
+        try:
+            row = self._row(meta, meta_path, checksum, data_path=data_path, file_path=part_path)
+        except (KeyError, TypeError, ValueError):
+            row = None
+        if row is None:
+            if not os.path.exists(part_path):
+                raise ValueError(f"Can not cache {data_path}, the downloaded file {part_path} is missing")
+            os.remove(part_path)
+            raise ValueError(f"Can not cache {data_path}, incomplete metadata: {meta}")
+
+        tmp_meta_path = meta_path + ".tmp"
+        with open(tmp_meta_path, "w") as f:
+            json.dump(meta, f)
+
+        with self._lock, self._connect() as conn:
+            os.replace(part_path, data_path)
+            os.replace(tmp_meta_path, meta_path)
+            self._insert(conn, row)
+
+        return row[0]
+
+    def sync(self):
+        '''Index meta files written since the catalog was last opened'''
+        with self._connect() as conn:
+            known = {r[0] for r in conn.execute("SELECT meta_path FROM cache_entries")}
+        count = 0
+        for lf in sorted(f for f in os.listdir(self.cache_dir) if f.endswith("_meta.json")):
+            meta_path = os.path.join(self.cache_dir, lf)
+            if meta_path in known:
+                continue
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                if self.add(meta, meta_path=meta_path):
+                    count += 1
+            except Exception as e:
+                print(f"[W] Skipping cache metadata {lf}: {e}")
+        # After the inserts, the SQLite journal changes the directory as well
+        self._synced_mtime = os.stat(self.cache_dir).st_mtime_ns
+
+        return count
+
+    def verify(self):
+        '''Re-hash every cached file and drop the entries that no longer match.
+
+        The files of a corrupted entry are deleted with it, the next sync would
+        index them again otherwise.
+        '''
+        with self._connect() as conn:
+            rows = conn.execute("SELECT data_path, meta_path, checksum FROM cache_entries").fetchall()
+        corrupted = []
+        for data_path, meta_path, checksum in rows:
+            if os.path.exists(data_path) and not (checksum and file_checksum(data_path) != checksum):
+                continue
+            print(f"[W] Dropping corrupted cache entry: {data_path}")
+            for path in (meta_path, data_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            self.remove(data_path)
+            corrupted.append(data_path)
+
+        return corrupted
+
+    def rebuild(self):
+        '''Re-index every meta JSON file found in the cache directory'''
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries")
+
+        count = self.sync()
+        print(f"[i] Cache catalog rebuilt with {count} entries: {self.path}")
+
+        return count
+
+    def _refresh(self):
+        # Downloads of other processes, or interrupted between their data and catalog step
+        if os.stat(self.cache_dir).st_mtime_ns != self._synced_mtime:
+            self.sync()
+
+    def _bbox_query(self, area_bounds):
+        tol = self.tolerance
+        return (
+            "north BETWEEN ? AND ? AND west BETWEEN ? AND ? AND south BETWEEN ? AND ? AND east BETWEEN ? AND ?",
+            [v for k in ("north", "west", "south", "east")
+               for v in (float(area_bounds[k]) - tol, float(area_bounds[k]) + tol)],
+        )
+
+    def _rows_to_entries(self, rows, variables=None):
+        entries = []
+        for data_path, size, entry_vars, meta in rows:
+            entry_vars = json.loads(entry_vars)
+            # Entries without recorded variables are legacy files, keep matching them
+            if variables and entry_vars and not set(variables).issubset(entry_vars):
+                continue
+            if not os.path.exists(data_path) or os.path.getsize(data_path) != size:
+                self.remove(data_path)
+                continue
+            entry = json.loads(meta)
+            entry["data_path"] = data_path
+            entries.append(entry)
+        return entries
+
+    def lookup(self, area_bounds, start_date, end_date=None, variables=None):
+        '''Find the cached file of an exact request, bbox compared within the tolerance'''
+        end_date = start_date if end_date is None else end_date
+        bbox_sql, bbox_args = self._bbox_query(area_bounds)
+        self._refresh()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT data_path, size, variables, meta FROM cache_entries "
+                f"WHERE start_date = ? AND end_date = ? AND {bbox_sql} ORDER BY created_at DESC",
+                [str(start_date), str(end_date)] + bbox_args,
+            ).fetchall()
+
+        entries = self._rows_to_entries(rows, variables)
+        return entries[0] if entries else {}
+
+    def _lookup_times(self, area_bounds, start_time, end_time, variables=None):
+        # Exact request compared on the normalized times, whatever date format it was recorded with
+        bbox_sql, bbox_args = self._bbox_query(area_bounds)
+        self._refresh()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT data_path, size, variables, meta FROM cache_entries "
+                f"WHERE start_time = ? AND end_time = ? AND {bbox_sql} ORDER BY created_at DESC",
+                [start_time, end_time] + bbox_args,
+            ).fetchall()
+
+        entries = self._rows_to_entries(rows, variables)
+        return entries[0] if entries else None
+
+    def find_covering(self, area_bounds, start_time, end_time, variables=None):
+        '''Cached entries whose bbox and time range contain the request, smallest first'''
+        tol = self.tolerance
+        self._refresh()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT data_path, size, variables, meta FROM cache_entries "
+                "WHERE start_time <= ? AND end_time >= ? "
+                "AND north >= ? AND south <= ? AND west <= ? AND east >= ? ORDER BY size ASC",
+                [start_time, end_time,
+                 float(area_bounds["north"]) - tol, float(area_bounds["south"]) + tol,
+                 float(area_bounds["west"]) + tol, float(area_bounds["east"]) - tol],
+            ).fetchall()
+
+        return self._rows_to_entries(rows, variables)
+
+    def open_subset(self, entry, area_bounds, start_time, end_time, variables=None):
+        '''Lazily slice a cached file down to the requested bbox, time range and variables'''
+        tol = self.tolerance
+        ds = open_era5_dataset(entry["data_path"], variables=variables)
+
+        north, south = float(area_bounds["north"]) + tol, float(area_bounds["south"]) - tol
+        west, east = float(area_bounds["west"]) - tol, float(area_bounds["east"]) + tol
+        # ERA5 latitudes are stored north to south
+        descending = ds["latitude"].size > 1 and float(ds["latitude"][0]) > float(ds["latitude"][-1])
+        subset = ds.sel(
+            latitude=slice(north, south) if descending else slice(south, north),
+            longitude=slice(west, east),
+            valid_time=slice(start_time, end_time),
+        )
+        if 0 in subset.sizes.values():
+            return None
+
+        return subset
+
+    def serve(self, area_bounds, start_date, end_date=None, variables=None, materialize=False, default_time=None,
+              target=None):
+        '''Serve a request from any cached superset of it.
+
+        Returns the sliced Dataset, or with ``materialize`` the meta document of
+        the slice written back to the cache as a new entry. ``target`` is another
+        CacheCatalog to write the slice into instead. A slice is materialized
+        once, a request already in ``target`` returns its entry. ``None`` on a miss.
+        '''
+        # An empty catalog is falsy, compare with None
+        target = self if target is None else target
+        end_date = start_date if end_date is None else end_date
+        start_time = normalize_date(start_date, "start", default_time)
+        end_time = normalize_date(end_date, "end", default_time)
+        if start_time is None or end_time is None:
+            return None
+        if materialize:
+            existing = target._lookup_times(area_bounds, start_time, end_time, variables)
+            if existing:
+                return existing
+
+        for entry in self.find_covering(area_bounds, start_time, end_time, variables):
+            try:
+                subset = self.open_subset(entry, area_bounds, start_time, end_time, variables)
+            except KeyError:
+                # Legacy entry without the requested variables
+                continue
+            if subset is None:
+                continue
+            if not materialize:
+                return subset
+
+            nowdate = datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S_%f")
+            data_path = os.path.join(target.cache_dir, f"{nowdate}_{start_time[:10]}_{end_time[:10]}_slice.nc")
+            meta_path = data_path.replace(".nc", "_meta.json")
+            # Written to a partial file and renamed by commit_download, a reader
+            # or a crash never sees half a slice
+            part_path = data_path + ".part"
+            try:
+                subset.load().to_netcdf(part_path)
+            except Exception:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+
+            doc = {
+                "area_bounds": {k: float(area_bounds[k]) for k in ("north", "west", "south", "east")},
+                "data_path": data_path,
+                "start_date": str(start_date),
+                "end_date": str(end_date),
+                "variables": list(variables or []),
+                "source": entry["data_path"],
+            }
+            if default_time:
+                doc["time"] = default_time
+            target.commit_download(part_path, data_path, doc, meta_path)
+            print(f"[i] Sliced cached ERA5 data {os.path.basename(entry['data_path'])} -> {os.path.basename(data_path)}")
+
+            return doc
+
+        return None
+
+    def remove(self, data_path):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE data_path = ?", (data_path,))
+
+    def __len__(self):
+        self._refresh()
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Rebuild the ERA5 cache catalog")
+    parser.add_argument('-cd', '--cache-dir', dest="cache_dir", type=str, default="era5_cache")
+    args = parser.parse_args()
+
+    CacheCatalog(args.cache_dir).rebuild()
@@ -0,0 +1,139 @@
+import geopandas as gpd
+import shapely
+
+from era5_cache_catalog import normalize_date
+
+# Share of a merged bbox that no study area asked for
+DEFAULT_MAX_WASTE = 0.25
+
+
+def shapefile_bounds(shapefile_path):
+    '''Area bounds of a shapefile as the Reanalysis classes request them'''
+    gdf = gpd.read_file(shapefile_path).to_crs("EPSG:4326")
+    west, south, east, north = gdf.total_bounds
+    return {"north": float(north), "west": float(west), "south": float(south), "east": float(east)}
+
+
+def _box(area_bounds):
+    return shapely.box(area_bounds["west"], area_bounds["south"], area_bounds["east"], area_bounds["north"])
+
+
+def _union_bounds(members):
+    return {
+        "north": max(m["area_bounds"]["north"] for m in members),
+        "west": min(m["area_bounds"]["west"] for m in members),
+        "south": min(m["area_bounds"]["south"] for m in members),
+        "east": max(m["area_bounds"]["east"] for m in members),
+    }
+
+
+def wasted_share(members):
+    '''Share of the covering bbox of ``members`` outside every member bbox'''
+    union = _union_bounds(members)
+    total = _box(union).area
+    if total == 0:
+        return 0.0
+    covered = shapely.union_all([_box(m["area_bounds"]) for m in members]).area
+    return (total - covered) / total
+
+
+def coalesce(requests, max_waste=DEFAULT_MAX_WASTE):
+    '''Group (area, date) requests into covering bbox requests.
+
+    ``requests`` are dicts with at least ``name``, ``area_bounds`` and ``date``.
+    Requests of the same date are merged greedily, cheapest pair first, as long
+    as the wasted share of the covering bbox stays below ``max_waste``.
+    Returns groups with the covering ``area_bounds``, the ``date`` and the
+    ``members`` requests.
+    '''
+    by_date = {}
+    for request in requests:
+        by_date.setdefault(request["date"], []).append(request)
+
+    groups = []
+    for req_date, members in sorted(by_date.items()):
+        clusters = [[m] for m in members]
+        while len(clusters) > 1:
+            best = None
+            for i in range(len(clusters)):
+                for j in range(i+1, len(clusters)):
+                    waste = wasted_share(clusters[i] + clusters[j])
+                    if waste <= max_waste and (best is None or waste < best[0]):
+                        best = (waste, i, j)
+            if best is None:
+                break
+            _, i, j = best
+            clusters[i] = clusters[i] + clusters.pop(j)
+
+        for cluster in clusters:
+            groups.append({
+                "date": req_date,
+                "area_bounds": _union_bounds(cluster),
+                "members": cluster,
+                "waste": round(wasted_share(cluster), 4),
+            })
+
+    return groups
+
+
+def _is_cached(catalog, area_bounds, date, variables=None):
+    # Read only: Reanalysis._search_cache would write a slice of a covering
+    # entry back into the cache
+    time = normalize_date(date, "start", "13:00")
+    return time is not None and bool(catalog.find_covering(area_bounds, time, time, variables))
+
+
+def fan_out(group, reanalyses, staging):
+    '''Serve every member of a group from one covering request.
+
+    ``reanalyses`` maps member names to their era5_ingest.Reanalysis, ``staging``
+    is the Reanalysis whose cache holds the covering downloads. Members already
+    cached are skipped, every other member gets its slice of the covering file
+    written into its own cache. Returns the members that could not be sliced,
+    they are left to their own request.
+    '''
+    # Reanalysis.process looks the date up unpadded (2020-1-15), the slices are
+    # recorded the same way so its exact lookup finds them
+    process_date = "-".join(str(int(v)) for v in group["date"].split("-"))
+    members = group["members"]
+    missing = [m for m in members
+               if not _is_cached(reanalyses[m["name"]].catalog, m["area_bounds"], process_date)]
+    if not missing:
+        return []
+    if len(missing) == 1 and len(members) == 1:
+        return missing
+
+    year, month, day = group["date"].split("-")
+    area_bounds = _union_bounds(missing)
+    if not _is_cached(staging.catalog, area_bounds, process_date, staging.variables):
+        print(f"[REQ] Covering request for {', '.join(m['name'] for m in missing)} on {group['date']}")
+        staging._retrieve_data(area_bounds=area_bounds, year=year, month=month, day=day)
+
+    unserved = []
+    for member in missing:
+        doc = staging.catalog.serve(
+            member["area_bounds"], start_date=process_date, variables=staging.variables,
+            materialize=True, default_time="13:00", target=reanalyses[member["name"]].catalog)
+        if not doc:
+            # The covering file has no grid point inside this area
+            unserved.append(member)
+
+    return unserved
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Preview the coalesced ERA5 requests of a batch")
+    parser.add_argument('-b', '--batch', dest="batch_path", type=str, default="batch_retrieve.json")
+    parser.add_argument('-d', '--date', dest="date", type=str, default="2020-01-15")
+    parser.add_argument('-w', '--max-waste', dest="max_waste", type=float, default=DEFAULT_MAX_WASTE)
+    args = parser.parse_args()
+
+    with open(args.batch_path) as f:
+        areas = json.load(f)
+    requests = [{"name": area["name"], "area_bounds": shapefile_bounds(area["shapefile_path"]), "date": args.date}
+                for area in areas]
+    for group in coalesce(requests, max_waste=args.max_waste):
+        print(f"{group['date']} {[m['name'] for m in group['members']]} waste={group['waste']} {group['area_bounds']}")
@@ -0,0 +1,123 @@
+import os
+from datetime import datetime
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import rasterio
+import rioxarray
+import xarray as xr
+
+from era5_aggregation import period_dates
+
+CUBE_FORMATS = {"tif": ".TIF", "netcdf": ".nc"}
+
+
+def cube_path(dir_path, var, year, fmt="tif"):
+    return os.path.join(dir_path, f"{var}_{year}{CUBE_FORMATS[fmt]}")
+
+
+class GeoTiffCube:
+    '''One multi-band GeoTIFF per variable and year, a band per day.
+
+    The bands for every day of the cube are allocated when it is created, days
+    are written into their band as they are aggregated. The date (YYYY-MM-DD)
+    is the band description.
+    '''
+
+    def __init__(self, path, dates, template):
+        self.path = path
+        self.dates = list(dates)
+        self._index = {date: idx+1 for idx, date in enumerate(self.dates)}
+        self._dst = rasterio.open(
+            path, "w", driver="GTiff", count=len(self.dates),
+            height=template.sizes["y"], width=template.sizes["x"], dtype=template.dtype,
+            crs="EPSG:4326", transform=template.rio.transform(recalc=True),
+            compress="deflate", interleave="band", BIGTIFF="IF_SAFER")
+        for date, band in self._index.items():
+            self._dst.set_band_description(band, date)
+
+    def write(self, date, values):
+        self._dst.write(values, self._index[date])
+
+    def close(self):
+        self._dst.close()
+
+
+class NetCDFCube:
+    '''One compressed NetCDF per variable and year with a time dimension'''
+
+    def __init__(self, path, dates, template, complevel=4):
+        self.path = path
+        self.dates = list(dates)
+        self._index = {date: idx for idx, date in enumerate(self.dates)}
+        self._dst = netCDF4.Dataset(path, "w", format="NETCDF4")
+        self._dst.createDimension("time", len(self.dates))
+        self._dst.createDimension("latitude", template.sizes["y"])
+        self._dst.createDimension("longitude", template.sizes["x"])
+
+        time = self._dst.createVariable("time", "i4", ("time",))
+        time.units = f"days since {self.dates[0]}"
+        time.calendar = "proleptic_gregorian"
+        time[:] = (pd.to_datetime(self.dates) - pd.Timestamp(self.dates[0])).days.values
+        lat = self._dst.createVariable("latitude", "f8", ("latitude",))
+        lat.units, lat.standard_name = "degrees_north", "latitude"
+        lat[:] = template["y"].values
+        lon = self._dst.createVariable("longitude", "f8", ("longitude",))
+        lon.units, lon.standard_name = "degrees_east", "longitude"
+        lon[:] = template["x"].values
+
+        self.var = template.name
+        values = self._dst.createVariable(
+            self.var, template.dtype, ("time", "latitude", "longitude"), zlib=True, complevel=complevel,
+            chunksizes=(1, template.sizes["y"], template.sizes["x"]), fill_value=np.nan)
+        values.grid_mapping = "crs"
+        crs = self._dst.createVariable("crs", "i4")
+        crs.spatial_ref = rasterio.crs.CRS.from_epsg(4326).to_wkt()
+        crs.epsg_code = "EPSG:4326"
+
+    def write(self, date, values):
+        self._dst[self.var][self._index[date], :, :] = values
+
+    def close(self):
+        self._dst.close()
+
+
+def open_cube(path, dates, template):
+    if path.endswith(CUBE_FORMATS["netcdf"]):
+        return NetCDFCube(path, dates, template)
+    return GeoTiffCube(path, dates, template)
+
+
+def read_cube(path, start=None, end=None):
+    '''Read the days between ``start`` and ``end`` (inclusive) of a cube as a
+    (time, y, x) DataArray with a single open call.
+    '''
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    if path.endswith(CUBE_FORMATS["netcdf"]):
+        with xr.open_dataset(path) as ds:
+            var = [v for v in ds.data_vars if v != "crs"][0]
+            da = ds[var].sel(time=slice(start, end)).load()
+        da = da.rename(latitude="y", longitude="x")
+        return da.rio.write_crs(4326)
+
+    with rioxarray.open_rasterio(path) as da:
+        dates = pd.to_datetime(list(da.attrs["long_name"]) if isinstance(da.attrs.get("long_name"), tuple)
+                               else [da.attrs["long_name"]])
+        da = da.assign_coords(band=dates).rename(band="time")
+        # Only the selected bands are read
+        da = da.sel(time=slice(start, end)).load()
+    da.attrs.pop("long_name", None)
+
+    return da
+
+
+def cube_days(first_date, last_date, frequency="D"):
+    '''Split a range of days into the (period start) dates of each year, the cubes are per year'''
+    days = {}
+    for day in pd.to_datetime(period_dates(first_date, last_date, frequency)):
+        days.setdefault(day.year, []).append(datetime.strftime(day, "%Y-%m-%d"))
+
+    return days
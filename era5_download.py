@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+
+class DownloadError(Exception):
+    pass
+
+
+def request_digest(dataset, request):
+    return hashlib.sha1(json.dumps([dataset, request], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def grib_message_count(path):
+    '''Walk the GRIB messages of a file, raise DownloadError if one is cut off'''
+    count = 0
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(16)
+            if header[:4] != b"GRIB":
+                raise DownloadError(f"No GRIB message at byte {offset} of {path}")
+            edition = header[7]
+            if edition == 1:
+                # ERA5 area subsets stay far below the 8 MB GRIB1 large message encoding
+                length = int.from_bytes(header[4:7], "big")
+            elif edition == 2:
+                length = int.from_bytes(header[8:16], "big")
+            else:
+                raise DownloadError(f"Unknown GRIB edition {edition} at byte {offset} of {path}")
+
+            if offset + length > file_size:
+                raise DownloadError(f"GRIB message {count+1} is truncated in {path}")
+            f.seek(offset + length - 4)
+            if f.read(4) != b"7777":
+                raise DownloadError(f"GRIB message {count+1} has no end section in {path}")
+            offset += length
+            count += 1
+
+    return count
+
+
+def verify_download(path, expected_size=None, expected_messages=None):
+    '''Check a finished transfer before it is moved into the cache'''
+    if not os.path.exists(path):
+        raise DownloadError(f"Download is missing: {path}")
+
+    size = os.path.getsize(path)
+    if size == 0:
+        raise DownloadError(f"Download is empty: {path}")
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(f"Download size {size} does not match the announced {expected_size} bytes")
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        sha.update(magic)
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            sha.update(chunk)
+
+    info = {"size": size, "checksum": sha.hexdigest(), "messages": None}
+    if magic == b"GRIB":
+        info["messages"] = grib_message_count(path)
+        if expected_messages is not None and info["messages"] != expected_messages:
+            raise DownloadError(f"Got {info['messages']} GRIB messages, expected {expected_messages}")
+
+    return info
+
+
+def http_download(url, part_path, expected_size=None, retries=5, chunk_size=1024*1024):
+    '''Download to ``part_path``, resuming what is already there with range requests'''
+    for attempt in range(1, retries+1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected_size is not None and offset == expected_size:
+            return part_path
+        if expected_size is not None and offset > expected_size:
+            offset = 0
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                if offset and r.status_code != 206:
+                    # The server ignored the range, start over
+                    offset = 0
+                if offset:
+                    print(f"[i] Resuming download at {offset} bytes")
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            return part_path
+        except (requests.RequestException, OSError) as e:
+            print(f"[W] Download interrupted (attempt {attempt}/{retries}): {e}")
+            time.sleep(min(60, 2 ** attempt))
+
+    raise DownloadError(f"Download failed after {retries} attempts: {url}")
+
+
+def retrieve_verified(client, dataset, request, target, expected_messages=None):
+    '''Retrieve a CDS request into a partial file next to ``target`` and verify it.
+
+    The partial file is named after the request, so a retrieval interrupted in an
+    earlier run continues from the bytes already on disk. Returns the partial
+    file path and its verification info, moving it into place is left to the caller.
+    '''
+    part_path = os.path.join(os.path.dirname(target), f".{request_digest(dataset, request)}.part")
+
+    result = client.retrieve(dataset, request)
+    expected_size = getattr(result, "content_length", None)
+    location = getattr(result, "location", None)
+    if location and str(location).startswith("http"):
+        http_download(location, part_path, expected_size=expected_size)
+    else:
+        result.download(part_path)
+
+    try:
+        info = verify_download(part_path, expected_size=expected_size, expected_messages=expected_messages)
+    except DownloadError:
+        # A corrupt transfer can not be resumed
+        os.remove(part_path)
+        raise
+
+    return part_path, info
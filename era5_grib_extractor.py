@@ -3,64 +3,140 @@ import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import os, json
+from functools import lru_cache
 from datetime import datetime, timedelta
 # Extract metadata
 import rasterio
 import rasterio.features
 import rasterio.warp
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
 
+from era5_aggregation import aggregate, period_dates
+from era5_cube import CUBE_FORMATS, cube_days, cube_path, open_cube
+from era5_metadata_store import METADATA_STORE_NAME, MetadataStore
+from era5_metrics import incr, stage
+from era5_grib_reader import open_era5_hypercubes, select_window, short_names, valid_time_range
+from era5_variables import derivation_order, derive_dataset, kelvin_to_celsius, source_variables
+
 import warnings
 warnings.filterwarnings('ignore')
 
+DEFAULT_VARIABLES = ("t2m", "tp", "d2m")
+# The t2m and d2m rasters hold degrees Celsius, other derived variables
+# (rh, vpd, tp_mm, see era5_variables) are written under their own name
+OUTPUT_VARIABLES = {"t2m": "t2m_c", "d2m": "d2m_c"}
+# Working copies per decoded value while a window is aggregated
+WINDOW_OVERHEAD = 4
+
+
+def output_sources(variables):
+    '''Output raster name -> variable computed for it'''
+    return {name: OUTPUT_VARIABLES.get(name, name) for name in short_names(variables)}
+
+
+def band_stats(values):
+    '''max/min/mean/median of a band, NaN cells are left out'''
+    val = np.asarray(values, dtype='float32').ravel()
+    # One pass to drop the NaN cells, the reductions then run on the valid ones only
+    val = val[~np.isnan(val)]
+    if val.size == 0:
+        return {"max": None, "min": None, "mean": None, "med": None}
+    return {
+        "max": float(val.max()),
+        "min": float(val.min()),
+        "mean": float(val.mean()),
+        "med": float(np.median(val)),
+    }
+
+
+@lru_cache(maxsize=32)
+def footprint_wkt(transform, shape, crs):
+    '''WKT outline of a full raster grid in EPSG:4326.
+
+    Every raster of a run shares the grid, so it is polygonized and
+    reprojected once per (transform, shape, crs).
+    '''
+    mask = np.full(shape, 255, dtype="uint8")
+    geom = [geom for geom, val in rasterio.features.shapes(mask, transform=transform)][0]
+
+    # Transform shapes from the dataset's own coordinate
+    # reference system to CRS84 (EPSG:4326).
+    geom = rasterio.warp.transform_geom(crs, 'EPSG:4326', geom, precision=6)
+    wkt_coords = [f"{(coord[0])} {(coord[1])}" for coord in geom["coordinates"][0]]
+    wkt = f"POLYGON ({tuple(wkt_coords)})".replace('\'', '')
+
+    return wkt
+
+
+class ExtractionError(Exception):
+    '''Files that failed in ``process_files``, ``failed`` maps them to their error'''
+
+    def __init__(self, failed):
+        super().__init__(f"Extraction of {len(failed)} file(s) failed: {', '.join(map(str, failed))}")
+        self.failed = failed
+
+
+# Workers only return their metadata, the parent process is the single
+# writer of the metadata store
+def _write_day_worker(output_dir, json_metadata, dir_path, var, date, da):
+    extractor = ERA5GribExtractor(output_dir=output_dir, json_metadata=json_metadata, metadata_store=False)
+    return extractor._write_day(dir_path, var, date, da)
+
+
+def _process_file_worker(output_dir, memory_budget_mb, json_metadata, filename, kwargs):
+    extractor = ERA5GribExtractor(output_dir=output_dir, memory_budget_mb=memory_budget_mb,
+                                  json_metadata=json_metadata, metadata_store=False)
+    return extractor.process(filename, **kwargs)
+
+
+def _worker_pool(max_workers):
+    # Spawned workers do not inherit the cfgrib/eccodes state of the parent
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
 class ERA5GribExtractor:
-    def __init__(self):
-        pass
+    def __init__(self, output_dir="temp_results", memory_budget_mb=None, max_workers=1,
+                 json_metadata=False, metadata_store=True):
+        self.output_dir = output_dir
+        # Metadata goes to temp_results/metadata/metadata.sqlite, the former
+        # metadata_<name>.json per raster is only written with json_metadata
+        self.json_metadata = json_metadata
+        self.store = MetadataStore(os.path.join(output_dir, "metadata", METADATA_STORE_NAME)) if metadata_store else None
+        # Upper bound for the hourly values held at once, None reads the file in one go
+        self.memory_budget_mb = memory_budget_mb
+        # Processes writing rasters and metadata, 1 keeps everything in this process
+        self.max_workers = max_workers or os.cpu_count()
 
     def __stat_value(self, band_entry):
-            band = rasterio.open(band_entry)
-            val = band.read(1).astype('float32')
-            # Solve nan value
-            val[val==np.nan] = 0
-            collect = {
-                "max": float(np.nanmax(val)),
-                "min": float(np.nanmin(val)),
-                "mean": float(np.nanmean(val)),
-                "med": float(np.nanmedian(val)),
-            }
-            
-            return collect
+        with rasterio.open(band_entry) as band:
+            return band_stats(band.read(1))
 
     def __extract_geom(self, filename):
         with rasterio.open(filename) as data:
-            # Read the dataset's valid data mask as a ndarray.
-            mask = data.dataset_mask()
-            # Extract feature shapes and values from the array.
-            # for geom, val in rasterio.features.shapes(mask, transform=data.transform):
-            geom = [geom for geom, val in rasterio.features.shapes(mask, transform=data.transform)][0]
-
-            # Transform shapes from the dataset's own coordinate
-            # reference system to CRS84 (EPSG:4326).
-            geom = rasterio.warp.transform_geom(data.crs, 'EPSG:4326', geom, precision=6)
-            wkt_coords = [f"{(coord[0])} {(coord[1])}" for coord in geom["coordinates"][0]]
-            wkt = f"POLYGON ({tuple(wkt_coords)})".replace('\'', '')
+            return footprint_wkt(data.transform, data.shape, data.crs.to_string())
 
-            return wkt
-
-    def __export_metadata(self, data_path, date_acquired):
+    def __export_metadata(self, data_path, date_acquired, values=None, transform=None):
+        '''Metadata of a raster, from ``values`` and ``transform`` when the band is
+        still in memory, otherwise from the file'''
 
         result = {}
         result.update({"path": os.path.basename(data_path)})
         result.update({"metadata": {
                 "DATE_ACQUIRED": date_acquired,
                 "SPACECRAFT_ID": "ERA5",
-                "WKT_COORDS": self.__extract_geom(data_path),
-                "FACTORS": os.path.basename(data_path).split("_")[0]
+                "WKT_COORDS": self.__extract_geom(data_path) if transform is None
+                              else footprint_wkt(transform, np.shape(values), "EPSG:4326"),
+                # {var}_{YYYYMMDD}.TIF, derived names may hold an underscore
+                "FACTORS": os.path.basename(data_path).rsplit("_", 1)[0]
             }})
-        result.update({"stat_value": self.__stat_value(data_path)})
+        result.update({"stat_value": self.__stat_value(data_path) if values is None else band_stats(values)})
+        if not self.json_metadata:
+            return result
 
-        meta_dir_path = os.path.join("temp_results", "metadata")
+        meta_dir_path = os.path.join(self.output_dir, "metadata")
         if not os.path.exists(meta_dir_path):
             os.makedirs(meta_dir_path)
 
@@ -70,7 +146,262 @@ class ERA5GribExtractor:
         
         return result
 
-    def process(self, filename):
+    def __export_cube_metadata(self, cube, template, band_stats):
+        '''One metadata document per cube, the stats of each band are listed by date'''
+        result = {
+            "path": os.path.basename(cube.path),
+            "metadata": {
+                "START_DATE": cube.dates[0],
+                "END_DATE": cube.dates[-1],
+                "SPACECRAFT_ID": "ERA5",
+                "WKT_COORDS": footprint_wkt(template.rio.transform(recalc=True), template.shape, "EPSG:4326"),
+                "FACTORS": os.path.basename(cube.path).rsplit("_", 1)[0],
+            },
+            "bands": [{"band": idx+1, "DATE_ACQUIRED": date, "stat_value": band_stats[date]}
+                      for idx, date in enumerate(cube.dates)],
+        }
+        if not self.json_metadata:
+            return result
+
+        meta_dir_path = os.path.join(self.output_dir, "metadata")
+        if not os.path.exists(meta_dir_path):
+            os.makedirs(meta_dir_path)
+
+        metadata_filename = os.path.join(meta_dir_path, "metadata_"+os.path.splitext(os.path.basename(cube.path))[0]+".json")
+        with open(metadata_filename, "w") as f:
+            json.dump(result, f, indent=4)
+
+        return result
+
+    def _aggregate(self, ds, variables=DEFAULT_VARIABLES, frequency="D", rules=None, start=None, end=None):
+        # Derived on the hourly values, a daily mean of rh is not the rh of the daily means
+        sources = output_sources(variables)
+        hourly = derive_dataset(ds, list(sources.values()))
+        hourly = xr.Dataset({name: hourly[var] for name, var in sources.items() if var in hourly})
+        for name in list(hourly.data_vars):
+            if name in OUTPUT_VARIABLES and name in ds.data_vars:
+                # Converted on the values as read (float32), like the dataframe path
+                hourly[name] = kelvin_to_celsius(ds[name])
+        periods = aggregate(hourly, frequency=frequency, rules=rules, start=start, end=end)
+        for name in periods.data_vars:
+            output = periods[name].attrs["variable"]
+            # Outputs of an ERA5 variable (t2m from t2m_c) keep the dtype it was read with
+            source = output if output in ds.data_vars else sources[output]
+            if source in ds.data_vars:
+                periods[name] = periods[name].astype(ds[source].dtype)
+
+        return periods
+
+    def _date_range(self, hypercubes):
+        # Taken from the coordinates only, the instantaneous fields have no
+        # padding steps outside the requested range. The last day is included
+        instant = [ds for ds in hypercubes if "step" not in ds.dims] or hypercubes
+        first, last = valid_time_range(instant)
+        return pd.Timestamp(first).normalize(), pd.Timestamp(last).normalize()
+
+    def _window_days(self, hypercubes, variables=DEFAULT_VARIABLES):
+        if not self.memory_budget_mb:
+            return None
+        ds = hypercubes[0]
+        n_cells = ds.sizes["latitude"] * ds.sizes["longitude"]
+        # Every derived variable and intermediate is one more hourly array
+        n_vars = sum(len(ds.data_vars) for ds in hypercubes) + len(derivation_order(output_sources(variables).values()))
+        # float64 hourly values, with room for the copies made while aggregating
+        day_bytes = n_vars * 24 * n_cells * 8 * WINDOW_OVERHEAD
+        return max(1, int(self.memory_budget_mb * 1024**2 // day_bytes))
+
+    def _period_windows(self, hypercubes, variables, first_date, last_date, frequency="D", rules=None):
+        '''Yield the aggregated periods one time window at a time.
+
+        Windows hold whole periods (at least one, whatever the budget), so the
+        statistics are the same as over the full file. Without a memory budget
+        the whole range is one window.
+        '''
+        window_days = self._window_days(hypercubes, variables) or (last_date - first_date).days + 1
+        sources = source_variables(output_sources(variables).values())
+        periods = [pd.Timestamp(p) for p in period_dates(first_date, last_date, frequency)]
+        starts = [max(p, first_date) for p in periods]
+        ends = [p - timedelta(days=1) for p in periods[1:]] + [last_date]
+
+        i = 0
+        while i < len(periods):
+            j = i
+            while j + 1 < len(periods) and (ends[j+1] - starts[i]).days + 1 <= window_days:
+                j += 1
+            window_start, window_end = starts[i], ends[j]
+            with stage("grib_decode"):
+                ds = select_window(hypercubes, window_start, window_end + timedelta(days=1) - pd.Timedelta(1, "ns"))
+                ds = ds[[n for n in sources if n in ds]].load()
+            with stage("aggregation"):
+                aggregated = self._aggregate(ds, variables, frequency, rules, window_start, window_end)
+            yield aggregated
+            i = j + 1
+
+    def _raster_array(self, da):
+        # North-up is not enforced, rows stay ordered by ascending latitude as before
+        da = da.rename(latitude="y", longitude="x").sortby("y").sortby("x")
+        da = da.drop_vars([c for c in da.coords if c not in ("y", "x")])
+        da.attrs, da.encoding = {}, {}
+        return da
+
+    def _write_raster(self, da, raster_path):
+        with stage("raster_write"):
+            da = self._raster_array(da).rio.set_crs(4326)
+            da.rio.to_raster(raster_path)
+        incr("rasters_written")
+        return da
+
+    def _write_day(self, dir_path, var, date, da):
+        raster_path = os.path.join(dir_path, f"{var}_{date.strftime('%Y%m%d')}.TIF")
+        da = self._write_raster(da, raster_path)
+        with stage("metadata_export"):
+            return self.__export_metadata(data_path=raster_path, date_acquired=date.strftime('%Y-%m-%d'),
+                                          values=da.values, transform=da.rio.transform())
+
+    def _store_metadata(self, docs):
+        # Appended per window in one transaction, the list is emptied in place
+        if self.store is not None:
+            with stage("metadata_store"):
+                self.store.append(docs)
+        self._stored.extend(docs)
+        del docs[:]
+
+    def process(self, filename, mode="array", variables=DEFAULT_VARIABLES, output="daily",
+                frequency="D", statistics=None):
+        '''Aggregate a GRIB file into daily rasters (t2m, tp, d2m) and their metadata.
+
+        Every day of the file is aggregated, the last one included. t2m/d2m are
+        daily means and tp the daily sum. ``frequency`` ("D", "W", "M" or "dekad")
+        and ``statistics`` ({variable: ("mean", "max", ...)}, see
+        era5_aggregation) change the periods and statistics, the other outputs are
+        named after them (t2m_max, t2m_monthly).
+
+        ``variables`` may also name derived variables (rh, vpd, tp_mm, ...), only
+        the ERA5 variables they need are read.
+
+        ``mode="dataframe"`` runs the former pandas/GeoDataFrame implementation,
+        kept as the reference for era5_benchmark.py. With ``memory_budget_mb``
+        set, the file is decoded in windows of whole days that fit the budget.
+
+        ``output="daily"`` writes a single band TIF per variable and day.
+        ``output="tif"`` or ``"netcdf"`` writes one cube per variable and year
+        instead (see era5_cube.read_cube). With ``max_workers`` above 1 the daily
+        rasters are written by a process pool. Returns the metadata documents,
+        which are also added to the metadata store.
+        '''
+        if mode == "dataframe":
+            return self._process_dataframe(filename)
+        if output not in ("daily",) + tuple(CUBE_FORMATS):
+            raise ValueError(f"Unknown output {output}, use daily, {' or '.join(CUBE_FORMATS)}")
+        self._stored = []
+
+        hypercubes = open_era5_hypercubes(filename, strict=False,
+                                          variables=source_variables(output_sources(variables).values()))
+        first_date, last_date = self._date_range(hypercubes)
+        if last_date < first_date:
+            print(f"[W] No data in {os.path.basename(filename)}")
+            return []
+
+        dir_path = os.path.join(self.output_dir, "raster" if output == "daily" else "cube")
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        days = cube_days(first_date, last_date, frequency)
+        cubes, cube_stats, docs = {}, {}, []
+
+        pool = _worker_pool(self.max_workers) if output == "daily" and self.max_workers > 1 else None
+        pending = set()
+
+        print("Aggregating data and generating raster image")
+        try:
+            # Each window is written out and released before the next one is decoded
+            for daily in self._period_windows(hypercubes, variables, first_date, last_date, frequency, statistics):
+                for day in tqdm(daily["valid_time"].values):
+                    date = pd.Timestamp(day)
+                    for var in daily.data_vars:
+                        da = daily[var].sel(valid_time=day)
+                        if output == "daily" and pool:
+                            # A few days per worker in flight keeps the window memory bound
+                            if len(pending) >= 2 * self.max_workers:
+                                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                for future in done:
+                                    docs.append(future.result())
+                            pending.add(pool.submit(_write_day_worker, self.output_dir, self.json_metadata,
+                                                    dir_path, var, date, da.load()))
+                            continue
+                        if output == "daily":
+                            docs.append(self._write_day(dir_path, var, date, da))
+                            continue
+
+                        da = self._raster_array(da).rename(var)
+                        key = (var, date.year)
+                        if key not in cubes:
+                            cubes[key] = open_cube(cube_path(dir_path, var, date.year, output), days[date.year], da)
+                            cube_stats[key] = {}
+                        cube = cubes[key]
+                        with stage("raster_write"):
+                            cube.write(date.strftime('%Y-%m-%d'), da.values)
+                        with stage("metadata_export"):
+                            cube_stats[key][date.strftime('%Y-%m-%d')] = band_stats(da.values)
+                        if date.strftime('%Y-%m-%d') == cube.dates[-1]:
+                            # The year is complete, the cube is closed right away
+                            with stage("raster_write"):
+                                cubes.pop(key).close()
+                            docs.append(self.__export_cube_metadata(cube, da, cube_stats.pop(key)))
+                del daily
+                self._store_metadata(docs)
+            for future in pending:
+                docs.append(future.result())
+            self._store_metadata(docs)
+        finally:
+            if pool:
+                # Only left after a failure: queued days are dropped, the running ones finish their file
+                pool.shutdown(wait=True, cancel_futures=True)
+            for cube in cubes.values():
+                cube.close()
+
+        print("All process has completed!")
+        return self._stored
+
+    def process_files(self, filenames, **kwargs):
+        '''Run ``process`` over several GRIB files, one file per worker process.
+
+        Outputs are named after variable and date as with ``process``, so the
+        result does not depend on the order the files finish in. A failing
+        file does not stop the others, an ExtractionError naming the failed
+        files is raised once all are done.
+        '''
+        failed = {}
+        if self.max_workers <= 1 or len(filenames) <= 1:
+            for filename in filenames:
+                try:
+                    self.process(filename, **kwargs)
+                except Exception as e:
+                    print(f"[E] Extraction of {filename} failed: {e}")
+                    failed[filename] = e
+        else:
+            pool = _worker_pool(min(self.max_workers, len(filenames)))
+            futures = {pool.submit(_process_file_worker, self.output_dir, self.memory_budget_mb, self.json_metadata,
+                                   filename, kwargs): filename
+                       for filename in filenames}
+            try:
+                for future, filename in tqdm(futures.items()):
+                    try:
+                        docs = future.result()
+                    except Exception as e:
+                        print(f"[E] Extraction of {filename} failed: {e}")
+                        failed[filename] = e
+                        continue
+                    if self.store is not None:
+                        self.store.append(docs)
+            finally:
+                # Only left early when interrupted, the files not started yet are dropped
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        if failed:
+            raise ExtractionError(failed) from next(iter(failed.values()))
+        return list(filenames)
+
+    def _process_dataframe(self, filename):
 
         # xarray dataset open
         t2m_dataset = xr.open_dataset(filename, engine="cfgrib")
@@ -80,9 +411,11 @@ class ERA5GribExtractor:
         tp_df = tp_dataset.to_dataframe().reset_index()
         t2m_df = t2m_dataset.to_dataframe().reset_index()
         # convert temperature (t2m) kelvin to celcius
-        t2m_df['t2m'] = t2m_df['t2m'].apply(lambda c: c-273.15)
-        # join both separate dataframe into one dataframe
-        join = pd.merge(t2m_df, tp_df[['tp']], on=t2m_df.index, how='left')
+        t2m_df['t2m'] = kelvin_to_celsius(t2m_df['t2m'].values)
+        # join both separate dataframe into one dataframe, on the hour and cell:
+        # tp is laid out by (time, step) and its rows do not line up with t2m
+        tp_df = tp_df.dropna(subset=['tp'])[['valid_time', 'latitude', 'longitude', 'tp']]
+        join = pd.merge(t2m_df, tp_df, on=['valid_time', 'latitude', 'longitude'], how='left')
 
         # convert dataframe to geodataframe to obtain the geometry features
         gdf = gpd.GeoDataFrame(
@@ -90,7 +423,7 @@ class ERA5GribExtractor:
         )
 
         # Drop unused features, create validated datetime format
-        gdf = gdf.drop(columns=["number", "step", "time", "surface", "key_0", "latitude", "longitude"])
+        gdf = gdf.drop(columns=["number", "step", "time", "surface", "latitude", "longitude"])
         gdf['date'] = pd.to_datetime(gdf['valid_time']).dt.date
         gdf['date'] = pd.to_datetime(gdf['date'], format='%Y-%m-%d')
         gdf['time'] = pd.to_datetime(gdf['valid_time']).dt.time
@@ -98,7 +431,8 @@ class ERA5GribExtractor:
         # ===========================================================================================
         # Do some grouping/aggregation based on the date
         print("Aggregating data")
-        date_list = pd.date_range(gdf["date"].min(), gdf["date"].max()-timedelta(days=1),freq='d')
+        # Every day of the file, the last one included as in the array mode
+        date_list = pd.date_range(gdf["date"].min(), gdf["date"].max(), freq='d')
 
         df_list = []
         for idx, d in enumerate(tqdm(date_list)):
@@ -127,6 +461,7 @@ class ERA5GribExtractor:
         # ===========================================================================================
         # Loop through collection of grouped dataframe
         print("Generating raster image")
+        docs = []
         for idx, dfl in enumerate(tqdm(df_list)):
 
             gdf = dfl
@@ -137,21 +472,24 @@ class ERA5GribExtractor:
             t2m = (gdf.set_index(["y", "x"]).t2m.to_xarray()).rio.set_crs(4326)
             tp = (gdf.set_index(["y", "x"]).tp.to_xarray()).rio.set_crs(4326)
 
-            dir_path = os.path.join("temp_results", "raster")
+            dir_path = os.path.join(self.output_dir, "raster")
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
             
-            t2m_path = os.path.join(dir_path, f"t2m_{datetime.strftime(gdf["date"][0], '%Y%m%d')}.TIF")
+            t2m_path = os.path.join(dir_path, f"t2m_{datetime.strftime(gdf['date'][0], '%Y%m%d')}.TIF")
             t2m.rio.to_raster(t2m_path)
-            self.__export_metadata(data_path=t2m_path, date_acquired=datetime.strftime(gdf["date"][0], '%Y-%m-%d'))
+            docs.append(self.__export_metadata(data_path=t2m_path, date_acquired=datetime.strftime(gdf['date'][0], '%Y-%m-%d')))
             
-            tp_path = os.path.join(dir_path, f"tp_{datetime.strftime(gdf["date"][0], '%Y%m%d')}.TIF")
+            tp_path = os.path.join(dir_path, f"tp_{datetime.strftime(gdf['date'][0], '%Y%m%d')}.TIF")
             tp.rio.to_raster(tp_path)
-            self.__export_metadata(data_path=tp_path, date_acquired=datetime.strftime(gdf["date"][0], '%Y-%m-%d'))
+            docs.append(self.__export_metadata(data_path=tp_path, date_acquired=datetime.strftime(gdf['date'][0], '%Y-%m-%d')))
         
+        self._stored = []
+        self._store_metadata(docs)
         print("All process has completed!")
+        return self._stored
     
 if __name__ == "__main__":
     gribfile = "/Users/yylab/ikkifik/research/era5-reanalysis/_archives/ofunato_t2m_tp.grib"
-    extractor = ERA5GribExtractor()
+    extractor = ERA5GribExtractor(memory_budget_mb=512, max_workers=4)
     extractor.process(filename=gribfile)
\ No newline at end of file
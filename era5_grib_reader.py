@@ -0,0 +1,136 @@
+import os
+
+import cfgrib
+import numpy as np
+import xarray as xr
+
+# CDS request names and the shortName they get in the GRIB/NetCDF files
+ERA5_SHORT_NAMES = {
+    "2m_temperature": "t2m",
+    "total_precipitation": "tp",
+    "2m_dewpoint_temperature": "d2m",
+    "soil_temperature_level_1": "stl1",
+    "volumetric_soil_water_layer_1": "swvl1",
+    "high_vegetation_cover": "cvh",
+    "low_vegetation_cover": "cvl",
+    "total_cloud_cover": "tcc",
+}
+
+
+# cfgrib names the variables after cfVarName, the GRIB shortName differs for some
+GRIB_SHORT_NAMES = {"t2m": "2t", "d2m": "2d"}
+
+
+def short_names(variables):
+    return [ERA5_SHORT_NAMES.get(v, v) for v in variables]
+
+
+def to_valid_time(ds):
+    '''Put every hypercube on a single (valid_time, latitude, longitude) layout.
+
+    Accumulated fields (tp) come as (time, step) pairs in the GRIB files, the
+    instantaneous ones as (time,), NetCDF files from the CDS use valid_time or time.
+    '''
+    ds = ds.drop_vars([c for c in ("number", "surface", "expver") if c in ds.coords])
+
+    if "step" in ds.dims and "time" in ds.dims:
+        valid_time = ds["valid_time"].values.ravel()
+        ds = ds.drop_vars("valid_time").stack(valid=("time", "step"))
+        ds = ds.drop_vars(["valid", "time", "step"]).assign_coords(valid_time=("valid", valid_time))
+        ds = ds.swap_dims(valid="valid_time")
+        # The first and last base times carry steps outside the requested range
+        ds = ds.dropna("valid_time", how="all")
+    elif "time" in ds.dims:
+        if "valid_time" in ds.coords:
+            ds = ds.swap_dims(time="valid_time").drop_vars("time")
+        else:
+            ds = ds.rename(time="valid_time")
+    elif "valid_time" not in ds.dims and "valid_time" in ds.coords:
+        ds = ds.expand_dims("valid_time")
+
+    ds = ds.drop_vars([c for c in ("time", "step") if c in ds.coords])
+    return ds.sortby("valid_time").transpose("valid_time", ...)
+
+
+def open_era5_hypercubes(filename, variables=None, indexpath=None, strict=True):
+    '''Open a cached ERA5 file (GRIB or NetCDF) as lazy, not yet aligned hypercubes.
+
+    ``variables`` (CDS names or short names) limits what is read. For GRIB the
+    file is indexed once, every hypercube is then opened from that index and the
+    values are only decoded when accessed, unrequested messages never are.
+    Missing variables raise a KeyError, or are left out when not ``strict``.
+    '''
+    names = short_names(variables) if variables else None
+
+    if os.path.splitext(filename)[1].lower() in (".grib", ".grb", ".grib1", ".grib2"):
+        backend_kwargs = {}
+        if names:
+            backend_kwargs["filter_by_keys"] = {"shortName": [GRIB_SHORT_NAMES.get(n, n) for n in names]}
+        if indexpath is not None:
+            backend_kwargs["indexpath"] = indexpath
+        hypercubes = cfgrib.open_datasets(filename, backend_kwargs=backend_kwargs)
+    else:
+        hypercubes = [xr.open_dataset(filename)]
+
+    if names:
+        found = {v for ds in hypercubes for v in ds.data_vars}
+        missing = [n for n in names if n not in found]
+        if missing and strict:
+            raise KeyError(f"{missing} not found in {filename}")
+        if missing:
+            print(f"[W] {missing} not found in {os.path.basename(filename)}, skipped")
+        hypercubes = [ds[[n for n in names if n in ds]] for ds in hypercubes
+                      if any(n in ds for n in names)]
+
+    return hypercubes
+
+
+def _merge(datasets):
+    return xr.merge(datasets, join="outer", compat="override", combine_attrs="drop_conflicts")
+
+
+def select_window(hypercubes, start, end):
+    '''Align the part of the hypercubes valid between ``start`` and ``end`` (inclusive).
+
+    Only the selected messages are decoded, the (time, step) layout of the
+    accumulated fields is narrowed down before it is stacked.
+    '''
+    start, end = np.datetime64(start, "ns"), np.datetime64(end, "ns")
+    parts = []
+    for ds in hypercubes:
+        if "step" in ds.dims and "time" in ds.dims:
+            valid_time = ds["valid_time"].values
+            in_window = ((valid_time >= start) & (valid_time <= end)).any(axis=1)
+            ds = ds.isel(time=np.flatnonzero(in_window))
+        parts.append(to_valid_time(ds).sel(valid_time=slice(start, end)))
+
+    return _merge(parts)
+
+
+def valid_time_range(hypercubes):
+    values = np.concatenate([ds["valid_time"].values.ravel() for ds in hypercubes])
+    return values.min(), values.max()
+
+
+def iter_windows(hypercubes, variables=None, window_days=31):
+    '''Yield the hypercubes aligned and loaded ``window_days`` at a time'''
+    first, last = valid_time_range(hypercubes)
+    start = np.datetime64(first, "D").astype("datetime64[ns]")
+    window = np.timedelta64(window_days, "D")
+    while start <= last:
+        ds = select_window(hypercubes, start, start + window - np.timedelta64(1, "ns"))
+        if variables:
+            ds = ds[[n for n in short_names(variables) if n in ds]]
+        if ds.sizes.get("valid_time", 0):
+            yield ds.load()
+        start = start + window
+
+
+def open_era5_dataset(filename, variables=None, indexpath=None, strict=True):
+    '''Open a cached ERA5 file (GRIB or NetCDF) as one aligned Dataset'''
+    hypercubes = open_era5_hypercubes(filename, variables=variables, indexpath=indexpath, strict=strict)
+    ds = _merge([to_valid_time(ds) for ds in hypercubes])
+    if variables:
+        ds = ds[[n for n in short_names(variables) if n in ds]]
+
+    return ds
@@ -7,35 +7,41 @@ import shutil
 import json
 from datetime import datetime, date
 
+from era5_cache_catalog import CacheCatalog
+from era5_download import retrieve_verified
+
 from dotenv import load_dotenv
 load_dotenv()
 
 class Reanalysis:
 
-    def __init__(self, temp_dir="era5_cache"):
+    def __init__(self, temp_dir="era5_cache", client=None):
+        self.client = client
+        self.variables = ['2m_temperature', 'total_precipitation']
         self.uid = os.getenv("ERA5_UID")
         self.api_key = os.getenv("ERA5_API_KEY")
         
         self.temp_dir = temp_dir
         if not os.path.exists(self.temp_dir):
             os.makedirs(self.temp_dir)
+        self.catalog = CacheCatalog(self.temp_dir)
 
     def _search_cache(self, area_bounds, **kwargs):
-        cached_data = {}
+        cached_data = self.catalog.lookup(area_bounds, start_date=kwargs['date'])
+        if cached_data:
+            return cached_data
+
+        # Fall back to any cached file covering this area and date, the slice
+        # is registered and found by the next lookup
         try:
-            lfs = [f for f in os.listdir(self.temp_dir) if ".json" in f]
-            for lf in lfs:
-                selected = json.load(open(os.path.join(self.temp_dir, lf)))
-                if 'date' not in selected:
-                    continue
-                if selected['area_bounds'] == area_bounds and selected['date'] == kwargs['date']:
-                    cached_data = selected
-                # elif selected['area_bounds'] == area_bounds:
-                #     cached_data = selected
-        except Exception as e:
-            print("[E] Failed to get cached data", e)
-            pass
-        
+            cached_data = self.catalog.serve(
+                area_bounds, start_date=kwargs['date'], variables=self.variables,
+                materialize=True, default_time="13:00") or {}
+        except (OSError, ValueError) as e:
+            # An unreadable cached file, the data is requested again
+            print("[W] Failed to slice cached data", e)
+            cached_data = {}
+
         return cached_data
 
     def _retrieve_data(self, area_bounds, **kwargs):
@@ -45,16 +51,18 @@ class Reanalysis:
         temp_metafilename = os.path.join(self.temp_dir, f"{nowdate}_{kwargs['year']}{kwargs['month']}_meta.json")
 
         ## Call API
-        c = cdsapi.Client(
+        c = self.client or cdsapi.Client(
             "https://cds.climate.copernicus.eu/api/v2", 
             f"{self.uid}:{self.api_key}")
             
-        retrieve = c.retrieve(
+        # Downloaded to a partial file first, only a verified file reaches the cache
+        part_filename, info = retrieve_verified(
+            c,
             'reanalysis-era5-single-levels',
             {
                 'product_type': 'reanalysis',
                 'format': 'netcdf',
-                'variable': ['2m_temperature', 'total_precipitation'],
+                'variable': self.variables,
                 'year': kwargs['year'],
                 'month': kwargs['month'],
                 'day': kwargs['day'],
@@ -63,9 +71,17 @@ class Reanalysis:
                 # -2, 113.5, -3.5, 114.5,
             }, temp_filename)
         
-        doc = { "area_bounds": area_bounds, "ncfile": os.path.basename(temp_filename), "date": f"{kwargs['year']}-{kwargs['month']}-{kwargs['day']}" }
-        with open(temp_metafilename, "w") as f:
-            json.dump(doc, f)
+        doc = { 
+            "area_bounds": area_bounds, 
+            "ncfile": os.path.basename(temp_filename), 
+            "date": f"{kwargs['year']}-{kwargs['month']}-{kwargs['day']}",
+            "time": "13:00",
+            "variables": self.variables,
+            "size": info["size"],
+            "checksum": info["checksum"],
+        }
+        self.catalog.commit_download(
+            part_filename, temp_filename, doc, temp_metafilename, checksum=info["checksum"])
         
         return temp_filename
 
@@ -96,20 +112,14 @@ class Reanalysis:
         area_bounds = {"north": north, "west": west, "south": south, "east": east}
 
         # Add caching technique
-        try:
-            date_check=f"{year}-{month}-{day}"
-            cached_file = self._search_cache(area_bounds=area_bounds, date=date_check)
-            if cached_file:
-                print(f"\n[i] Using cached ERA5 data: {date_check}")
-                ncfile = os.path.join(self.temp_dir, cached_file['ncfile'])
-            else:
-                print("\n[REQ] Online ECMWF Request")
-                ncfile = self._retrieve_data(area_bounds=area_bounds, year=year, month=month, day=day)
-        except:
-            print("\n[MSG] Getting cached .nc file has failed")
-            print("[REQ] Online ECMWF Request instead\n")
+        date_check=f"{year}-{month}-{day}"
+        cached_file = self._search_cache(area_bounds=area_bounds, date=date_check)
+        if cached_file:
+            print(f"\n[i] Using cached ERA5 data: {date_check}")
+            ncfile = cached_file['data_path']
+        else:
+            print("\n[REQ] Online ECMWF Request")
             ncfile = self._retrieve_data(area_bounds=area_bounds, year=year, month=month, day=day)
-            pass
         # Add caching technique (end)
 #############################################################################################
         # dataset = xr.open_dataset(ncfile)
@@ -147,18 +157,60 @@ class Reanalysis:
 #############################################################################################
 
 if __name__ == "__main__":
-    import time
-    import random
+    import argparse
+    from era5_scheduler import DownloadScheduler
+
+    parser = argparse.ArgumentParser(description="ERA5 batch ingestion of the study areas")
+    parser.add_argument('-b', '--batch', dest="batch_path", type=str, default="batch_retrieve.json")
+    parser.add_argument('-n', '--max-in-flight', dest="max_in_flight", type=int, default=3)
+    parser.add_argument('-t', '--timeout', dest="timeout", type=int, default=None)
+    parser.add_argument('-c', '--coalesce', dest="coalesce", action="store_true",
+                        help="merge the requests of nearby areas into covering requests")
+    parser.add_argument('-w', '--max-waste', dest="max_waste", type=float, default=0.25,
+                        help="largest share of a covering request outside the areas")
+    args = parser.parse_args()
 
     # only for ingestion purpose
-    with open("batch_retrieve.json", "r") as f:
+    with open(args.batch_path, "r") as f:
         areas = json.load(f)
+
+    reanalyses = {area['name']: Reanalysis(temp_dir=f"era5_nc_{area['name']}") for area in areas}
+
+    def _ingest(job):
+        params = job["params"]
+        print(f"Getting data on {params['name']} {params['date']}")
+        return reanalyses[params['name']].process(
+            shape_files=params["shapefile_path"], year=2020, metadata={ "DATE_ACQUIRED": params['date'] })
+
+    dates = [f"{year}-{month:02d}-15" for year in range(2016, 2022+1) for month in range(1, 12+1)]
+
+    if args.coalesce:
+        from era5_coalesce import coalesce, fan_out, shapefile_bounds
+
+        # Covering downloads are kept apart, every area cache only gets its slice
+        staging = Reanalysis(temp_dir="era5_nc_coalesced")
+        bounds = {area['name']: shapefile_bounds(area["shapefile_path"]) for area in areas}
+        requests = [{"name": area['name'], "shapefile_path": area["shapefile_path"],
+                     "area_bounds": bounds[area['name']], "date": d} for d in dates for area in areas]
+
+        def _ingest_group(job):
+            group = job["params"]["group"]
+            fan_out(group, reanalyses, staging)
+            # Served from the slices now, or requested on their own when not sliced
+            return [_ingest({"params": member}) for member in group["members"]]
+
+        scheduler = DownloadScheduler(
+            task=_ingest_group, max_in_flight=args.max_in_flight, timeout=args.timeout,
+            queue_path="ingest_coalesced_queue.json")
+        for group in coalesce(requests, max_waste=args.max_waste):
+            scheduler.submit(f"{group['date']}_{'+'.join(m['name'] for m in group['members'])}", group=group)
+        scheduler.run()
+    else:
+        scheduler = DownloadScheduler(
+            task=_ingest, max_in_flight=args.max_in_flight, timeout=args.timeout,
+            queue_path="ingest_queue.json")
         for area in areas:
-            reanalysis = Reanalysis(temp_dir=f"era5_nc_{area['name']}")
-            for year in range(2016, 2022+1):
-                for month in range(1, 12+1):
-                    month = "{0:02d}".format(month)
-                    print(f"Getting data on {area['name']} {year}-{month}-15")
-                    res = reanalysis.process(shape_files=area["shapefile_path"], year=2020, metadata={ "DATE_ACQUIRED": f"{year}-{month}-15" })
-            time.sleep(random.randint(1,5)*60)
-            # break
\ No newline at end of file
+            for d in dates:
+                scheduler.submit(f"{area['name']}_{d}", name=area['name'],
+                                 shapefile_path=area["shapefile_path"], date=d)
+        scheduler.run()
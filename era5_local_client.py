@@ -0,0 +1,51 @@
+import json
+import shutil
+import threading
+import time
+
+
+class LocalResult:
+    '''What ``LocalClient.retrieve`` returns without a target, like cdsapi's result'''
+
+    def __init__(self, client, name, request):
+        self.client = client
+        self.name = name
+        self.request = request
+        self.location = None
+        self.content_length = None
+
+    def download(self, target):
+        return self.client.retrieve(self.name, self.request, target)
+
+
+class LocalClient:
+    '''Offline stand-in for ``cdsapi.Client``.
+
+    ``source`` is either a file copied to every target or a callable
+    ``source(request, target)`` writing the result, otherwise the request itself
+    is written as JSON. Every request is recorded in ``self.requests``.
+    '''
+
+    def __init__(self, source=None, delay=0):
+        self.source = source
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def retrieve(self, name, request, target=None):
+        if target is None:
+            return LocalResult(self, name, request)
+
+        with self._lock:
+            self.requests.append({"name": name, "request": request, "target": target})
+
+        time.sleep(self.delay)
+        if callable(self.source):
+            self.source(request, target)
+        elif self.source:
+            shutil.copyfile(self.source, target)
+        else:
+            with open(target, "w") as f:
+                json.dump({"name": name, "request": request}, f)
+
+        return target
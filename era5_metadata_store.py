@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+METADATA_STORE_NAME = "metadata.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS raster_metadata (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    band INTEGER NOT NULL DEFAULT 0,
+    factor TEXT NOT NULL,
+    date_acquired TEXT NOT NULL,
+    spacecraft_id TEXT,
+    wkt_coords TEXT,
+    stat_max REAL,
+    stat_min REAL,
+    stat_mean REAL,
+    stat_med REAL,
+    created_at TEXT NOT NULL,
+    UNIQUE (path, band)
+);
+CREATE INDEX IF NOT EXISTS idx_raster_metadata_factor ON raster_metadata (factor, date_acquired);
+CREATE INDEX IF NOT EXISTS idx_raster_metadata_date ON raster_metadata (date_acquired);
+"""
+
+# Columns as pandas.json_normalize names them for the former per-raster JSON files
+COLUMNS = {
+    "path": "path",
+    "date_acquired": "metadata.DATE_ACQUIRED",
+    "spacecraft_id": "metadata.SPACECRAFT_ID",
+    "wkt_coords": "metadata.WKT_COORDS",
+    "factor": "metadata.FACTORS",
+    "stat_max": "stat_value.max",
+    "stat_min": "stat_value.min",
+    "stat_mean": "stat_value.mean",
+    "stat_med": "stat_value.med",
+}
+
+ROW_COLUMNS = ("path", "band", "factor", "date_acquired", "spacecraft_id", "wkt_coords",
+               "stat_max", "stat_min", "stat_mean", "stat_med", "created_at")
+
+
+def metadata_rows(doc, created_at=None):
+    '''Flatten an extractor metadata document, a cube gives a row per band'''
+    created_at = created_at or datetime.now().isoformat(timespec="seconds")
+    meta = doc["metadata"]
+    bands = doc.get("bands") or [{"band": 0, "DATE_ACQUIRED": meta["DATE_ACQUIRED"], "stat_value": doc["stat_value"]}]
+    for band in bands:
+        stats = band["stat_value"]
+        yield (
+            doc["path"], band["band"], meta["FACTORS"], band["DATE_ACQUIRED"],
+            meta.get("SPACECRAFT_ID"), meta.get("WKT_COORDS"),
+            stats["max"], stats["min"], stats["mean"], stats["med"], created_at,
+        )
+
+
+class MetadataStore:
+    '''Metadata of every extracted raster in one SQLite table.
+
+    Replaces the ``metadata_<name>.json`` file per raster, rows are indexed by
+    factor and date. Rasters written again replace their row.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if os.path.dirname(self.path) and not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with self._connect() as conn:
+            self._migrate(conn)
+            conn.executescript(SCHEMA)
+
+    def _migrate(self, conn):
+        # Stores created before the seq column keyed the rows on (path, band) only
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(raster_metadata)")]
+        if not columns or "seq" in columns:
+            return
+        print(f"[i] Adding the sequence column to {self.path}")
+        conn.execute("ALTER TABLE raster_metadata RENAME TO raster_metadata_old")
+        conn.execute("DROP INDEX IF EXISTS idx_raster_metadata_factor")
+        conn.execute("DROP INDEX IF EXISTS idx_raster_metadata_date")
+        conn.executescript(SCHEMA)
+        conn.execute(f"INSERT INTO raster_metadata ({', '.join(columns)}) "
+                     f"SELECT {', '.join(columns)} FROM raster_metadata_old ORDER BY rowid")
+        conn.execute("DROP TABLE raster_metadata_old")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def append(self, docs):
+        '''Add extractor metadata documents in a single transaction'''
+        created_at = datetime.now().isoformat(timespec="seconds")
+        rows = [row for doc in docs for row in metadata_rows(doc, created_at)]
+        if not rows:
+            return 0
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO raster_metadata ({', '.join(ROW_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(ROW_COLUMNS))})", rows)
+
+        return len(rows)
+
+    def import_json(self, dirpath):
+        '''Load the per-raster JSON files written by earlier versions'''
+        docs = []
+        for name in sorted(os.listdir(dirpath)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(dirpath, name)) as f:
+                docs.append(json.load(f))
+
+        return self.append(docs)
+
+    def to_dataframe(self, factor=None, start=None, end=None, after_seq=None, until_seq=None):
+        '''Rows sorted by date, with the column names of the former JSON files.
+
+        ``start`` and ``end`` (YYYY-MM-DD) are inclusive. ``after_seq`` and
+        ``until_seq`` select the rows written between two ``max_seq`` calls,
+        a replaced row gets a new sequence number. The ``band`` column is only kept when
+        the store holds cubes.
+        '''
+        where, params = [], []
+        if factor is not None:
+            where.append("factor = ?")
+            params.append(factor)
+        if start is not None:
+            where.append("date_acquired >= ?")
+            params.append(str(start))
+        if end is not None:
+            where.append("date_acquired <= ?")
+            params.append(str(end))
+        if after_seq is not None:
+            where.append("seq > ?")
+            params.append(after_seq)
+        if until_seq is not None:
+            where.append("seq <= ?")
+            params.append(until_seq)
+
+        query = f"SELECT {', '.join(COLUMNS)}, band FROM raster_metadata"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY date_acquired, factor, path, band"
+
+        with self._connect() as conn:
+            df = pd.read_sql_query(query, conn, params=params)
+
+        df = df.rename(columns=COLUMNS)
+        if not (df["band"] > 0).any():
+            df = df.drop(columns="band")
+
+        return df
+
+    def max_seq(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM raster_metadata").fetchone()[0]
+
+    def count(self, until_seq):
+        '''Number of rows written up to ``until_seq``'''
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM raster_metadata WHERE seq <= ?", (until_seq,)).fetchone()[0]
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM raster_metadata").fetchone()[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Load per-raster metadata JSON files into the metadata store")
+    parser.add_argument('-d', '--dirpath', dest="dirpath", type=str, default=os.path.join("temp_results", "metadata"))
+    parser.add_argument('-s', '--store', dest="store_path", type=str, default=None)
+    args = parser.parse_args()
+
+    store = MetadataStore(args.store_path or os.path.join(args.dirpath, METADATA_STORE_NAME))
+    print(f"[i] {store.import_json(args.dirpath)} rows imported into {store.path}")
@@ -0,0 +1,208 @@
+import atexit
+import cProfile
+import functools
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_FORMATS = ("jsonl", "prometheus")
+PROMETHEUS_PREFIX = "era5"
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _io_bytes():
+    '''Bytes read and written by this process so far, through any file or socket'''
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        # Block counts of 512 bytes where /proc is not there
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+class Metrics:
+    '''Stage timers and counters of a pipeline run.
+
+    ``stage`` records the wall time, CPU time, peak RSS and bytes read/written
+    of a block, ``incr`` counts events (cache hits, files, bytes). Totals are
+    kept per stage in memory. With ``path`` every stage is also appended to a
+    JSON lines file as it ends (``fmt="jsonl"``), or the totals are written as
+    a Prometheus textfile on ``flush`` (``fmt="prometheus"``). ``profile_stage``
+    runs that stage under cProfile, a .prof file per call lands in
+    ``profile_dir``. Only one profiler can be active in a process, calls of
+    the stage that start while another one is profiled (concurrent downloads)
+    are measured but not profiled.
+
+    Nested stages are measured on their own, a parent includes its children.
+    The peak RSS is the process peak at the end of the stage.
+    '''
+
+    def __init__(self, path=None, fmt="jsonl", profile_stage=None, profile_dir="profiles"):
+        if fmt not in METRICS_FORMATS:
+            raise ValueError(f"Unknown metrics format {fmt}, use {' or '.join(METRICS_FORMATS)}")
+        self.path = path
+        self.fmt = fmt
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._profiled = 0
+        self._profile_lock = threading.Lock()
+        # Only the process that configured the metrics writes the textfile
+        self.owner_pid = int(os.getenv("ERA5_METRICS_OWNER", os.getpid()))
+
+    @contextmanager
+    def stage(self, name, **labels):
+        profiler = None
+        # cProfile (sys.monitoring since 3.12) refuses a second active profiler
+        if name == self.profile_stage and self._profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        read_before, written_before = _io_bytes()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool outside the metrics is active
+                self._profile_lock.release()
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self._profile_lock.release()
+            read_after, written_after = _io_bytes()
+            record = {
+                "stage": name,
+                "wall_s": round(time.perf_counter() - wall, 6),
+                # process_time covers every thread of the process
+                "cpu_s": round(time.process_time() - cpu, 6),
+                "peak_rss_mb": round(_peak_rss_mb(), 1),
+                "read_bytes": read_after - read_before,
+                "written_bytes": written_after - written_before,
+            }
+            self._record(record, labels)
+            if profiler:
+                self._dump_profile(profiler, name)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _record(self, record, labels):
+        with self._lock:
+            totals = self.stages.setdefault(record["stage"], {
+                "count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0, "read_bytes": 0, "written_bytes": 0})
+            totals["count"] += 1
+            for key in ("wall_s", "cpu_s", "read_bytes", "written_bytes"):
+                totals[key] += record[key]
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], record["peak_rss_mb"])
+
+            if self.path and self.fmt == "jsonl":
+                event = {"time": datetime.now().isoformat(timespec="milliseconds"), "host": socket.gethostname(),
+                         "pid": os.getpid(), **record, **labels}
+                # One short append per line, the workers of a pool share the file
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(event, default=str) + "\n")
+
+    def _dump_profile(self, profiler, name):
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        with self._lock:
+            self._profiled += 1
+            path = os.path.join(self.profile_dir, f"{name}_{os.getpid()}_{self._profiled}.prof")
+        profiler.dump_stats(path)
+        print(f"[i] Profile of {name} written to {path} (python -m pstats {path})")
+
+    def summary(self):
+        with self._lock:
+            return {"stages": {k: dict(v) for k, v in self.stages.items()}, "counters": dict(self.counters)}
+
+    def prometheus(self):
+        '''The totals in the Prometheus text exposition format'''
+        summary = self.summary()
+        lines = []
+        series = (("wall_seconds_total", "wall_s", "counter"), ("cpu_seconds_total", "cpu_s", "counter"),
+                   ("calls_total", "count", "counter"), ("peak_rss_megabytes", "peak_rss_mb", "gauge"),
+                   ("read_bytes_total", "read_bytes", "counter"), ("written_bytes_total", "written_bytes", "counter"))
+        for metric, key, kind in series:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_{metric} {kind}")
+            for stage, totals in sorted(summary["stages"].items()):
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_{metric}{{stage="{stage}"}} {round(totals[key], 6)}')
+        for counter, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{counter}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{counter}_total {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        '''Write the Prometheus textfile, replaced in one go for the node exporter.
+
+        The textfile holds the totals of the main process, the stages run by
+        worker processes are only in the JSON lines output.
+        '''
+        if not self.path or self.fmt != "prometheus" or os.getpid() != self.owner_pid:
+            return None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, self.path)
+        return self.path
+
+
+# Process wide instance, configured from the environment so the spawned
+# extraction workers record to the same file
+metrics = Metrics(path=os.getenv("ERA5_METRICS_PATH"), fmt=os.getenv("ERA5_METRICS_FORMAT", "jsonl"),
+                  profile_stage=os.getenv("ERA5_PROFILE_STAGE"), profile_dir=os.getenv("ERA5_PROFILE_DIR", "profiles"))
+atexit.register(metrics.flush)
+
+
+def configure(path=None, fmt="jsonl", profile_stage=None, profile_dir="profiles"):
+    '''Point the process wide metrics at ``path``, worker processes started
+    afterwards inherit the settings'''
+    if fmt not in METRICS_FORMATS:
+        raise ValueError(f"Unknown metrics format {fmt}, use {' or '.join(METRICS_FORMATS)}")
+    metrics.path, metrics.fmt = path, fmt
+    metrics.profile_stage, metrics.profile_dir = profile_stage, profile_dir
+    metrics.owner_pid = os.getpid()
+    for key, value in (("ERA5_METRICS_PATH", path), ("ERA5_METRICS_FORMAT", fmt), ("ERA5_PROFILE_STAGE", profile_stage),
+                       ("ERA5_PROFILE_DIR", profile_dir), ("ERA5_METRICS_OWNER", str(os.getpid()))):
+        if value:
+            os.environ[key] = value
+        else:
+            os.environ.pop(key, None)
+    return metrics
+
+
+def stage(name, **labels):
+    return metrics.stage(name, **labels)
+
+
+def incr(name, value=1):
+    metrics.incr(name, value)
+
+
+def timed(name, **labels):
+    '''Decorator running every call of a function as a stage'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,129 @@
+import queue
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from era5_grib_extractor import _process_file_worker, _worker_pool
+from era5_metrics import incr, stage
+
+
+class ExtractionPipeline:
+    '''Extract the GRIB files of a DownloadScheduler while later ones download.
+
+    Every finished download goes into a queue, ``extract_workers`` processes
+    take them out and run ``ERA5GribExtractor.process`` on them. While
+    ``queue_size`` files wait in the queue the scheduler starts no new
+    download (the running ones finish), so downloads never run more than
+    ``queue_size`` plus the downloads in flight ahead of the extraction.
+
+    A failing file is marked ``extract_status="failed"`` in the scheduler queue
+    and the others go on, a crashed worker process only fails its own file.
+    Downloaded files not extracted yet are picked up again when the same queue
+    file is run again.
+    '''
+
+    def __init__(self, scheduler, extractor, extract_workers=1, queue_size=2, process_kwargs=None, on_extracted=None):
+        self.scheduler = scheduler
+        self.extractor = extractor
+        self.extract_workers = max(1, extract_workers)
+        self.process_kwargs = process_kwargs or {}
+        self.on_extracted = on_extracted
+        self.queue_size = max(1, queue_size)
+        # Not bounded itself, on_done runs on the scheduler loop and must not block
+        self.queue = queue.Queue()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._holding = False
+
+        self._on_download = scheduler.on_done
+        scheduler.on_done = self._downloaded
+        scheduler.hold = self._hold
+
+    def _hold(self):
+        holding = self.queue.qsize() >= self.queue_size
+        if holding and not self._holding:
+            print("[i] Extraction queue full, downloads wait for a free worker")
+        self._holding = holding
+        return holding
+
+    def _enqueue(self, job):
+        self.scheduler.update(job, extract_status="queued", extract_error=None)
+        self.queue.put(job)
+
+    def _downloaded(self, job):
+        if self._on_download:
+            self._on_download(job)
+        if job["status"] == "done" and job["result"]:
+            self._enqueue(job)
+
+    def _submit(self, filename):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = _worker_pool(self.extract_workers)
+            pool = self._pool
+        return pool, pool.submit(_process_file_worker, self.extractor.output_dir, self.extractor.memory_budget_mb,
+                                 self.extractor.json_metadata, filename, self.process_kwargs)
+
+    def _reset_pool(self, pool):
+        # Every thread sharing the broken pool gets the error, it is replaced once
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _extract(self, job):
+        self.scheduler.update(job, extract_status="running")
+        pool = None
+        try:
+            with stage("extract", job=job["id"]):
+                pool, future = self._submit(job["result"])
+                docs = future.result()
+            if self.extractor.store is not None:
+                self.extractor.store.append(docs)
+            self.scheduler.update(job, extract_status="done", extract_error=None)
+            print(f"[i] Job {job['id']}: extracted {len(docs)} rasters")
+        except BrokenProcessPool as e:
+            self._reset_pool(pool)
+            self._failed(job, f"extraction worker crashed: {e}")
+        except Exception as e:
+            self._failed(job, str(e))
+
+        if self.on_extracted:
+            try:
+                self.on_extracted(job)
+            except Exception as e:
+                print(f"[E] Extraction callback failed for {job['id']}: {e}")
+
+    def _failed(self, job, error):
+        incr("extract_failed")
+        self.scheduler.update(job, extract_status="failed", extract_error=error)
+        print(f"[E] Job {job['id']}: extraction failed ({error})")
+
+    def _consume(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self._extract(job)
+
+    def run(self):
+        '''Download and extract every job, returns the scheduler jobs'''
+        consumers = [threading.Thread(target=self._consume, name=f"extract-{i}", daemon=True)
+                     for i in range(self.extract_workers)]
+        for consumer in consumers:
+            consumer.start()
+
+        try:
+            # Downloaded by an earlier run, extracted first
+            for job in self.scheduler.jobs:
+                if job["status"] == "done" and job["result"] and job.get("extract_status") != "done":
+                    self._enqueue(job)
+            self.scheduler.run()
+        finally:
+            for _ in consumers:
+                self.queue.put(None)
+            for consumer in consumers:
+                consumer.join()
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+
+        return self.scheduler.jobs
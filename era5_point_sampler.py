@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+from era5_grib_reader import iter_windows, open_era5_hypercubes
+from era5_zonal_stats import weighted_mean
+
+SAMPLE_METHODS = ("nearest", "bilinear")
+
+
+def _unit_vectors(lon, lat):
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _inside(coords, values):
+    # Points up to half a cell outside the outer cell centers still fall in the grid
+    half = abs(coords[1] - coords[0]) / 2 if len(coords) > 1 else 0.125
+    return (values >= coords.min() - half) & (values <= coords.max() + half)
+
+
+def nearest_weights(lat, lon, x, y):
+    '''Sparse (point, cell) matrix selecting the nearest grid cell of every point.
+
+    The grid cell centers go into a cKDTree on the unit sphere once, all
+    points are then matched in one query.
+    '''
+    lat, lon = np.asarray(lat, dtype="float64"), np.asarray(lon, dtype="float64")
+    x, y = np.asarray(x, dtype="float64"), np.asarray(y, dtype="float64")
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    tree = cKDTree(_unit_vectors(lon2d.ravel(), lat2d.ravel()))
+    _, cell = tree.query(_unit_vectors(x, y))
+
+    rows = np.flatnonzero(_inside(lon, x) & _inside(lat, y))
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cell[rows])), shape=(len(x), lat.size * lon.size))
+
+
+def _axis_neighbours(coords, values):
+    '''Lower/upper index and upper weight of ``values`` along a regular axis'''
+    n = len(coords)
+    if n == 1:
+        zeros = np.zeros(len(values), dtype=int)
+        return zeros, zeros, np.zeros(len(values))
+
+    descending = coords[0] > coords[-1]
+    ascending = coords[::-1] if descending else coords
+    lower = np.clip(np.searchsorted(ascending, values, side="right") - 1, 0, n - 2)
+    frac = np.clip((values - ascending[lower]) / (ascending[lower+1] - ascending[lower]), 0.0, 1.0)
+    upper = lower + 1
+    if descending:
+        lower, upper = n - 1 - lower, n - 1 - upper
+
+    return lower, upper, frac
+
+
+def bilinear_weights(lat, lon, x, y):
+    '''Sparse (point, cell) matrix of the bilinear weights of the four
+    surrounding grid cells of every point, points off the grid get no weights.
+    '''
+    lat, lon = np.asarray(lat, dtype="float64"), np.asarray(lon, dtype="float64")
+    x, y = np.asarray(x, dtype="float64"), np.asarray(y, dtype="float64")
+    lat0, lat1, wy = _axis_neighbours(lat, y)
+    lon0, lon1, wx = _axis_neighbours(lon, x)
+    inside = _inside(lon, x) & _inside(lat, y)
+
+    rows = np.tile(np.arange(len(x)), 4)
+    cells = np.concatenate([lat0 * lon.size + lon0, lat0 * lon.size + lon1,
+                            lat1 * lon.size + lon0, lat1 * lon.size + lon1])
+    weights = np.concatenate([(1-wy) * (1-wx), (1-wy) * wx, wy * (1-wx), wy * wx])
+    keep = np.tile(inside, 4) & (weights > 0)
+
+    return scipy.sparse.csr_matrix(
+        (weights[keep], (rows[keep], cells[keep])), shape=(len(x), lat.size * lon.size))
+
+
+class PointSampler:
+    '''Values of a (time, lat, lon) grid at many points.
+
+    The point index (a sparse weight matrix) is built once per grid, sampling
+    a window of the cube is then one sparse matrix product. NaN cells are left
+    out of the bilinear weights.
+    '''
+
+    def __init__(self, lat, lon, x, y, method="nearest"):
+        if method not in SAMPLE_METHODS:
+            raise ValueError(f"Unknown method {method}, use {' or '.join(SAMPLE_METHODS)}")
+        self.shape = (len(lat), len(lon))
+        self.method = method
+        build = nearest_weights if method == "nearest" else bilinear_weights
+        self.weights = build(lat, lon, x, y)
+
+    def sample(self, values):
+        '''(time, lat, lon) values to (time, point)'''
+        return weighted_mean(self.weights, np.asarray(values).reshape(-1, self.shape[0] * self.shape[1]))
+
+    def sample_at(self, values, time_index, points=None):
+        '''Value of every point at its own time step, ``time_index`` per point'''
+        points = np.arange(self.weights.shape[0]) if points is None else np.asarray(points)
+        flat = np.asarray(values).reshape(-1, self.shape[0] * self.shape[1])
+        out = np.full(len(points), np.nan)
+        # One product per distinct time step instead of one per point
+        for step in np.unique(time_index):
+            selected = np.flatnonzero(time_index == step)
+            out[selected] = weighted_mean(self.weights[points[selected]], flat[step:step+1])[0]
+
+        return out
+
+
+def sample_points(filename, lons, lats, times=None, ids=None, variables=("t2m", "tp", "d2m"),
+                  method="nearest", window_days=31):
+    '''Sample an ERA5 file at the given points into a tidy DataFrame.
+
+    Without ``times`` every point gets the full hourly series (one row per point
+    and valid_time). With ``times`` (one timestamp per point) every point gets
+    the value of the nearest hour, rows then keep the order of the points.
+    '''
+    lons, lats = np.asarray(lons, dtype="float64"), np.asarray(lats, dtype="float64")
+    ids = np.arange(len(lons)) if ids is None else np.asarray(ids)
+    hypercubes = open_era5_hypercubes(filename, variables=variables, strict=False)
+    sampler = PointSampler(hypercubes[0]["latitude"].values, hypercubes[0]["longitude"].values, lons, lats, method=method)
+
+    if times is None:
+        frames = []
+        for ds in iter_windows(hypercubes, variables, window_days=window_days):
+            n_times = ds.sizes["valid_time"]
+            frame = {
+                "point": np.tile(ids, n_times),
+                "valid_time": np.repeat(ds["valid_time"].values, len(ids)),
+                "longitude": np.tile(lons, n_times),
+                "latitude": np.tile(lats, n_times),
+            }
+            for var in ds.data_vars:
+                frame[var] = sampler.sample(ds[var].values).ravel()
+            frames.append(pd.DataFrame(frame))
+        return pd.concat(frames, ignore_index=True)
+
+    times = pd.to_datetime(np.asarray(times)).values.astype("datetime64[ns]")
+    frame = {"point": ids, "time": times, "longitude": lons, "latitude": lats,
+             "valid_time": np.full(len(ids), np.datetime64("NaT"), dtype="datetime64[ns]")}
+    values = {}
+    for ds in iter_windows(hypercubes, variables, window_days=window_days):
+        valid_time = ds["valid_time"].values
+        half_step = (valid_time[1] - valid_time[0]) / 2 if len(valid_time) > 1 else np.timedelta64(30, "m")
+        in_window = np.flatnonzero((times >= valid_time[0] - half_step) & (times < valid_time[-1] + half_step))
+        if not len(in_window):
+            continue
+        # Nearest hour of every point in this window
+        step = np.clip(np.searchsorted(valid_time, times[in_window] + half_step, side="right") - 1, 0, len(valid_time) - 1)
+        frame["valid_time"][in_window] = valid_time[step]
+        for var in ds.data_vars:
+            values.setdefault(var, np.full(len(ids), np.nan))[in_window] = sampler.sample_at(ds[var].values, step, in_window)
+
+    return pd.DataFrame({**frame, **values})
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Sample ERA5 values at point locations")
+    parser.add_argument('-f', '--file', dest="filename", type=str, required=True)
+    parser.add_argument('-p', '--points', dest="points", type=str, required=True, help="CSV with lon, lat and optionally time columns")
+    parser.add_argument('-m', '--method', dest="method", type=str, default="nearest", choices=SAMPLE_METHODS)
+    parser.add_argument('-o', '--output', dest="output", type=str, default="point_samples.csv")
+    args = parser.parse_args()
+
+    points = pd.read_csv(args.points)
+    df = sample_points(args.filename, points["lon"].values, points["lat"].values,
+                       times=points["time"].values if "time" in points else None,
+                       ids=points["id"].values if "id" in points else None, method=args.method)
+    df.to_csv(args.output, index=False)
+    print(f"[i] {len(df)} rows written to {args.output}")
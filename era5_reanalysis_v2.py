@@ -8,112 +8,65 @@ import shutil
 import json
 from datetime import datetime, date
 
+from era5_cache_catalog import CacheCatalog
+from era5_request_planner import RequestPlanner, retrieve_chunk, retrieve_range
+from era5_grib_reader import open_era5_dataset
+
 from dotenv import load_dotenv
 load_dotenv()
 
 class Reanalysis:
 
-    def __init__(self):
+    def __init__(self, client=None, planner=None):
         # self.uid = os.getenv("ERA5_UID")
         # self.api_key = os.getenv("ERA5_API_KEY")
+        self.client = client
+        self.planner = planner or RequestPlanner()
+        self.variables = [
+                "2m_temperature",
+                "total_precipitation",
+                # additional (2026.02.18)
+                "2m_dewpoint_temperature",
+            ]
         
         self.temp_dir = "era5_cache"
         if not os.path.exists(self.temp_dir):
             os.makedirs(self.temp_dir)
+        self.catalog = CacheCatalog(self.temp_dir)
 
     def _search_cache(self, area_bounds, **kwargs):
         cached_data = {}
         try:
-            lfs = [f for f in os.listdir("era5_cache") if ".json" in f]
-            for lf in lfs:
-                selected = json.load(open(os.path.join("era5_cache", lf)))
-                if 'start_date' not in selected:
-                    continue
-                
-                check_date = (selected['start_date'] == kwargs['start_date']) and (selected['end_date'] == kwargs['end_date'])
-                if selected['area_bounds'] == area_bounds and check_date:
-                    cached_data = selected
-                # elif selected['area_bounds'] == area_bounds:
-                #     cached_data = selected
+            cached_data = self.catalog.lookup(
+                area_bounds, start_date=kwargs['start_date'], end_date=kwargs['end_date'],
+                variables=kwargs.get('variables'))
         except Exception as e:
             print("[E] Failed to get cached data", e)
             pass
         
         return cached_data
 
-    def _retrieve_data(self, area_bounds, **kwargs):
+    def _retrieve_data(self, area_bounds, chunk):
         # This program created to run 1-by-1 retrieving data because
         # later the data will changed into raster images.
-        
-        nowdate = datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S")
-        # date_filename = f"{min(kwargs['year'])}{min(kwargs['month'])}_{max(kwargs['year'])}{max(kwargs['month'])}"
-        # temp_filename = os.path.join(self.temp_dir, f"{nowdate}_{date_filename}.grib")
-        # temp_metafilename = os.path.join(self.temp_dir, f"{nowdate}_{date_filename}_meta.json")
-
-        # years = [str(y) for y in kwargs['year']]
-        # months = [str(m) for m in kwargs['month']]
-        # days = [str(d) for d in kwargs['day']]
-
-        print("""
-            - year: 2015
-            - months: [1...12]
-            - day: [1...31]
-            - variables: ["2m_temperature","total_precipitation","2m_dewpoint_temperature"
-        """)
-
-        years = ["2015"]
-        variable = [
-                "2m_temperature",
-                "total_precipitation",
-                # additional (2026.02.18)
-                "2m_dewpoint_temperature",
-                # "soil_temperature_level_1",
-                # "volumetric_soil_water_layer_1",
-                # "high_vegetation_cover",
-                # "low_vegetation_cover",
-                # "total_cloud_cover"
-            ]
-        temp_filename = os.path.join(self.temp_dir, f"{nowdate}_{years[0]}_{"-".join([var for var in variable])}.grib")
-        temp_metafilename = os.path.join(self.temp_dir, f"{nowdate}_{years[0]}_{"-".join([var for var in variable])}_meta.json")
-
-
-        dataset = "reanalysis-era5-single-levels"
-        request = {
-            "product_type": ["reanalysis"],
-            "variable": variable,
-            "year": years, #years,
-            "month": [f"{number:02d}" for number in range(1, 12+1)], # months,
-            "day": [f"{number:02d}" for number in range(1, 31+1)], # days,
-            "time": [f"{number:02d}:00" for number in range(24)],
-            "data_format": "grib",
-            "download_format": "unarchived",
-            'area': [ area_bounds["north"], area_bounds["west"], 
-                     area_bounds["south"], area_bounds["east"] ],
-        }
-
-        client = cdsapi.Client()
-        client.retrieve(dataset, request, temp_filename)
-        
-        doc = { 
-            "area_bounds": area_bounds, 
-            "data_path": temp_filename, 
-            # "date": f"{kwargs['year']}-{kwargs['month']}-{kwargs['day']}"
-            "start_date": f"{min(kwargs['year'])}{min(kwargs['month'])}",
-            "end_date": f"{max(kwargs['year'])}{max(kwargs['month'])}",
-        }
-        with open(temp_metafilename, "w") as f:
-            json.dump(doc, f)
-        
-        return temp_filename
+        client = self.client or cdsapi.Client()
+        return retrieve_chunk(client, self.planner, self.catalog, self.temp_dir, area_bounds, chunk)
 
-    def _retrieve_var(self, dataset):
-        t2m_dataset = xr.open_dataset(dataset, engine="cfgrib")
-        t2m_df = t2m_dataset.to_dataframe().reset_index()
-        tp_dataset = xr.open_dataset(dataset, engine="cfgrib", 
-                                     backend_kwargs={'filter_by_keys': {'shortName': 'tp'}})
-        tp_df = tp_dataset.to_dataframe().reset_index()
+    def _retrieve_range(self, area_bounds, start, end):
+        def _lookup(chunk):
+            cached_file = self._search_cache(
+                area_bounds=area_bounds, start_date=chunk["start_date"], end_date=chunk["end_date"],
+                variables=chunk["variable"])
+            return cached_file.get("data_path")
+
+        return retrieve_range(
+            self.planner, self.catalog, self.temp_dir, area_bounds, start, end, self.variables, lookup=_lookup,
+            retrieve=lambda chunk: self._retrieve_data(area_bounds=area_bounds, chunk=chunk))
 
-        merged = pd.merge(t2m_df, tp_df[['tp']], on=t2m_df.index, how='left')
+    def _retrieve_var(self, dataset):
+        # t2m, tp and d2m decoded from a single scan of the file
+        merged = open_era5_dataset(dataset, variables=self.variables, strict=False)
+        merged = merged.to_dataframe().reset_index()
 
         return merged
 
@@ -175,23 +128,19 @@ class Reanalysis:
         area_bounds = {"north": north, "west": west, "south": south, "east": east}
 
         # Add caching technique
-        start_date = f"{min(year)}{min(month)}"
-        end_date = f"{max(year)}{max(month)}"
-
-        try:
-            # date_check=f"{year}-{month}-{day}"
-            cached_file = self._search_cache(area_bounds=area_bounds, start_date=start_date, end_date=end_date)
-            if cached_file:
-                print(f"\n[i] Using cached ERA5 data: {start_date}_{end_date}")
-                gribfile = cached_file['data_path']
-            else:
-                print("\n[REQ] Online ECMWF Request")
-                gribfile = self._retrieve_data(area_bounds=area_bounds, year=year, month=month, day=day)
-        except:
-            print(f"\n[MSG] Getting cached .grib file has failed: {start_date}_{end_date}")
-            print("[REQ] Online ECMWF Request instead\n")
-            gribfile = self._retrieve_data(area_bounds=area_bounds, year=year, month=month, day=day)
-            pass
+        years = year if isinstance(year, list) else [year]
+        start_date = f"{min(years)}-01-01__00:00"
+        end_date = f"{max(years)}-12-31__23:00"
+
+        cached_file = self._search_cache(
+            area_bounds=area_bounds, start_date=start_date, end_date=end_date, variables=self.variables)
+        if cached_file:
+            print(f"\n[i] Using cached ERA5 data: {start_date}_{end_date}")
+            gribfile = cached_file['data_path']
+        else:
+            print("\n[REQ] Online ECMWF Request")
+            gribfile = self._retrieve_range(
+                area_bounds=area_bounds, start=f"{min(years)}-01-01", end=f"{max(years)}-12-31")
         # Add caching technique (end)
 
         return gribfile
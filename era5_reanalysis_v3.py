@@ -8,116 +8,70 @@ import shutil
 import json
 from datetime import datetime, date
 
+from era5_cache_catalog import CacheCatalog
+from era5_request_planner import RequestPlanner, retrieve_chunk, retrieve_range
+from era5_metrics import incr, stage
+
 from dotenv import load_dotenv
 load_dotenv()
 
 class Reanalysis:
 
-    def __init__(self):
+    def __init__(self, client=None, planner=None):
+        # client: cdsapi.Client compatible object, e.g. era5_local_client.LocalClient offline
+        self.client = client
+        self.planner = planner or RequestPlanner()
+        self.variables = [
+                "2m_temperature",
+                "total_precipitation",
+                # additional (2026.02.18)
+                "2m_dewpoint_temperature",
+                # "soil_temperature_level_1",
+                # "volumetric_soil_water_layer_1",
+                # "high_vegetation_cover",
+                # "low_vegetation_cover",
+                # "total_cloud_cover"
+            ]
         self.temp_dir = "era5_cache"
         if not os.path.exists(self.temp_dir):
             os.makedirs(self.temp_dir)
+        self.catalog = CacheCatalog(self.temp_dir)
 
     def _search_cache(self, area_bounds, **kwargs):
         cached_data = {}
-        try:
-            lfs = [f for f in os.listdir("era5_cache") if ".json" in f]
-            for lf in lfs:
-                selected = json.load(open(os.path.join("era5_cache", lf)))
-                if 'start_date' not in selected:
-                    continue
-                
-                check_date = (selected['start_date'] == kwargs['start_date']) and (selected['end_date'] == kwargs['end_date'])
-                if selected['area_bounds'] == area_bounds and check_date:
-                    cached_data = selected
-                # elif selected['area_bounds'] == area_bounds:
-                #     cached_data = selected
-        except Exception as e:
-            print("[E] Failed to get cached data", e)
-            pass
+        with stage("cache_lookup"):
+            try:
+                cached_data = self.catalog.lookup(
+                    area_bounds, start_date=kwargs['start_date'], end_date=kwargs['end_date'],
+                    variables=kwargs.get('variables'))
+                if not cached_data:
+                    # Fall back to any cached file covering this area and period
+                    cached_data = self.catalog.serve(
+                        area_bounds, start_date=kwargs['start_date'], end_date=kwargs['end_date'],
+                        variables=kwargs.get('variables'), materialize=True) or {}
+            except Exception as e:
+                print("[E] Failed to get cached data", e)
+                pass
+        incr("cache_hit" if cached_data else "cache_miss")
         
         return cached_data
 
-    def _retrieve_data(self, area_bounds, **kwargs):
+    def _retrieve_data(self, area_bounds, chunk):
         # This program created to run 1-by-1 retrieving data because
         # later the data will changed into raster images.
-        
-        nowdate = datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S")
+        client = self.client or cdsapi.Client()
+        return retrieve_chunk(client, self.planner, self.catalog, self.temp_dir, area_bounds, chunk)
 
-        years = [str(kwargs['year'])]
-        months = [f"{number:02d}" for number in range(1, 12+1)]
-        days = [f"{number:02d}" for number in range(1, 31+1)]
-        times = [f"{number:02d}:00" for number in range(24)]
-        variable = [
-                "2m_temperature",
-                "total_precipitation",
-                # additional (2026.02.18)
-                "2m_dewpoint_temperature",
-                # "soil_temperature_level_1",
-                # "volumetric_soil_water_layer_1",
-                # "high_vegetation_cover",
-                # "low_vegetation_cover",
-                # "total_cloud_cover"
-            ]
-        temp_filename = os.path.join(self.temp_dir, f"{nowdate}_{years[0]}_{"-".join([var for var in variable])}.grib")
-        temp_metafilename = os.path.join(self.temp_dir, f"{nowdate}_{years[0]}_{"-".join([var for var in variable])}_meta.json")
-
-        print("=========================================================")
-        print("Downloading {year}-{min_month}-{min_day} to {year}-{max_month}-{max_day} ".format(
-            year=years[0], 
-            min_month=min(months), max_month=max(months),
-            min_day=min(days), max_day=max(days),
-        ))
-        print("Variables: {var}".format(var=variable))
-
-        dataset = "reanalysis-era5-single-levels"
-        request = {
-            "product_type": ["reanalysis"],
-            "variable": variable,
-            "year": years,
-            "month": months,
-            "day": days,
-            "time": times,
-            "data_format": "grib",
-            "download_format": "unarchived",
-            'area': [ area_bounds["north"], area_bounds["west"], 
-                     area_bounds["south"], area_bounds["east"] ],
-        }
-
-        client = cdsapi.Client()
-        client.retrieve(dataset, request, temp_filename)
-        
-        doc = { 
-            "area_bounds": area_bounds, 
-            "data_path": temp_filename, 
-            "start_date": f"{years[0]}-{min(months)}-{min(days)}__{min(times)}",
-            "end_date": f"{years[0]}-{max(months)}-{max(days)}__{max(times)}",
-        }
-        with open(temp_metafilename, "w") as f:
-            json.dump(doc, f)
-        
-        return temp_filename
-
-    def _iterate_date(self, year):
-
-        months = [m for m in range(1, 12+1)]
-
-        d31a = [d for d in range(1,7+1, 2)]
-        # d30a = [d for d in range(2,7+1, 2)]
-        d31b = [d for d in range(8,12+1, 2)]
-        # d30b = [d for d in range(9,12+1, 2)]
-
-        for month in months:
-            if (year % 4 == 0) and month == 2:
-                days = [d for d in range(1, 29+1)]
-            elif month == 2:
-                days = [d for d in range(1, 28+1)]
-            elif month in d31a or month in d31b:
-                days = [d for d in range(1, 31+1)]
-            else:
-                days = [d for d in range(1, 30+1)]
-        
-        return months, days
+    def _retrieve_range(self, area_bounds, start, end):
+        def _lookup(chunk):
+            cached_file = self._search_cache(
+                area_bounds=area_bounds, start_date=chunk["start_date"], end_date=chunk["end_date"],
+                variables=chunk["variable"])
+            return cached_file.get("data_path")
+
+        return retrieve_range(
+            self.planner, self.catalog, self.temp_dir, area_bounds, start, end, self.variables, lookup=_lookup,
+            retrieve=lambda chunk: self._retrieve_data(area_bounds=area_bounds, chunk=chunk))
 
     def process(self, shape_files, **kwargs):
         
@@ -131,8 +85,18 @@ class Reanalysis:
         # Get minX, minY, maxX, maxY
         west, south, east, north = gdf.total_bounds
         area_bounds = {"north": north, "west": west, "south": south, "east": east}
-    
-        gribfile = self._retrieve_data(area_bounds=area_bounds, year=year)
+
+        # Add caching technique
+        start_date, end_date = f"{year}-01-01__00:00", f"{year}-12-31__23:00"
+        cached_file = self._search_cache(
+            area_bounds=area_bounds, start_date=start_date, end_date=end_date, variables=self.variables)
+        if cached_file:
+            print(f"\n[i] Using cached ERA5 data: {start_date}_{end_date}")
+            gribfile = cached_file['data_path']
+        else:
+            print("\n[REQ] Online ECMWF Request")
+            gribfile = self._retrieve_range(area_bounds=area_bounds, start=f"{year}-01-01", end=f"{year}-12-31")
+        # Add caching technique (end)
         
         return gribfile
 
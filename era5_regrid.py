@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import rasterio
+import rasterio.warp
+import rioxarray
+import scipy.sparse
+import shapely
+import xarray as xr
+from rasterio.transform import Affine
+
+from era5_point_sampler import bilinear_weights
+from era5_zonal_stats import coverage_weights, weighted_mean
+
+REGRID_METHODS = ("bilinear", "conservative")
+
+
+def target_grid(path, scale=1):
+    '''CRS, transform and shape of a raster, read from its header.
+
+    ``scale`` coarsens the grid (2 = pixels twice as large), a full 10 m
+    Sentinel-2 band has 120 million pixels.
+    '''
+    with rasterio.open(path) as src:
+        transform = src.transform * Affine.scale(scale)
+        return {
+            "crs": src.crs.to_wkt(),
+            "transform": list(transform)[:6],
+            "width": int(np.ceil(src.width / scale)),
+            "height": int(np.ceil(src.height / scale)),
+        }
+
+
+def _to_lonlat(grid, cols, rows):
+    a, b, c, d, e, f = grid["transform"]
+    xs, ys = a * cols + b * rows + c, d * cols + e * rows + f
+    lon, lat = rasterio.warp.transform(grid["crs"], "EPSG:4326", xs, ys)
+    return np.asarray(lon), np.asarray(lat)
+
+
+def pixel_centers(grid):
+    '''Longitude/latitude of every target pixel center, flattened in C order'''
+    rows, cols = np.mgrid[0:grid["height"], 0:grid["width"]]
+    return _to_lonlat(grid, cols.ravel() + 0.5, rows.ravel() + 0.5)
+
+
+def pixel_polygons(grid):
+    '''Target pixels as EPSG:4326 polygons, from the reprojected pixel corners'''
+    height, width = grid["height"], grid["width"]
+    rows, cols = np.mgrid[0:height+1, 0:width+1]
+    lon, lat = _to_lonlat(grid, cols.ravel(), rows.ravel())
+    lon, lat = lon.reshape(height+1, width+1), lat.reshape(height+1, width+1)
+
+    corners = np.stack([
+        np.stack([lon[:-1, :-1], lat[:-1, :-1]], axis=-1),
+        np.stack([lon[:-1, 1:], lat[:-1, 1:]], axis=-1),
+        np.stack([lon[1:, 1:], lat[1:, 1:]], axis=-1),
+        np.stack([lon[1:, :-1], lat[1:, :-1]], axis=-1),
+    ], axis=2).reshape(-1, 4, 2)
+    return shapely.polygons(corners)
+
+
+def regrid_weights(lat, lon, grid, method="bilinear"):
+    '''Sparse (target pixel, source cell) weights from the ERA5 grid to ``grid``'''
+    if method == "bilinear":
+        x, y = pixel_centers(grid)
+        return bilinear_weights(lat, lon, x, y)
+    # The share of each ERA5 cell inside a pixel, as for the zonal statistics
+    return coverage_weights(lat, lon, pixel_polygons(grid))
+
+
+def weights_key(lat, lon, grid, method):
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(lat, dtype="float64").tobytes())
+    sha.update(np.ascontiguousarray(lon, dtype="float64").tobytes())
+    sha.update(json.dumps([grid, method], sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class Regridder:
+    '''Resample (time, lat, lon) ERA5 fields onto a target raster grid.
+
+    The weights are computed once per (source grid, target grid, method) and
+    optionally cached in ``cache_dir``, every timestep and variable is then one
+    sparse matrix product. NaN cells are left out of the weights.
+    '''
+
+    def __init__(self, lat, lon, grid, method="bilinear", cache_dir=None):
+        if method not in REGRID_METHODS:
+            raise ValueError(f"Unknown method {method}, use {' or '.join(REGRID_METHODS)}")
+        self.lat, self.lon = np.asarray(lat), np.asarray(lon)
+        self.grid = grid
+        self.method = method
+        self.weights = None
+
+        cache_path = None
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            cache_path = os.path.join(cache_dir, f"regrid_{weights_key(self.lat, self.lon, grid, method)}.npz")
+            if os.path.exists(cache_path):
+                self.weights = scipy.sparse.load_npz(cache_path).tocsr()
+
+        if self.weights is None:
+            self.weights = regrid_weights(self.lat, self.lon, grid, method)
+            if cache_path:
+                scipy.sparse.save_npz(cache_path, self.weights)
+
+    def regrid(self, values):
+        '''(time, lat, lon) values to (time, height, width) on the target grid'''
+        flat = np.asarray(values).reshape(-1, len(self.lat) * len(self.lon))
+        return weighted_mean(self.weights, flat).reshape(-1, self.grid["height"], self.grid["width"])
+
+
+def read_raster_stack(path):
+    '''Bands, cell center lat/lon and band descriptions of an extracted ERA5 raster'''
+    with rasterio.open(path) as src:
+        values = src.read().astype("float64")
+        if src.nodata is not None:
+            values[values == src.nodata] = np.nan
+        lon = src.transform.c + (np.arange(src.width) + 0.5) * src.transform.a
+        lat = src.transform.f + (np.arange(src.height) + 0.5) * src.transform.e
+        return values, lat, lon, list(src.descriptions)
+
+
+def write_regridded(values, grid, path, descriptions=None):
+    '''Write (band, height, width) values aligned to ``grid`` as GeoTIFF or NetCDF'''
+    transform = Affine(*grid["transform"])
+    if path.endswith(".nc"):
+        # Pixel center coordinates of a north-up grid
+        xs = transform.c + (np.arange(grid["width"]) + 0.5) * transform.a
+        ys = transform.f + (np.arange(grid["height"]) + 0.5) * transform.e
+        da = xr.DataArray(values.astype("float32"), dims=("band", "y", "x"),
+                          coords={"band": descriptions or list(range(1, len(values)+1)), "y": ys, "x": xs})
+        da = da.rio.write_crs(grid["crs"]).rio.write_transform(transform)
+        da.to_dataset(name="value").to_netcdf(path, encoding={"value": {"zlib": True, "complevel": 4}})
+        return path
+
+    with rasterio.open(path, "w", driver="GTiff", count=len(values), height=grid["height"], width=grid["width"],
+                       dtype="float32", crs=grid["crs"], transform=transform, nodata=np.nan,
+                       compress="deflate", tiled=True) as dst:
+        dst.write(values.astype("float32"))
+        for band, description in enumerate(descriptions or [], start=1):
+            if description:
+                dst.set_band_description(band, description)
+
+    return path
+
+
+def regrid_rasters(paths, target_raster, output_dir="temp_results/regrid", method="bilinear",
+                   fmt="tif", scale=1, cache_dir=os.path.join("era5_cache", "weights")):
+    '''Regrid extracted ERA5 rasters (daily TIFs or cubes) onto a target raster grid.
+
+    Rasters sharing the ERA5 grid share one Regridder, its weights are built
+    once and reused for every file and band.
+    '''
+    grid = target_grid(target_raster, scale=scale)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    regridders, outputs = {}, []
+    for path in paths:
+        values, lat, lon, descriptions = read_raster_stack(path)
+        key = (lat.tobytes(), lon.tobytes())
+        if key not in regridders:
+            regridders[key] = Regridder(lat, lon, grid, method=method, cache_dir=cache_dir)
+        regridded = regridders[key].regrid(values)
+
+        name = os.path.splitext(os.path.basename(path))[0] + (".nc" if fmt == "netcdf" else ".TIF")
+        outputs.append(write_regridded(regridded, grid, os.path.join(output_dir, name), descriptions))
+
+    return outputs
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+    parser = argparse.ArgumentParser(description="Regrid extracted ERA5 rasters onto a Sentinel raster grid")
+    parser.add_argument('-rp', '--raster-path', dest="raster_path", type=str, required=True, help="target raster")
+    parser.add_argument('-i', '--input', dest="input", type=str, default=os.path.join("temp_results", "raster", "*.TIF"))
+    parser.add_argument('-o', '--output-dir', dest="output_dir", type=str, default=os.path.join("temp_results", "regrid"))
+    parser.add_argument('-m', '--method', dest="method", type=str, default="bilinear", choices=REGRID_METHODS)
+    parser.add_argument('-f', '--format', dest="fmt", type=str, default="tif", choices=("tif", "netcdf"))
+    parser.add_argument('-s', '--scale', dest="scale", type=int, default=1, help="coarsen the target grid")
+    args = parser.parse_args()
+
+    outputs = regrid_rasters(sorted(glob.glob(args.input)), args.raster_path, output_dir=args.output_dir,
+                             method=args.method, fmt=args.fmt, scale=args.scale)
+    print(f"[i] {len(outputs)} rasters regridded into {args.output_dir}")
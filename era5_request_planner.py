@@ -0,0 +1,225 @@
+import calendar
+import json
+import os
+import shutil
+from datetime import date, datetime
+
+import xarray as xr
+
+from era5_download import retrieve_verified
+from era5_grib_reader import open_era5_dataset
+from era5_metrics import incr, stage
+
+ERA5_DATASET = "reanalysis-era5-single-levels"
+# Field limit of a single reanalysis-era5-single-levels request on the CDS
+# (variables x dates x times)
+CDS_MAX_FIELDS = 120000
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
+class RequestPlanner:
+    '''Split a (bbox, start, end, variables) request into CDS sized chunks.
+
+    Only valid calendar dates are requested. Because the CDS builds the cartesian
+    product of year x month x day, months are only grouped into one chunk when
+    they share the same year and list of days.
+    '''
+
+    def __init__(self, max_fields=CDS_MAX_FIELDS, max_months=1, times=None):
+        self.max_fields = max_fields
+        # One month per request gets through the CDS queue the fastest
+        self.max_months = max_months
+        self.times = times or [f"{number:02d}:00" for number in range(24)]
+
+    def _month_units(self, start, end, n_variables):
+        # Largest number of days of one variable set that fits in a request
+        max_days = max(1, self.max_fields // (n_variables * len(self.times)))
+
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            first = max(start, date(year, month, 1))
+            last = min(end, date(year, month, calendar.monthrange(year, month)[1]))
+            days = [first.day + i for i in range((last - first).days + 1)]
+            for i in range(0, len(days), max_days):
+                yield year, month, days[i:i+max_days]
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def _make_chunk(self, year, months, days, variables):
+        last_month = months[-1]
+        return {
+            "key": f"{year}{months[0]:02d}{days[0]:02d}_{year}{last_month:02d}{days[-1]:02d}",
+            "year": [str(year)],
+            "month": [f"{m:02d}" for m in months],
+            "day": [f"{d:02d}" for d in days],
+            "time": list(self.times),
+            "variable": list(variables),
+            "start_date": f"{year}-{months[0]:02d}-{days[0]:02d}__{min(self.times)}",
+            "end_date": f"{year}-{last_month:02d}-{days[-1]:02d}__{max(self.times)}",
+            "fields": len(variables) * len(months) * len(days) * len(self.times),
+            "status": "pending",
+            "data_path": None,
+        }
+
+    def plan(self, start, end, variables):
+        start, end = _to_date(start), _to_date(end)
+        if end < start:
+            raise ValueError(f"End date {end} is before start date {start}")
+
+        chunks = []
+        group = None
+        for year, month, days in self._month_units(start, end, len(variables)):
+            fields = len(variables) * len(days) * len(self.times)
+            if (group and group["year"] == year and group["days"] == days
+                    and group["months"][-1] == month - 1
+                    and len(group["months"]) < self.max_months
+                    and group["fields"] + fields <= self.max_fields):
+                group["months"].append(month)
+                group["fields"] += fields
+                continue
+            if group:
+                chunks.append(self._make_chunk(group["year"], group["months"], group["days"], variables))
+            group = {"year": year, "months": [month], "days": days, "fields": fields}
+        if group:
+            chunks.append(self._make_chunk(group["year"], group["months"], group["days"], variables))
+
+        return chunks
+
+    def execute(self, chunks, lookup, retrieve):
+        '''Resolve every chunk from the cache (``lookup``) or the CDS (``retrieve``).
+
+        Both callables take the chunk and return a data path (lookup returns a
+        falsy value on a miss). Chunks are tracked one by one, a failure leaves the
+        finished ones cached for the next run.
+        '''
+        for idx, chunk in enumerate(chunks):
+            print(f"[i] Chunk {idx+1}/{len(chunks)}: {chunk['start_date']} to {chunk['end_date']}")
+            data_path = lookup(chunk)
+            if data_path:
+                chunk["status"] = "cached"
+            else:
+                chunk["status"] = "downloading"
+                data_path = retrieve(chunk)
+                chunk["status"] = "downloaded"
+            chunk["data_path"] = data_path
+
+        return chunks
+
+    def chunk_request(self, chunk, area_bounds, data_format="grib"):
+        return {
+            "product_type": ["reanalysis"],
+            "variable": chunk["variable"],
+            "year": chunk["year"],
+            "month": chunk["month"],
+            "day": chunk["day"],
+            "time": chunk["time"],
+            "data_format": data_format,
+            "download_format": "unarchived",
+            'area': [ area_bounds["north"], area_bounds["west"],
+                     area_bounds["south"], area_bounds["east"] ],
+        }
+
+
+def merge_chunks(paths, target):
+    '''Merge the finished chunk files into one file, in the given order.
+
+    GRIB files are a plain sequence of messages so they are concatenated as is,
+    anything else is combined along valid_time and written as NetCDF.
+    '''
+    is_grib = all(os.path.splitext(p)[1].lower() in (".grib", ".grb") for p in paths)
+    if not (is_grib and os.path.splitext(target)[1].lower() in (".grib", ".grb")):
+        target = os.path.splitext(target)[0] + ".nc"
+    # Written next to the target and renamed, a crash never leaves half a file
+    part_path = target + ".part"
+
+    if is_grib and target.endswith((".grib", ".grb")):
+        with open(part_path, "wb") as dst:
+            for path in paths:
+                with open(path, "rb") as src:
+                    shutil.copyfileobj(src, dst, 16*1024*1024)
+    else:
+        datasets = [open_era5_dataset(p) for p in paths]
+        merged = xr.concat(datasets, dim="valid_time", join="outer")
+        merged.to_netcdf(part_path, format="NETCDF4")
+    os.replace(part_path, target)
+
+    return target
+
+
+def retrieve_chunk(client, planner, catalog, temp_dir, area_bounds, chunk):
+    '''Download one planned chunk into ``temp_dir`` and add it to ``catalog``.
+
+    The file is downloaded to a partial file first, only a verified file
+    reaches the cache. Returns the cached file path.
+    '''
+    nowdate = datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S")
+
+    variable = chunk["variable"]
+    temp_filename = os.path.join(temp_dir, f"{nowdate}_{chunk['key']}_{'-'.join(variable)}.grib")
+    temp_metafilename = os.path.join(temp_dir, f"{nowdate}_{chunk['key']}_{'-'.join(variable)}_meta.json")
+
+    print("=========================================================")
+    print("Downloading {start_date} to {end_date} ({fields} fields)".format(
+        start_date=chunk["start_date"], end_date=chunk["end_date"], fields=chunk["fields"]))
+    print("Variables: {var}".format(var=variable))
+
+    request = planner.chunk_request(chunk, area_bounds)
+    with stage("download", chunk=chunk["key"]):
+        part_filename, info = retrieve_verified(
+            client, ERA5_DATASET, request, temp_filename, expected_messages=chunk["fields"])
+    incr("downloaded_bytes", info["size"])
+
+    doc = {
+        "area_bounds": area_bounds,
+        "data_path": temp_filename,
+        "variables": variable,
+        "start_date": chunk["start_date"],
+        "end_date": chunk["end_date"],
+        "size": info["size"],
+        "checksum": info["checksum"],
+    }
+    catalog.commit_download(part_filename, temp_filename, doc, temp_metafilename, checksum=info["checksum"])
+
+    return temp_filename
+
+
+def retrieve_range(planner, catalog, temp_dir, area_bounds, start, end, variables, lookup, retrieve):
+    '''Resolve a date range chunk by chunk and return a single file of it.
+
+    ``lookup`` and ``retrieve`` are the callables of ``RequestPlanner.execute``.
+    Several chunks are merged into one file, added to ``catalog`` with the
+    chunk files it was built from.
+    '''
+    chunks = planner.plan(start, end, variables)
+    planner.execute(chunks, lookup=lookup, retrieve=retrieve)
+
+    if len(chunks) == 1:
+        return chunks[0]["data_path"]
+
+    nowdate = datetime.strftime(datetime.now(), "%Y%m%d_%H%M%S")
+    label = f"{chunks[0]['key'].split('_')[0]}_{chunks[-1]['key'].split('_')[1]}"
+    temp_filename = os.path.join(temp_dir, f"{nowdate}_{label}_{'-'.join(variables)}.grib")
+    temp_filename = merge_chunks([chunk["data_path"] for chunk in chunks], temp_filename)
+    temp_metafilename = os.path.splitext(temp_filename)[0] + "_meta.json"
+
+    doc = {
+        "area_bounds": area_bounds,
+        "data_path": temp_filename,
+        "variables": list(variables),
+        "start_date": chunks[0]["start_date"],
+        "end_date": chunks[-1]["end_date"],
+        "chunks": [chunk["data_path"] for chunk in chunks],
+    }
+    # Renamed into place, sync() never indexes half a meta file
+    with open(temp_metafilename + ".tmp", "w") as f:
+        json.dump(doc, f)
+    os.replace(temp_metafilename + ".tmp", temp_metafilename)
+    catalog.add(doc, meta_path=temp_metafilename)
+
+    return temp_filename
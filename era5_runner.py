@@ -2,57 +2,104 @@ from era5_reanalysis_v3 import Reanalysis
 from raster_boundaries import RasterBoundaries
 from era5_grib_extractor import ERA5GribExtractor
 
-from notification import Notification
+from era5_scheduler import DownloadScheduler
+from era5_pipeline import ExtractionPipeline
+from era5_metrics import METRICS_FORMATS, configure, stage
+
+from notification import NotificationDispatcher, duration_formatter
 from datetime import datetime
+import os
 
 if __name__ == "__main__":
 
-    bot = Notification()
+    # Sent from a background thread, Telegram round-trips never hold up the downloads
+    notifier = NotificationDispatcher()
 
-    import argparse, time
+    import argparse
     parser = argparse.ArgumentParser(description="ERA5 Reanalysis data retrieval")
     parser.add_argument('-rp', '--raster-path', dest="raster_path", type=str, required=True) # raster image
     parser.add_argument('-sy', '--start-year', dest="start_year", type=int, default=2016)
     parser.add_argument('-ey', '--end-year', dest="end_year", type=int, default=2025)
     # parser.add_argument('-y', '--year', dest="year", type=int, default=2015)
+    parser.add_argument('-n', '--max-in-flight', dest="max_in_flight", type=int, default=3)
+    parser.add_argument('-t', '--timeout', dest="timeout", type=int, default=None, help="seconds per year")
+    parser.add_argument('-x', '--extract-workers', dest="extract_workers", type=int, default=1,
+                        help="processes extracting the downloaded years, 0 only downloads")
+    parser.add_argument('-qs', '--queue-size', dest="queue_size", type=int, default=2,
+                        help="downloaded years waiting for extraction before the downloads pause")
+    parser.add_argument('-o', '--output-dir', dest="output_dir", type=str, default="temp_results")
+    parser.add_argument('-mb', '--memory-budget-mb', dest="memory_budget_mb", type=int, default=None)
+    parser.add_argument('--metrics', dest="metrics_path", type=str, default=None,
+                        help="stage metrics output, e.g. era5_metrics.jsonl or era5.prom")
+    parser.add_argument('--metrics-format', dest="metrics_format", type=str, default="jsonl", choices=METRICS_FORMATS)
+    parser.add_argument('--profile-stage', dest="profile_stage", type=str, default=None,
+                        help="run one stage (e.g. download, grib_decode) under cProfile")
     args = parser.parse_args()
+    metrics = configure(path=args.metrics_path, fmt=args.metrics_format, profile_stage=args.profile_stage)
 
-    rbound = RasterBoundaries()
-    _, rb_filepath = rbound.raster_grid_split(
-        source=args.raster_path)
+    # The bounds only need the raster header, the pixels are never read. Only
+    # the full extent is downloaded, the grid of raster_grid_split is not built
+    rbound = RasterBoundaries(bounds_mode="header")
+    with stage("raster_bounds"):
+        _, rb_filepath = rbound.full_boundaries(source=args.raster_path)
     print(rb_filepath)
 
     # To get 4-axis boundaries from raster image, please refer to raster_boundaries.py
     # it produces a geojson files that can be inputted to below process
 
-    years = [year for year in range(args.start_year, args.end_year+1)]
-    for year in years:
-        datenow = datetime.now()
-        bot.send_telegram_message(f"ERA5 Reanalysis Start downloading: {str(datetime.strftime(datenow, "%Y-%m-%d %H:%M:%S"))}")
-
-        reanalysis = Reanalysis()
-        gribfile = reanalysis.process(
-            shape_files=rb_filepath, 
-            # year=[y for y in range(int(args.start_year), int(args.end_year)+1)], 
-            year=year
-        )
+    # Years are retrieved concurrently, CDS queues several requests per user
+    reanalysis = Reanalysis()
+    started = {}
+
+    def _download(job):
+        started[job["id"]] = datetime.now()
+        notifier.notify(f"ERA5 Reanalysis Start downloading {job['id']}: {str(datetime.strftime(started[job['id']], "%Y-%m-%d %H:%M:%S"))}")
+        return reanalysis.process(**job["params"])
+
+    def _notify(job):
+        datenow = started.get(job["id"], datetime.now())
         datelater = datetime.now()
         diff = datelater - datenow
-        bot.send_telegram_message(f"""
+        notifier.notify(f"""
         ERA5 Reanalysis 
         ========================================
-        Data downloaded successfully:
-        {str(gribfile)}
+        Data {job['id']} {"downloaded successfully" if job["status"] == "done" else job["status"]}:
+        {str(job["result"] or job["error"])}
 
         Timestamp:
         - start: {str(datetime.strftime(datenow, "%Y-%m-%d %H:%M:%S"))}
         - end: {str(datetime.strftime(datelater, "%Y-%m-%d %H:%M:%S"))}
-        - total duration: {str(bot.duration_formatter(int(diff.total_seconds())))}
+        - total duration: {str(duration_formatter(int(diff.total_seconds())))}
         """)
 
-        time.sleep(3600*2)
+    scheduler = DownloadScheduler(
+        task=_download, max_in_flight=args.max_in_flight, timeout=args.timeout,
+        queue_path=os.path.join(reanalysis.temp_dir, f"queue_{os.path.splitext(os.path.basename(args.raster_path))[0]}.json"),
+        on_done=_notify)
+    years = [year for year in range(args.start_year, args.end_year+1)]
+    for year in years:
+        scheduler.submit(f"{year}", shape_files=rb_filepath, year=year)
 
+    def _notify_extracted(job):
+        notifier.notify(f"ERA5 Reanalysis {job['id']} extraction {job['extract_status']}"
+                        + (f": {job['extract_error']}" if job.get("extract_error") else ""))
 
+    if args.extract_workers > 0:
+        # Years are extracted while the next ones download
+        extractor = ERA5GribExtractor(output_dir=args.output_dir, memory_budget_mb=args.memory_budget_mb)
+        pipeline = ExtractionPipeline(scheduler, extractor, extract_workers=args.extract_workers,
+                                      queue_size=args.queue_size, on_extracted=_notify_extracted)
+        pipeline.run()
+    else:
+        scheduler.run()
 
-    # extractor = ERA5GribExtractor()
-    # extractor.process(filename=gribfile)
\ No newline at end of file
+    metrics.flush()
+    summary = metrics.summary()
+    report = "\n".join(
+        f"- {name}: {totals['count']}x, wall {duration_formatter(int(totals['wall_s']))}, cpu {int(totals['cpu_s'])} s, "
+        f"peak {totals['peak_rss_mb']} MB"
+        for name, totals in sorted(summary["stages"].items(), key=lambda item: -item[1]["wall_s"]))
+    counters = ", ".join(f"{name}={value}" for name, value in sorted(summary["counters"].items()))
+    print(f"[i] Stages\n{report}\n[i] Counters: {counters}")
+    notifier.notify(f"ERA5 Reanalysis stages\n{report}\n{counters}")
+    notifier.close()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from datetime import datetime
+
+
+class DownloadScheduler:
+    '''Run several Reanalysis retrievals at once with a bounded number in flight.
+
+    Jobs are kept in a JSON queue file, so a scheduler restarted with the same
+    ``queue_path`` only runs the jobs that did not finish. ``task(job)`` does the
+    retrieval and returns its result (usually the GRIB path).
+
+    ``on_done(job)`` is called on the scheduler loop when a job ends, it must
+    not block. While ``hold()`` returns True no new job is started, the
+    running ones go on (backpressure from a slower consumer of the results).
+    '''
+
+    def __init__(self, task, max_in_flight=3, timeout=None, queue_path=None, on_done=None, hold=None):
+        self.task = task
+        self.max_in_flight = max_in_flight
+        # seconds a single job may run before it is reported as timed out
+        self.timeout = timeout
+        self.queue_path = queue_path
+        self.on_done = on_done
+        self.hold = hold
+        self.jobs = []
+        self._started = {}
+        self._lock = threading.RLock()
+
+        if self.queue_path and os.path.exists(self.queue_path):
+            with open(self.queue_path) as f:
+                self.jobs = json.load(f)
+            # Jobs running when the previous run stopped are started again
+            for job in self.jobs:
+                if job["status"] in ("running", "timeout"):
+                    job["status"] = "pending"
+
+    def update(self, job, **fields):
+        '''Set fields of a job and save the queue file, e.g. the status of a
+        later processing step. Safe to call from any thread.'''
+        with self._lock:
+            job.update(fields)
+            self._save()
+
+    def _save(self):
+        if not self.queue_path:
+            return
+        with self._lock:
+            if os.path.dirname(self.queue_path) and not os.path.exists(os.path.dirname(self.queue_path)):
+                os.makedirs(os.path.dirname(self.queue_path))
+            tmp_path = self.queue_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.jobs, f, indent=4)
+            os.replace(tmp_path, self.queue_path)
+
+    def submit(self, job_id, **params):
+        '''Queue a job, a job id already in the queue is kept as it is'''
+        if any(job["id"] == job_id for job in self.jobs):
+            return
+        with self._lock:
+            self.jobs.append({"id": job_id, "params": params, "status": "pending", "result": None, "error": None})
+            self._save()
+
+    def _run_job(self, job):
+        self._started[job["id"]] = time.monotonic()
+        self.update(job, status="running", started_at=datetime.now().isoformat(timespec="seconds"))
+        return self.task(job)
+
+    def _start(self, job):
+        # A daemon thread per job instead of a pool: a timed out job keeps its
+        # thread but not a slot, and nothing waits for it on exit
+        future = Future()
+
+        def target():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self._run_job(job))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, name=f"job-{job['id']}", daemon=True).start()
+        return future
+
+    def _finish(self, job, status, result=None, error=None):
+        self.update(job, status=status, result=result, error=error,
+                     finished_at=datetime.now().isoformat(timespec="seconds"))
+        print(f"[i] Job {job['id']}: {status}" + (f" ({error})" if error else ""))
+        if self.on_done:
+            try:
+                self.on_done(job)
+            except Exception as e:
+                print(f"[E] Job callback failed for {job['id']}: {e}")
+
+    def run(self):
+        pending = [job for job in self.jobs if job["status"] in ("pending", "failed")]
+        print(f"[i] Scheduling {len(pending)} jobs, {self.max_in_flight} in flight")
+
+        running = {}
+        while pending or running:
+            while pending and len(running) < self.max_in_flight and not (self.hold and self.hold()):
+                job = pending.pop(0)
+                running[self._start(job)] = job
+
+            if not running:
+                # Held back with nothing in flight, check again shortly
+                time.sleep(0.5)
+                continue
+            done, _ = wait(list(running), timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    self._finish(job, "done", result=future.result())
+                except Exception as e:
+                    self._finish(job, "failed", error=str(e))
+
+            if self.timeout:
+                now = time.monotonic()
+                for future, job in list(running.items()):
+                    started = self._started.get(job["id"])
+                    if started is not None and now - started > self.timeout:
+                        # Threads can not be killed, the slot is given back and
+                        # the late result is ignored
+                        running.pop(future)
+                        self._finish(job, "timeout", error=f"exceeded {self.timeout} s")
+
+        return self.jobs
+
+
+if __name__ == "__main__":
+    import argparse
+    from era5_reanalysis_v3 import Reanalysis
+    from era5_local_client import LocalClient
+
+    parser = argparse.ArgumentParser(description="ERA5 concurrent download scheduler")
+    parser.add_argument('-sf', '--shape-files', dest="shape_files", type=str, required=True)
+    parser.add_argument('-sy', '--start-year', dest="start_year", type=int, default=2016)
+    parser.add_argument('-ey', '--end-year', dest="end_year", type=int, default=2025)
+    parser.add_argument('-n', '--max-in-flight', dest="max_in_flight", type=int, default=3)
+    parser.add_argument('-t', '--timeout', dest="timeout", type=int, default=None)
+    parser.add_argument('-q', '--queue', dest="queue_path", type=str, default=os.path.join("era5_cache", "queue.json"))
+    parser.add_argument('--offline', dest="offline", action="store_true", help="use the local stand-in client")
+    args = parser.parse_args()
+
+    reanalysis = Reanalysis(client=LocalClient(delay=1) if args.offline else None)
+    scheduler = DownloadScheduler(
+        task=lambda job: reanalysis.process(**job["params"]),
+        max_in_flight=args.max_in_flight, timeout=args.timeout, queue_path=args.queue_path)
+    for year in range(args.start_year, args.end_year+1):
+        scheduler.submit(f"{year}", shape_files=args.shape_files, year=year)
+    scheduler.run()
@@ -0,0 +1,283 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import eccodes
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xr
+from rasterio.transform import from_origin
+
+from era5_cache_catalog import CacheCatalog
+from era5_grib_reader import short_names
+from era5_metadata_store import METADATA_STORE_NAME, MetadataStore
+
+DEFAULT_VARIABLES = ("2m_temperature", "total_precipitation", "2m_dewpoint_temperature")
+# indicatorOfParameter in the ECMWF GRIB1 table 128
+GRIB_PARAMETERS = {"t2m": 167, "d2m": 168, "tp": 228}
+ACCUMULATED = ("tp",)
+
+# Fixture sizes of the benchmark suite, "large" is about one real ERA5 year
+# over a prefecture and a 10 m Sentinel-2 band
+SIZES = {
+    "small": {"days": 31, "area_bounds": {"north": 40.0, "west": 20.0, "south": 39.0, "east": 21.5},
+              "raster": 1098, "cache_entries": 100, "metadata_days": 365},
+    "medium": {"days": 92, "area_bounds": {"north": 41.0, "west": 20.0, "south": 38.0, "east": 23.0},
+               "raster": 5490, "cache_entries": 1000, "metadata_days": 3650},
+    "large": {"days": 365, "area_bounds": {"north": 42.0, "west": 19.0, "south": 35.0, "east": 28.0},
+              "raster": 10980, "cache_entries": 10000, "metadata_days": 3650},
+}
+
+
+def era5_grid(area_bounds, res=0.25):
+    '''Latitudes (north to south) and longitudes of the ERA5 cells in a bbox'''
+    north = np.floor(area_bounds["north"] / res) * res
+    south = np.ceil(area_bounds["south"] / res) * res
+    west = np.ceil(area_bounds["west"] / res) * res
+    east = np.floor(area_bounds["east"] / res) * res
+    lat = np.round(np.arange(north, south - res/2, -res), 6)
+    lon = np.round(np.arange(west, east + res/2, res), 6)
+    return lat, lon
+
+
+def synthetic_field(var, valid_time, lat, lon, seed=0):
+    '''Deterministic ERA5-like values of one variable at one hour.
+
+    A seasonal and daily cycle plus noise, seeded by (seed, variable, hour) so
+    a field does not depend on what else is generated.
+    '''
+    valid_time = pd.Timestamp(valid_time)
+    hour_index = int(valid_time.value // 3_600_000_000_000)
+    rng = np.random.default_rng([seed, GRIB_PARAMETERS[var], hour_index])
+    lat2d = np.broadcast_to(np.asarray(lat)[:, None], (len(lat), len(lon)))
+    season = np.cos(2 * np.pi * (valid_time.dayofyear - 200) / 365.25)
+    day = np.cos(2 * np.pi * (valid_time.hour - 14) / 24)
+
+    t2m = 288.0 - 0.6 * (lat2d - 35.0) + 10.0 * season + 4.0 * day
+    if var == "t2m":
+        return t2m + rng.normal(0.0, 0.5, lat2d.shape)
+    if var == "d2m":
+        return t2m - 2.0 - 4.0 * rng.random(lat2d.shape)
+    # tp: metres per hour, dry most of the time
+    raining = rng.random(lat2d.shape) < 0.15
+    return np.where(raining, rng.exponential(5e-4, lat2d.shape), 0.0)
+
+
+def _grib_handle(lat, lon, res):
+    h = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib1")
+    eccodes.codes_set(h, "Ni", len(lon))
+    eccodes.codes_set(h, "Nj", len(lat))
+    eccodes.codes_set(h, "latitudeOfFirstGridPointInDegrees", float(lat[0]))
+    eccodes.codes_set(h, "latitudeOfLastGridPointInDegrees", float(lat[-1]))
+    eccodes.codes_set(h, "longitudeOfFirstGridPointInDegrees", float(lon[0]))
+    eccodes.codes_set(h, "longitudeOfLastGridPointInDegrees", float(lon[-1]))
+    eccodes.codes_set(h, "iDirectionIncrementInDegrees", res)
+    eccodes.codes_set(h, "jDirectionIncrementInDegrees", res)
+    eccodes.codes_set(h, "centre", "ecmf")
+    eccodes.codes_set(h, "table2Version", 128)
+    return h
+
+
+def _write_message(f, template, var, data_date, values, step=None):
+    h = eccodes.codes_clone(template)
+    try:
+        eccodes.codes_set(h, "indicatorOfParameter", GRIB_PARAMETERS[var])
+        eccodes.codes_set(h, "dataDate", int(data_date.strftime("%Y%m%d")))
+        eccodes.codes_set(h, "dataTime", data_date.hour * 100)
+        if step is not None:
+            eccodes.codes_set(h, "stepType", "accum")
+            eccodes.codes_set(h, "startStep", step - 1)
+            eccodes.codes_set(h, "endStep", step)
+        eccodes.codes_set_values(h, np.asarray(values, dtype="float64").ravel())
+        eccodes.codes_write(h, f)
+    finally:
+        eccodes.codes_release(h)
+
+
+def write_grib(path, start="2015-01-01", days=31, area_bounds=None, variables=DEFAULT_VARIABLES, res=0.25, seed=0):
+    '''Write an hourly ERA5-like GRIB file laid out like a CDS download.
+
+    Instantaneous fields get a message per hour, tp comes as 1 hour
+    accumulations from the 06/18 UTC base times, as in ERA5.
+    '''
+    area_bounds = area_bounds or SIZES["small"]["area_bounds"]
+    lat, lon = era5_grid(area_bounds, res)
+    names = short_names(variables)
+    start = datetime.strptime(str(start)[:10], "%Y-%m-%d")
+    end = start + timedelta(days=days)
+
+    template = _grib_handle(lat, lon, res)
+    try:
+        with open(path, "wb") as f:
+            for hour in range(days * 24):
+                valid_time = start + timedelta(hours=hour)
+                for var in names:
+                    if var not in ACCUMULATED:
+                        _write_message(f, template, var, valid_time, synthetic_field(var, valid_time, lat, lon, seed))
+
+            base_time = start - timedelta(hours=6)
+            while base_time < end:
+                for step in range(1, 13):
+                    valid_time = base_time + timedelta(hours=step)
+                    if valid_time < start or valid_time >= end:
+                        continue
+                    for var in names:
+                        if var in ACCUMULATED:
+                            _write_message(f, template, var, base_time,
+                                           synthetic_field(var, valid_time, lat, lon, seed), step=step)
+                base_time += timedelta(hours=12)
+    finally:
+        eccodes.codes_release(template)
+
+    return path
+
+
+def write_netcdf(path, start="2015-01-01", days=31, area_bounds=None, variables=DEFAULT_VARIABLES, res=0.25, seed=0):
+    '''Write the same values as ``write_grib`` as a CDS style NetCDF file (valid_time, latitude, longitude)'''
+    area_bounds = area_bounds or SIZES["small"]["area_bounds"]
+    lat, lon = era5_grid(area_bounds, res)
+    valid_time = pd.date_range(str(start)[:10], periods=days * 24, freq="h")
+    data = {}
+    for var in short_names(variables):
+        values = np.stack([synthetic_field(var, t, lat, lon, seed) for t in valid_time]).astype("float32")
+        data[var] = (("valid_time", "latitude", "longitude"), values)
+
+    ds = xr.Dataset(data, coords={"valid_time": valid_time, "latitude": lat, "longitude": lon})
+    ds.to_netcdf(path, encoding={var: {"zlib": True, "complevel": 1} for var in data})
+    return path
+
+
+def write_sentinel_raster(path, size=1098, pixel_size=None, crs="EPSG:32654", origin=(600000.0, 4000020.0), seed=0):
+    '''Write a Sentinel-2 like single band tile: uint16 reflectances on a UTM grid.
+
+    The tile covers 109.8 km like a real one, ``size`` sets the pixel count
+    (10980 is a 10 m band, 1830 a 60 m one).
+    '''
+    pixel_size = pixel_size or 109800.0 / size
+    rng = np.random.default_rng(seed)
+    profile = {"driver": "GTiff", "width": size, "height": size, "count": 1, "dtype": "uint16", "crs": crs,
+               "transform": from_origin(origin[0], origin[1], pixel_size, pixel_size),
+               "compress": "deflate", "tiled": True, "nodata": 0}
+    with rasterio.open(path, "w", **profile) as dst:
+        # Written by blocks, a 10 m band does not have to fit in memory
+        for _, window in dst.block_windows(1):
+            dst.write(rng.integers(500, 5000, (window.height, window.width), dtype="uint16"), 1, window=window)
+
+    return path
+
+
+def populate_cache(cache_dir, n_entries=100, area_bounds=None, year=2015, variables=DEFAULT_VARIABLES,
+                   data_bytes=1024, seed=0):
+    '''Fill a Reanalysis cache directory with ``n_entries`` downloads and their meta files.
+
+    Every entry is a random bbox inside ``area_bounds`` over a random month of
+    ``year``. The data files are ``data_bytes`` of padding, enough for the
+    catalog and the lookups, not for decoding. Returns the meta documents.
+    '''
+    area_bounds = area_bounds or SIZES["small"]["area_bounds"]
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    docs = []
+    for i in range(n_entries):
+        lat = np.sort(rng.uniform(area_bounds["south"], area_bounds["north"], 2))
+        lon = np.sort(rng.uniform(area_bounds["west"], area_bounds["east"], 2))
+        month = int(rng.integers(1, 13))
+        first = datetime(year, month, 1)
+        last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        name = f"synthetic_{i:06d}_{first.strftime('%Y%m%d')}_{'-'.join(variables)}"
+        data_path = os.path.join(cache_dir, f"{name}.grib")
+        with open(data_path, "wb") as f:
+            f.write(rng.bytes(data_bytes))
+
+        doc = {
+            "area_bounds": {"north": float(lat[1]), "west": float(lon[0]), "south": float(lat[0]), "east": float(lon[1])},
+            "data_path": data_path,
+            "variables": list(variables),
+            "start_date": f"{first.strftime('%Y-%m-%d')}__00:00",
+            "end_date": f"{last.strftime('%Y-%m-%d')}__23:00",
+        }
+        with open(os.path.join(cache_dir, f"{name}_meta.json"), "w") as f:
+            json.dump(doc, f)
+        docs.append(doc)
+
+    # Indexed here, the first open of a catalog reads every meta file
+    CacheCatalog(cache_dir).sync()
+    return docs
+
+
+def populate_metadata(dirpath, days=365, start="2015-01-01", factors=("t2m", "tp", "d2m"), json_files=False, seed=0):
+    '''Write the extractor metadata of ``days`` daily rasters per factor, to the
+    metadata store or as the former per-raster JSON files'''
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    wkt = "POLYGON ((20.0 40.0, 20.0 39.0, 21.5 39.0, 21.5 40.0, 20.0 40.0))"
+
+    docs = []
+    for day in pd.date_range(start, periods=days, freq="D"):
+        for factor in factors:
+            values = np.sort(rng.normal(15.0, 5.0, 4))
+            docs.append({
+                "path": f"{factor}_{day.strftime('%Y%m%d')}.TIF",
+                "metadata": {"DATE_ACQUIRED": day.strftime("%Y-%m-%d"), "SPACECRAFT_ID": "ERA5",
+                             "WKT_COORDS": wkt, "FACTORS": factor},
+                "stat_value": {"max": float(values[3]), "min": float(values[0]),
+                               "mean": float(values[1:3].mean()), "med": float(values[1:3].mean())},
+            })
+
+    if not json_files:
+        MetadataStore(os.path.join(dirpath, METADATA_STORE_NAME)).append(docs)
+        return docs
+
+    for doc in docs:
+        with open(os.path.join(dirpath, "metadata_" + doc["path"].replace("TIF", "json")), "w") as f:
+            json.dump(doc, f, indent=4)
+    return docs
+
+
+def grib_source(seed=0):
+    '''``source`` for era5_local_client.LocalClient answering a CDS request with a synthetic GRIB file'''
+    def _source(request, target):
+        north, west, south, east = request.get("area") or [40.0, 20.0, 39.0, 21.5]
+        dates = sorted(datetime(int(y), int(m), int(d)) for y in np.atleast_1d(request["year"])
+                       for m in np.atleast_1d(request["month"]) for d in np.atleast_1d(request["day"]))
+        write_grib(target, start=dates[0].strftime("%Y-%m-%d"), days=(dates[-1] - dates[0]).days + 1, seed=seed,
+                   variables=request.get("variable", DEFAULT_VARIABLES),
+                   area_bounds={"north": north, "west": west, "south": south, "east": east})
+    return _source
+
+
+def make_fixtures(dirpath, size="small", seed=0):
+    '''Every fixture of the benchmark suite for one of the SIZES, under ``dirpath``'''
+    spec = SIZES[size]
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    fixtures = {
+        "grib": write_grib(os.path.join(dirpath, "era5.grib"), days=spec["days"],
+                           area_bounds=spec["area_bounds"], seed=seed),
+        "raster": write_sentinel_raster(os.path.join(dirpath, "T54SWJ_B01.TIF"), size=spec["raster"], seed=seed),
+        "cache_dir": os.path.join(dirpath, "era5_cache"),
+        "metadata_dir": os.path.join(dirpath, "metadata"),
+    }
+    fixtures["cache_docs"] = populate_cache(fixtures["cache_dir"], n_entries=spec["cache_entries"],
+                                            area_bounds=spec["area_bounds"], seed=seed)
+    populate_metadata(fixtures["metadata_dir"], days=spec["metadata_days"], seed=seed)
+
+    return fixtures
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Synthetic ERA5 fixtures")
+    parser.add_argument('-o', '--output-dir', dest="output_dir", type=str, default="synthetic")
+    parser.add_argument('-s', '--size', dest="size", type=str, default="small", choices=list(SIZES))
+    parser.add_argument('--seed', dest="seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fixtures = make_fixtures(args.output_dir, size=args.size, seed=args.seed)
+    for name, value in fixtures.items():
+        if isinstance(value, str):
+            print(f"[i] {name}: {value}")
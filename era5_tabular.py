@@ -1,34 +1,167 @@
 from pandas import json_normalize
+import pandas as pd
 import json
 import os
 
-def process(dirpath):
+from era5_metadata_store import METADATA_STORE_NAME, MetadataStore
+from era5_metrics import timed
+
+DATE_COLUMN = "metadata.DATE_ACQUIRED"
+INCREMENTAL_FILENAME = "era5_tabular.csv"
 
-    listdir = os.listdir(dirpath)
-    
+def _read_json_files(dirpath, names=None):
+    # Per-raster JSON files, written by older runs or with json_metadata=True
     docs = []
-    for md in listdir:
+    for md in names if names is not None else os.listdir(dirpath):
+        if not md.endswith(".json"):
+            continue
         metadata_json_path = os.path.join(dirpath, md)
 
         with open(metadata_json_path) as f:
             metadata_json = json.load(f)
             docs.append(metadata_json)
 
-    df = json_normalize(docs)
-    df["type"] = df.apply(lambda x: x["path"].split("_")[0], axis=1)
-    df = df.sort_values(by=["metadata.DATE_ACQUIRED"], ascending=True)
+    return json_normalize(docs)
+
+def _add_type(df):
+    df["type"] = df["path"].str.rsplit("_", n=1).str[0]
+    return df
+
+@timed("tabular", build="full")
+def process(dirpath):
+
+    store_path = os.path.join(dirpath, METADATA_STORE_NAME)
+    if os.path.exists(store_path):
+        df = MetadataStore(store_path).to_dataframe()
+    else:
+        df = _read_json_files(dirpath)
+
+    df = _add_type(df)
+    df = df.sort_values(by=[DATE_COLUMN], ascending=True, kind="stable")
     df = df.reset_index(drop=True)
 
     result_path = os.path.join("dataset")
     if not os.path.exists(result_path):
         os.makedirs(result_path)
-    file_path = os.path.join(result_path, 
-                f"era5_{df.loc[0, "metadata.DATE_ACQUIRED"]}_{df.loc[len(df)-1, "metadata.DATE_ACQUIRED"]}_tabular.csv")
+    first_date, last_date = df.loc[0, DATE_COLUMN], df.loc[len(df)-1, DATE_COLUMN]
+    file_path = os.path.join(result_path, f"era5_{first_date}_{last_date}_tabular.csv")
     df.to_csv(file_path, sep=";")
 
     return True
 
+def _load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def _save_state(state, state_path):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, state_path)
+
+def _new_rows(dirpath, state):
+    '''Metadata written since the watermark in ``state`` and the next watermark.
+
+    With JSON files of which some were removed, all the metadata is returned
+    and ``rebuild`` set in the watermark. For the store the watermark holds
+    the row count, to compare with the rows of the output.
+    '''
+    store_path = os.path.join(dirpath, METADATA_STORE_NAME)
+    if os.path.exists(store_path):
+        store = MetadataStore(store_path)
+        # Taken before reading, rows added meanwhile are picked up next run
+        seq = store.max_seq()
+        df = store.to_dataframe(after_seq=state.get("seq", 0), until_seq=seq)
+        return df, {"seq": seq, "count": store.count(until_seq=seq)}
+
+    # JSON files: new or rewritten files are found by their modification time
+    seen = state.get("mtimes", {})
+    mtimes = {}
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json"):
+                mtimes[entry.name] = entry.stat().st_mtime_ns
+    if any(name not in mtimes for name in seen):
+        # The rows of a removed file are not known any more
+        return _read_json_files(dirpath, list(mtimes)), {"mtimes": mtimes, "rebuild": True}
+    changed = [name for name, mtime in mtimes.items() if seen.get(name) != mtime]
+    return _read_json_files(dirpath, changed), {"mtimes": mtimes}
+
+def _store_rows(dirpath, seq):
+    df = MetadataStore(os.path.join(dirpath, METADATA_STORE_NAME)).to_dataframe(until_seq=seq)
+    df = _add_type(df)
+    return df.sort_values(by=[DATE_COLUMN], ascending=True, kind="stable").reset_index(drop=True)
+
+@timed("tabular", build="incremental")
+def process_incremental(dirpath, result_path="dataset"):
+    '''Update ``dataset/era5_tabular.csv`` with the metadata added since the last run.
+
+    A watermark (the store sequence number, or the file mtimes for the JSON
+    metadata) is kept next to the output. Rows dated after the last row are
+    appended to the file, rows for earlier dates or rewritten rasters are
+    merged into it. When metadata was removed (a JSON file deleted, or fewer
+    rows in the store than in the output) the file is rebuilt from all of it.
+    '''
+    if not os.path.exists(result_path):
+        os.makedirs(result_path)
+    file_path = os.path.join(result_path, INCREMENTAL_FILENAME)
+    state_path = os.path.join(result_path, "era5_tabular_state.json")
+    state = _load_state(state_path) if os.path.exists(file_path) else {}
+
+    new, watermark = _new_rows(dirpath, state)
+    if watermark.pop("rebuild", False):
+        print(f"[i] Metadata files were removed, rebuilding {file_path}")
+        state = {}
+    # The store only grows or replaces rows, a different count means deleted rows
+    expected = watermark.get("count")
+    if new.empty and (not state or expected in (None, state["rows"])):
+        print("[i] No new metadata")
+        _save_state({**state, **watermark}, state_path)
+        return file_path
+
+    new = _add_type(new)
+    new = new.sort_values(by=[DATE_COLUMN], ascending=True, kind="stable").reset_index(drop=True)
+
+    if (state and not new.empty and list(new.columns) == state["columns"]
+            and new[DATE_COLUMN].min() > state["max_date"] and expected in (None, state["rows"] + len(new))):
+        # Later dates only, the sorted file just grows
+        new.index += state["rows"]
+        new.to_csv(file_path, sep=";", mode="a", header=False)
+        rows = state["rows"] + len(new)
+        print(f"[i] {len(new)} rows appended to {file_path}")
+    else:
+        df = new
+        if state:
+            old = pd.read_csv(file_path, sep=";", index_col=0)
+            # A rewritten raster replaces its former row
+            keys = ["path", "band"] if "band" in old.columns and "band" in new.columns else ["path"]
+            replaced = old.set_index(keys).index.isin(new.set_index(keys).index)
+            df = pd.concat([old[~replaced], new], ignore_index=True)
+            df = df.sort_values(by=[DATE_COLUMN], ascending=True, kind="stable").reset_index(drop=True)
+        if expected is not None and len(df) != expected:
+            print(f"[i] Rows were removed from the metadata store, rebuilding {file_path}")
+            df, state = _store_rows(dirpath, watermark["seq"]), {}
+        df.to_csv(file_path + ".tmp", sep=";")
+        os.replace(file_path + ".tmp", file_path)
+        new, rows = df, len(df)
+        print(f"[i] {file_path} rewritten with {rows} rows")
+
+    _save_state({**watermark, "columns": list(new.columns), "rows": rows,
+                 "max_date": max(str(new[DATE_COLUMN].max()), state.get("max_date", ""))}, state_path)
+
+    return file_path
+
 if __name__ == "__main__":
-    dirpath = "./temp_results/metadata"
-    process(dirpath=dirpath)
-    
+    import argparse
+    parser = argparse.ArgumentParser(description="ERA5 metadata to a tabular dataset")
+    parser.add_argument('-d', '--dirpath', dest="dirpath", type=str, default="./temp_results/metadata")
+    parser.add_argument('-i', '--incremental', dest="incremental", action="store_true",
+                        help="update dataset/era5_tabular.csv with the new metadata only")
+    args = parser.parse_args()
+
+    if args.incremental:
+        process_incremental(dirpath=args.dirpath)
+    else:
+        process(dirpath=args.dirpath)
@@ -0,0 +1,114 @@
+import numpy as np
+import xarray as xr
+
+KELVIN_OFFSET = 273.15
+
+
+def kelvin_to_celsius(kelvin):
+    return kelvin - KELVIN_OFFSET
+
+
+def saturation_vapour_pressure(celsius):
+    '''Saturation vapour pressure over water in hPa (Magnus, Alduchov & Eskridge 1996)'''
+    return 6.1094 * np.exp(17.625 * celsius / (celsius + 243.04))
+
+
+def relative_humidity(es, ea):
+    '''Relative humidity in %, from the saturation and actual vapour pressures'''
+    return np.clip(100.0 * ea / es, 0.0, 100.0)
+
+
+def vapour_pressure_deficit(es, ea):
+    '''Vapour pressure deficit in kPa, from vapour pressures in hPa'''
+    return np.maximum(es - ea, 0.0) / 10.0
+
+
+def metres_to_millimetres(metres):
+    return metres * 1000.0
+
+
+# name: (inputs, function, units). Inputs are ERA5 short names or other derived
+# variables, es/ea are only intermediates of rh and vpd
+DERIVED_VARIABLES = {
+    "t2m_c": (("t2m",), kelvin_to_celsius, "degC"),
+    "d2m_c": (("d2m",), kelvin_to_celsius, "degC"),
+    "es": (("t2m_c",), saturation_vapour_pressure, "hPa"),
+    "ea": (("d2m_c",), saturation_vapour_pressure, "hPa"),
+    "rh": (("es", "ea"), relative_humidity, "%"),
+    "vpd": (("es", "ea"), vapour_pressure_deficit, "kPa"),
+    "tp_mm": (("tp",), metres_to_millimetres, "mm"),
+}
+
+
+def derivation_order(names):
+    '''Derived variables needed for ``names``, each after its inputs'''
+    order, visiting = [], set()
+
+    def visit(name):
+        if name not in DERIVED_VARIABLES or name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Derived variable {name} depends on itself")
+        visiting.add(name)
+        for dependency in DERIVED_VARIABLES[name][0]:
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def source_variables(names):
+    '''ERA5 short names that have to be read to get ``names``'''
+    sources = [n for n in names if n not in DERIVED_VARIABLES]
+    for name in derivation_order(names):
+        sources.extend(n for n in DERIVED_VARIABLES[name][0] if n not in DERIVED_VARIABLES)
+    return list(dict.fromkeys(sources))
+
+
+class DerivedVariables:
+    '''Lazy, memoized view of source and derived variables.
+
+    ``source`` is anything indexable by short name (a Dataset or a dict of
+    arrays). A variable is computed the first time it is asked for, on the
+    float64 NumPy values, and kept, so es/ea are computed once for both rh and
+    vpd and nothing that is not asked for is computed at all.
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self._values = {}
+
+    def __contains__(self, name):
+        return all(n in self.source for n in source_variables([name]))
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            if name in DERIVED_VARIABLES:
+                inputs, func, _ = DERIVED_VARIABLES[name]
+                self._values[name] = func(*(self[n] for n in inputs))
+            else:
+                self._values[name] = np.asarray(self.source[name], dtype="float64")
+        return self._values[name]
+
+
+def derive_dataset(ds, names):
+    '''Dataset of ``names`` (short names or derived variables) on the grid of ``ds``.
+
+    Variables whose inputs are missing from ``ds`` are left out.
+    '''
+    derived = DerivedVariables(ds)
+    data = {}
+    for name in names:
+        if name not in derived:
+            continue
+        if name in DERIVED_VARIABLES:
+            template = ds[source_variables([name])[0]]
+            data[name] = xr.DataArray(derived[name], dims=template.dims, coords=template.coords,
+                                      attrs={"units": DERIVED_VARIABLES[name][2]})
+        else:
+            data[name] = ds[name]
+
+    return xr.Dataset(data)
@@ -0,0 +1,146 @@
+import hashlib
+import os
+
+import geopandas as gpd
+import numpy as np
+import scipy.sparse
+import shapely
+import xarray as xr
+
+from era5_grib_reader import iter_windows, open_era5_hypercubes
+
+
+def _resolution(coords):
+    return float(abs(coords[1] - coords[0])) if len(coords) > 1 else 0.25
+
+
+def grid_cells(lat, lon):
+    '''Cell polygons of a (lat, lon) grid of cell centers, flattened in C order'''
+    res_lat, res_lon = _resolution(lat), _resolution(lon)
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    return shapely.box(lon2d.ravel() - res_lon/2, lat2d.ravel() - res_lat/2,
+                       lon2d.ravel() + res_lon/2, lat2d.ravel() + res_lat/2)
+
+
+def coverage_weights(lat, lon, polygons):
+    '''Sparse (polygon, cell) matrix of covered cell share x cos(latitude).
+
+    Only the cells an STRtree finds near a polygon are intersected, the rest of
+    the matrix stays empty.
+    '''
+    cells = grid_cells(lat, lon)
+    tree = shapely.STRtree(cells)
+    poly_idx, cell_idx = tree.query(polygons, predicate="intersects")
+
+    covered = shapely.area(shapely.intersection(cells[cell_idx], polygons[poly_idx])) / shapely.area(cells[cell_idx])
+    cell_lat = np.repeat(np.asarray(lat, dtype="float64"), len(lon))[cell_idx]
+    weights = covered * np.cos(np.deg2rad(cell_lat))
+
+    keep = weights > 0
+    return scipy.sparse.csr_matrix(
+        (weights[keep], (poly_idx[keep], cell_idx[keep])), shape=(len(polygons), len(cells)))
+
+
+def weighted_mean(weights, flat):
+    '''Apply a sparse (target, cell) weight matrix to (time, cell) values.
+
+    NaN cells are left out and the weights renormalized over the valid ones,
+    a target without any valid cell gets NaN. Returns (time, target).
+    '''
+    flat = np.asarray(flat, dtype="float64").T
+    valid = ~np.isnan(flat)
+    total = weights @ np.where(valid, flat, 0.0)
+    norm = weights @ valid.astype("float64")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(norm > 0, total / norm, np.nan)
+
+    return means.T
+
+
+def weights_key(lat, lon, polygons):
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(lat, dtype="float64").tobytes())
+    sha.update(np.ascontiguousarray(lon, dtype="float64").tobytes())
+    for wkb in shapely.to_wkb(polygons):
+        sha.update(wkb)
+    return sha.hexdigest()
+
+
+class ZonalStats:
+    '''Area weighted means of gridded values over polygons.
+
+    The weights between the grid and the polygons are computed once, kept as a
+    sparse matrix and optionally cached in ``cache_dir`` by (grid, geometry
+    hash). Every timestep is then a row of one sparse matrix product.
+    '''
+
+    def __init__(self, lat, lon, polygons, cache_dir=None):
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.polygons = np.asarray(polygons)
+        self.weights = None
+
+        cache_path = None
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            cache_path = os.path.join(cache_dir, f"zonal_{weights_key(self.lat, self.lon, self.polygons)}.npz")
+            if os.path.exists(cache_path):
+                self.weights = scipy.sparse.load_npz(cache_path).tocsr()
+
+        if self.weights is None:
+            self.weights = coverage_weights(self.lat, self.lon, self.polygons)
+            if cache_path:
+                scipy.sparse.save_npz(cache_path, self.weights)
+
+    def mean(self, values):
+        '''(time, lat, lon) values to (time, polygon) weighted means'''
+        values = np.asarray(values, dtype="float64")
+        return weighted_mean(self.weights, values.reshape(-1, len(self.lat) * len(self.lon)))
+
+
+def read_polygons(path, id_column=None):
+    '''Polygons of a vector file (a zipped shapefile works too) in EPSG:4326'''
+    if path.endswith(".zip") and not path.startswith("zip://"):
+        path = f"zip://{path}"
+    gdf = gpd.read_file(path).to_crs("EPSG:4326")
+    ids = gdf[id_column].astype(str).values if id_column else np.array([str(i) for i in gdf.index])
+
+    return ids, gdf.geometry.values
+
+
+def zonal_dataset(filename, polygons, ids=None, variables=("t2m", "tp", "d2m"), window_days=31, cache_dir=None):
+    '''Hourly zonal means of an ERA5 file as a (valid_time, zone) Dataset.
+
+    The file is decoded ``window_days`` at a time, the weights are shared by
+    every window and variable.
+    '''
+    polygons = np.asarray(polygons)
+    ids = np.asarray(ids) if ids is not None else np.arange(len(polygons)).astype(str)
+    hypercubes = open_era5_hypercubes(filename, variables=variables, strict=False)
+    lat, lon = hypercubes[0]["latitude"].values, hypercubes[0]["longitude"].values
+    zonal = ZonalStats(lat, lon, polygons, cache_dir=cache_dir)
+
+    parts = []
+    for ds in iter_windows(hypercubes, variables, window_days=window_days):
+        parts.append(xr.Dataset(
+            {var: (("valid_time", "zone"), zonal.mean(ds[var].values)) for var in ds.data_vars},
+            coords={"valid_time": ds["valid_time"].values, "zone": ids}))
+
+    return xr.concat(parts, dim="valid_time")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="ERA5 time series per study area polygon")
+    parser.add_argument('-f', '--file', dest="filename", type=str, required=True)
+    parser.add_argument('-s', '--shapefile', dest="shapefile", type=str, required=True, help="e.g. area_study/Greece_Pol.zip")
+    parser.add_argument('-id', '--id-column', dest="id_column", type=str, default=None)
+    parser.add_argument('-o', '--output', dest="output", type=str, default="zonal_stats.csv")
+    parser.add_argument('-c', '--cache-dir', dest="cache_dir", type=str, default=os.path.join("era5_cache", "weights"))
+    args = parser.parse_args()
+
+    ids, polygons = read_polygons(args.shapefile, id_column=args.id_column)
+    ds = zonal_dataset(args.filename, polygons, ids=ids, cache_dir=args.cache_dir)
+    ds.to_dataframe().reset_index().to_csv(args.output, index=False)
+    print(f"[i] {ds.sizes['valid_time']} timesteps x {ds.sizes['zone']} zones written to {args.output}")
@@ -1,5 +1,8 @@
 from datetime import datetime
+from collections import deque
+import atexit
 import os
+import threading
 import telebot
 
 from datetime import datetime, timedelta
@@ -8,16 +11,19 @@ import time
 from dotenv import load_dotenv
 load_dotenv()
 
+def duration_formatter(total_seconds):
+    hours, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    return f"{hours} h {minutes} min {seconds} sec"
+
 class Notification:
     def __init__(self):
         # Create the bot instance
         self.bot = telebot.TeleBot(token=os.getenv('TELEGRAM_TOKEN'))
 
     def duration_formatter(self, total_seconds):
-        hours, remainder = divmod(total_seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-
-        return f"{hours} h {minutes} min {seconds} sec"
+        return duration_formatter(total_seconds)
 
     def send_telegram_message(self, message_text):
         '''Telegram send monitoring progress message'''    
@@ -25,4 +31,178 @@ class Notification:
             self.bot.send_message(os.getenv('TELEGRAM_CHAT_ID'), message_text)
             # print("Message sent successfully!")
         except Exception as e:
-            print(f"An error occurred: {e}")
\ No newline at end of file
+            print(f"An error occurred: {e}")
+
+class TelegramSink:
+    '''Sends to the TELEGRAM_CHAT_ID chat, errors are raised for the dispatcher to retry'''
+
+    def __init__(self, token=None, chat_id=None):
+        self.bot = telebot.TeleBot(token=token or os.getenv('TELEGRAM_TOKEN'))
+        self.chat_id = chat_id or os.getenv('TELEGRAM_CHAT_ID')
+
+    def send(self, message_text):
+        self.bot.send_message(self.chat_id, message_text)
+
+
+class FileSink:
+    '''Appends the messages to a file, or prints them without a path (offline runs)'''
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def send(self, message_text):
+        if self.path is None:
+            print(f"[MSG] {message_text}")
+            return
+        with open(self.path, "a") as f:
+            f.write(f"--- {datetime.now().isoformat(timespec='seconds')}\n{message_text}\n")
+
+
+def default_sinks():
+    '''Telegram when a TELEGRAM_TOKEN is set, stdout otherwise, plus NOTIFICATION_FILE if set'''
+    sinks = [TelegramSink() if os.getenv('TELEGRAM_TOKEN') else FileSink()]
+    if os.getenv('NOTIFICATION_FILE'):
+        sinks.append(FileSink(os.getenv('NOTIFICATION_FILE')))
+    return sinks
+
+
+def _retry_after(error):
+    # Telegram answers 429 with the seconds to wait
+    result = getattr(error, "result_json", None) or {}
+    return (result.get("parameters") or {}).get("retry_after")
+
+
+class NotificationDispatcher:
+    '''Sends notifications from a background thread, ``notify`` never waits on the network.
+
+    Messages go out in order. The ones piling up while a send is in progress, or
+    while the ``max_per_minute`` rate limit holds them back, are batched into one
+    message of at most ``max_length`` characters. Messages with a ``key`` (e.g.
+    per-file progress) are coalesced: only the count and the last text of each
+    key are kept and sent as one summary every ``interval`` seconds. Failed
+    sends are retried ``retries`` times with exponential backoff, or after the
+    delay Telegram asks for. Everything pending is flushed on ``close``, which
+    also runs at exit.
+    '''
+
+    def __init__(self, sinks=None, interval=60, max_per_minute=20, retries=3, backoff=1.0,
+                 max_length=4000, exit_timeout=30):
+        self.sinks = list(sinks) if sinks else default_sinks()
+        self.interval = interval
+        self.max_per_minute = max_per_minute
+        self.retries = retries
+        self.backoff = backoff
+        self.max_length = max_length
+        self.exit_timeout = exit_timeout
+
+        self._messages = deque()
+        self._coalesced = {}
+        self._sent = deque()
+        self._sending = False
+        self._flushing = False
+        self._closed = False
+        self._next_summary = time.monotonic() + interval
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="notification-dispatcher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def notify(self, message_text, key=None):
+        with self._cond:
+            if self._closed:
+                print(f"[W] Notification after close dropped: {message_text}")
+                return
+            if key is None:
+                self._messages.append(message_text)
+            else:
+                entry = self._coalesced.setdefault(key, {"count": 0, "first": datetime.now()})
+                entry["count"] += 1
+                entry["text"] = message_text
+            self._cond.notify_all()
+
+    def _pending(self):
+        return bool(self._messages) or bool(self._coalesced)
+
+    def _take_batch(self):
+        batch = [self._messages.popleft()]
+        while self._messages and sum(len(m) + 2 for m in batch) + len(self._messages[0]) <= self.max_length:
+            batch.append(self._messages.popleft())
+        return "\n\n".join(batch)[:self.max_length]
+
+    def _take_summary(self):
+        lines = []
+        for key, entry in self._coalesced.items():
+            count = f" ({entry['count']} updates since {entry['first'].strftime('%H:%M:%S')})" if entry["count"] > 1 else ""
+            lines.append(f"[{key}]{count}\n{entry['text']}")
+        self._coalesced = {}
+        self._next_summary = time.monotonic() + self.interval
+        return "\n\n".join(lines)[:self.max_length]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._messages or self._closed or self._flushing
+                           or (self._coalesced and time.monotonic() >= self._next_summary)):
+                    self._cond.wait(max(0.0, self._next_summary - time.monotonic()) if self._coalesced else None)
+                if self._closed and not self._pending():
+                    return
+                texts = []
+                if self._messages:
+                    texts.append(self._take_batch())
+                if self._coalesced and (self._closed or self._flushing or time.monotonic() >= self._next_summary):
+                    texts.append(self._take_summary())
+                if not self._pending():
+                    self._flushing = False
+                self._sending = True
+
+            for text in texts:
+                self._wait_rate()
+                self._deliver(text)
+
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+
+    def _wait_rate(self):
+        while len(self._sent) >= self.max_per_minute:
+            wait = self._sent[0] + 60 - time.monotonic()
+            if wait <= 0:
+                self._sent.popleft()
+            else:
+                time.sleep(wait)
+        self._sent.append(time.monotonic())
+
+    def _deliver(self, message_text):
+        for sink in self.sinks:
+            for attempt in range(self.retries + 1):
+                try:
+                    sink.send(message_text)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        print(f"[E] Notification to {type(sink).__name__} dropped after {attempt+1} attempts: {e}")
+                        break
+                    time.sleep(_retry_after(e) or self.backoff * 2**attempt)
+
+    def flush(self, timeout=None):
+        '''Send everything pending now, the coalesced summaries included.
+        Returns False when ``timeout`` ran out first.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._pending() or self._sending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        '''Flush and stop the worker thread, at exit at most ``exit_timeout`` seconds'''
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(self.exit_timeout if timeout is None else timeout)
@@ -1,78 +1,206 @@
 from shapely import geometry
+import shapely
+import numpy as np
 from rasterio.crs import CRS
+from rasterio.warp import transform_bounds
 import rasterio as rio
 import rioxarray as rxr
 import geopandas as gpd
-import os
+import os, json, threading
+from concurrent.futures import ProcessPoolExecutor
+
+RASTER_EXTENSIONS = (".jp2", ".tif", ".tiff")
+# Points added along each edge before reprojecting, UTM edges are curved in WGS84
+DENSIFY_PTS = 21
+
+def header_bounds(source):
+    '''(minX, minY, maxX, maxY) of a raster in EPSG:4326, from its header only'''
+    with rio.open(source) as src:
+        return list(transform_bounds(src.crs, "EPSG:4326", *src.bounds, densify_pts=DENSIFY_PTS))
+
+def reproject_bounds(source):
+    # Former approach: warps every pixel, the bounds are the outer pixel centers
+    raster = rxr.open_rasterio(source, masked=True).squeeze()
+    raster_new = raster.rio.reproject(CRS.from_string('EPSG:4326'))
+
+    maxX = raster_new.coords['x'].max(dim=["x"]).to_dict()['data']
+    minX = raster_new.coords['x'].min(dim=["x"]).to_dict()['data']
+    maxY = raster_new.coords['y'].max(dim=["y"]).to_dict()['data']
+    minY = raster_new.coords['y'].min(dim=["y"]).to_dict()['data']
+
+    return [minX, minY, maxX, maxY]
+
+BOUNDS_MODES = {"header": header_bounds, "reproject": reproject_bounds}
+ERA5_GRID_SIZE = 0.25
+
+def fishnet_cells(minX, minY, maxX, maxY, cell_size=None, n_cells=3, snap=None):
+    '''Square cells covering the extent, built as one array with shapely.box.
+
+    Rows start at minY and columns at minX, a cell starts on every step up to
+    and including maxX/maxY like the former loop. ``snap`` widens the extent
+    out to multiples of it and rounds ``cell_size`` up to one, so every cell
+    edge is on the snap grid and the cells cover the extent exactly.
+    '''
+    if snap:
+        minX, minY = np.floor(minX / snap + 1e-9) * snap, np.floor(minY / snap + 1e-9) * snap
+        maxX, maxY = np.ceil(maxX / snap - 1e-9) * snap, np.ceil(maxY / snap - 1e-9) * snap
+    if cell_size is None:
+        cell_size = (maxX - minX) / n_cells
+    if snap:
+        cell_size = max(1, np.ceil(cell_size / snap - 1e-9)) * snap
+        n_x = int(np.ceil((maxX - minX) / cell_size - 1e-9))
+        n_y = int(np.ceil((maxY - minY) / cell_size - 1e-9))
+    else:
+        n_x = int(np.floor((maxX - minX) / cell_size + 1e-9)) + 1
+        n_y = int(np.floor((maxY - minY) / cell_size + 1e-9)) + 1
+
+    x, y = np.meshgrid(minX + np.arange(n_x) * cell_size, minY + np.arange(n_y) * cell_size)
+    return shapely.box(x.ravel(), y.ravel(), x.ravel() + cell_size, y.ravel() + cell_size)
+
+def select_cells(cells, polygons, clip=True):
+    '''Cells intersecting any of the polygons, found with an STRtree'''
+    tree = shapely.STRtree(cells)
+    _, idx = tree.query(polygons, predicate="intersects")
+    selected = cells[np.unique(idx)]
+    if clip:
+        selected = shapely.intersection(selected, shapely.union_all(polygons))
+
+    return selected
+
+def _bounds_worker(source, mode):
+    return BOUNDS_MODES[mode](source)
 
 class RasterBoundaries:
-    def __init__(self):
+    def __init__(self, bounds_mode="reproject", cache_path=None):
         self.temp_path = "temp_results"
         if not os.path.exists(self.temp_path):
             os.makedirs(self.temp_path)
+        if bounds_mode not in BOUNDS_MODES:
+            raise ValueError(f"Unknown bounds mode {bounds_mode}, use {' or '.join(BOUNDS_MODES)}")
+        self.bounds_mode = bounds_mode
+        # Bounds per raster, valid as long as the file keeps its mtime and size
+        self.cache_path = cache_path or os.path.join(self.temp_path, "raster_bounds_cache.json")
+        self._lock = threading.Lock()
+        self._cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                self._cache = json.load(f)
+
+    def _cache_key(self, source):
+        stat = os.stat(source)
+        return os.path.abspath(source), {"mode": self.bounds_mode, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+    def _cached(self, source):
+        path, signature = self._cache_key(source)
+        entry = self._cache.get(path)
+        if entry and all(entry.get(k) == v for k, v in signature.items()):
+            return entry["bounds"]
+        return None
+
+    def _store(self, results):
+        with self._lock:
+            for source, bounds in results.items():
+                path, signature = self._cache_key(source)
+                self._cache[path] = {**signature, "bounds": bounds}
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._cache, f, indent=4)
+            os.replace(tmp_path, self.cache_path)
+
+    def raster_bounds(self, source):
+        '''(minX, minY, maxX, maxY) of a raster in EPSG:4326, cached'''
+        bounds = self._cached(source)
+        if bounds is None:
+            bounds = BOUNDS_MODES[self.bounds_mode](source)
+            self._store({source: bounds})
+
+        return bounds
+
+    def directory_bounds(self, dirpath, max_workers=None):
+        '''Bounds of every raster (.jp2/.tif) below ``dirpath``, computed in parallel'''
+        sources = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(dirpath) for name in names
+            if name.lower().endswith(RASTER_EXTENSIONS))
+
+        results = {source: self._cached(source) for source in sources}
+        missing = [source for source, bounds in results.items() if bounds is None]
+        print(f"[i] {len(sources)} rasters, {len(missing)} not cached")
+        if missing:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                computed = dict(zip(missing, pool.map(_bounds_worker, missing, [self.bounds_mode]*len(missing))))
+            self._store(computed)
+            results.update(computed)
+
+        return results
+
+    def _write_full_boundaries(self, maxX, minX, maxY, minY):
+        left_bottom = (minX, minY)
+        left_top = (minX, maxY)
+        right_top = (maxX, maxY)
+        right_bottom = (maxX, minY)
+
+        geom = geometry.Polygon([left_bottom, left_top, right_top, right_bottom])
+        geomdf = gpd.GeoDataFrame(index=[0], geometry=[geom], crs="EPSG:4326")
+
+        path_full_boundaries = os.path.join(self.temp_path, "temp_raster_full_boundaries.geojson")
+        geomdf.to_file(path_full_boundaries, driver="GeoJSON")
+
+        return geomdf, path_full_boundaries
+
+    def full_boundaries(self, source):
+        '''The raster extent as one EPSG:4326 polygon, and the GeoJSON file it is
+        written to (what Reanalysis.process takes), without building the grid'''
+        minX, minY, maxX, maxY = self.raster_bounds(source)
+        return self._write_full_boundaries(maxX, minX, maxY, minY)
+
+    def raster_grid_split(self, source, cell_size=None, snap=None, study_area=None):
+        '''Split the raster extent into a grid of cells.
+
+        ``cell_size`` (degrees) defaults to a third of the raster width, ``snap``
+        aligns the grid (0.25 for the ERA5 grid). With ``study_area`` (a
+        GeoDataFrame or a file) the cells intersecting its polygons are kept,
+        clipped to them, instead of the cells inside the raster extent.
+        '''
+        minX, minY, maxX, maxY = self.raster_bounds(source)
+
+        # Create a fishnet, by default 3 cells across the raster
+        fishnet = gpd.GeoDataFrame(geometry=fishnet_cells(minX, minY, maxX, maxY, cell_size=cell_size, snap=snap),
+                                   crs="EPSG:4326")
 
-    def raster_grid_split(self, source):
-
-        def _get_whole_boundaries(maxX, minX, maxY, minY):
-            left_bottom = (minX, minY)
-            left_top = (minX, maxY)
-            right_top = (maxX, maxY)
-            right_bottom = (maxX, minY)
-
-            geom = geometry.Polygon([left_bottom, left_top, right_top, right_bottom])
-            geomdf = gpd.GeoDataFrame(index=[0], geometry=[geom], crs="EPSG:4326")
-
-            path_full_boundaries = os.path.join(self.temp_path, "temp_raster_full_boundaries.geojson")
-            geomdf.to_file(path_full_boundaries, driver="GeoJSON")
-
-            return geomdf, path_full_boundaries
-        
-        imagery = rio.open(source)
-        raster = rxr.open_rasterio(source, masked=True).squeeze()
-        raster_new = raster.rio.reproject(CRS.from_string('EPSG:4326'))
-
-        maxX = raster_new.coords['x'].max(dim=["x"]).to_dict()['data']
-        minX = raster_new.coords['x'].min(dim=["x"]).to_dict()['data']
-        maxY = raster_new.coords['y'].max(dim=["y"]).to_dict()['data']
-        minY = raster_new.coords['y'].min(dim=["y"]).to_dict()['data']
-
-        # Create a fishnet
-        x, y = (minX, minY)
-        geom_array = []
-
-        # Polygon Size
-        square_size = tuple(map(lambda i, j: i - j, (maxX, minY), (minX, minY)))
-        square_size = square_size[0]/int(3)
-
-        while y <= maxY:
-            while x <= maxX:
-                geom = geometry.Polygon([(x,y), (x, y+square_size), (x+square_size, y+square_size), (x+square_size, y), (x, y)])
-                geom_array.append(geom)
-                x += square_size
-            x = minX
-            y += square_size
-
-        fishnet = gpd.GeoDataFrame(geom_array, columns=['geometry']).set_crs('EPSG:4326')
-        
         # Select grids within area study
-        wbounds, wbounds_path = _get_whole_boundaries(maxX, minX, maxY, minY)
-        within = gpd.overlay(wbounds, fishnet, how='intersection') #.reset_index()
-        within_check = within.copy()
-        
+        wbounds, wbounds_path = self._write_full_boundaries(maxX, minX, maxY, minY)
+        if study_area is not None:
+            study = gpd.read_file(study_area) if isinstance(study_area, str) else study_area
+            polygons = study.to_crs("EPSG:4326").geometry.values
+        else:
+            polygons = wbounds.geometry.values
+        within_check = gpd.GeoDataFrame(geometry=select_cells(fishnet.geometry.values, polygons), crs="EPSG:4326")
+
         # temporary change projection to find the area total
-        within_check = within_check.to_crs({'init': 'epsg:3857'})
-        within_check["area"] = within_check['geometry'].area/ 10**6
+        within_check["area"] = within_check.geometry.to_crs("EPSG:3857").area.values / 10**6
         within_check = within_check[within_check['area'] != 0]
-        within_check = within_check[within_check['area'] > within_check['area'].mean()].reset_index()
-
-        # re-project to wgs84
-        within_check = within_check.to_crs({'init': 'epsg:4326'})
-        within_check = within_check.drop(columns=['index'])
+        if study_area is None:
+            # Partial cells on the raster edge are left out
+            within_check = within_check[within_check['area'] > within_check['area'].mean()]
+        within_check = within_check.reset_index(drop=True)
 
         return within_check, wbounds_path
 
 if __name__ == "__main__":
-    rbound = RasterBoundaries()
-    _, total_bounds = rbound.raster_grid_split(
-        source="/Users/yylab/ikkifik/research/sentinel-extraction-tools/results/2025-ofunato/S2A_MSIL1C_20250103T012041_N0511_R031_T54SWJ_20250103T023155.SAFE/GRANULE/L1C_T54SWJ_A049792_20250103T012040/IMG_DATA/T54SWJ_20250103T012041_B01.jp2")
-    print(total_bounds)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="WGS84 boundaries of raster scenes")
+    parser.add_argument('-d', '--dirpath', dest="dirpath", type=str, default=None, help="compute the bounds of every scene in a directory")
+    parser.add_argument('-m', '--mode', dest="mode", type=str, default="header", choices=list(BOUNDS_MODES))
+    parser.add_argument('-w', '--max-workers', dest="max_workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.dirpath:
+        rbound = RasterBoundaries(bounds_mode=args.mode)
+        for source, bounds in rbound.directory_bounds(args.dirpath, max_workers=args.max_workers).items():
+            print(source, bounds)
+    else:
+        rbound = RasterBoundaries(bounds_mode=args.mode)
+        _, total_bounds = rbound.raster_grid_split(
+            source="/Users/yylab/ikkifik/research/sentinel-extraction-tools/results/2025-ofunato/S2A_MSIL1C_20250103T012041_N0511_R031_T54SWJ_20250103T023155.SAFE/GRANULE/L1C_T54SWJ_A049792_20250103T012040/IMG_DATA/T54SWJ_20250103T012041_B01.jp2")
+        print(total_bounds)
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pyproj has to find its database before eccodes is loaded, the
+# extractor imports geopandas/pyproj first
+import era5_grib_extractor  # noqa: E402,F401
+from era5_synthetic import write_grib  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def grib_file(tmp_path_factory):
+    '''Three days of hourly t2m and tp, laid out like a CDS download'''
+    path = tmp_path_factory.mktemp("grib") / "era5.grib"
+    return write_grib(str(path), days=3, variables=("2m_temperature", "total_precipitation"))
@@ -0,0 +1,173 @@
+import glob
+import json
+import os
+
+import pytest
+
+from era5_cache_catalog import CacheCatalog, normalize_date
+from era5_synthetic import populate_cache, write_netcdf
+
+AREA = {"north": 40.0, "west": 20.0, "south": 38.0, "east": 22.0}
+SUBSET = {"north": 39.5, "west": 20.5, "south": 38.5, "east": 21.5}
+
+
+def _write_entry(cache_dir, name, area_bounds=AREA, start_date="2020-01-01", end_date="2020-01-31", **extra):
+    data_path = os.path.join(cache_dir, f"{name}.grib")
+    with open(data_path, "wb") as f:
+        f.write(os.urandom(256))
+    doc = {"area_bounds": area_bounds, "data_path": data_path, "variables": ["2m_temperature"],
+           "start_date": start_date, "end_date": end_date, **extra}
+    with open(os.path.join(cache_dir, f"{name}_meta.json"), "w") as f:
+        json.dump(doc, f)
+    return doc
+
+
+@pytest.fixture
+def netcdf_cache(tmp_path):
+    '''A cache holding one month of t2m and tp over AREA as NetCDF'''
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    data_path = write_netcdf(os.path.join(cache_dir, "month.nc"), start="2020-01-01", days=31, area_bounds=AREA,
+                             variables=("2m_temperature", "total_precipitation"))
+    with open(os.path.join(cache_dir, "month_meta.json"), "w") as f:
+        json.dump({"area_bounds": AREA, "data_path": data_path, "start_date": "2020-01-01",
+                   "end_date": "2020-01-31", "variables": ["2m_temperature", "total_precipitation"]}, f)
+    return cache_dir
+
+
+def test_normalize_date():
+    assert normalize_date("2020-1-5", "start", "13:00") == "2020-01-05T13:00"
+    assert normalize_date("2020-01-05", "end") == "2020-01-05T23:00"
+    assert normalize_date("2020-01-05__06:00", "start") == "2020-01-05T06:00"
+
+
+def test_rebuild_indexes_existing_meta_files(tmp_path):
+    docs = populate_cache(str(tmp_path / "cache"), n_entries=20)
+    catalog = CacheCatalog(str(tmp_path / "cache"))
+    assert len(catalog) == 20
+
+    doc = docs[3]
+    entry = catalog.lookup(doc["area_bounds"], doc["start_date"], doc["end_date"])
+    assert entry["data_path"] == doc["data_path"]
+
+
+def test_lookup_within_tolerance(tmp_path):
+    cache_dir = str(tmp_path)
+    doc = _write_entry(cache_dir, "a")
+    catalog = CacheCatalog(cache_dir)
+
+    nearby = {k: v + 1e-7 for k, v in AREA.items()}
+    assert catalog.lookup(nearby, "2020-01-01", "2020-01-31")["data_path"] == doc["data_path"]
+    assert catalog.lookup({**AREA, "north": 40.1}, "2020-01-01", "2020-01-31") == {}
+    assert catalog.lookup(AREA, "2020-01-01", "2020-01-31", variables=["total_precipitation"]) == {}
+
+
+def test_lookup_drops_entries_of_missing_files(tmp_path):
+    cache_dir = str(tmp_path)
+    doc = _write_entry(cache_dir, "a")
+    catalog = CacheCatalog(cache_dir)
+    os.remove(doc["data_path"])
+
+    assert catalog.lookup(AREA, "2020-01-01", "2020-01-31") == {}
+    assert len(catalog) == 0
+
+
+def test_meta_files_of_other_processes_are_found(tmp_path):
+    cache_dir = str(tmp_path)
+    catalog = CacheCatalog(cache_dir)
+    # Written after the catalog was opened, as by another download
+    doc = _write_entry(cache_dir, "late", checksum="not hashed again", size=256)
+
+    entry = catalog.lookup(AREA, "2020-01-01", "2020-01-31")
+    assert entry["data_path"] == doc["data_path"]
+    assert CacheCatalog(cache_dir).lookup(AREA, "2020-01-01", "2020-01-31")["checksum"] == "not hashed again"
+
+
+def test_find_covering_smallest_first(tmp_path):
+    cache_dir = str(tmp_path)
+    _write_entry(cache_dir, "year", start_date="2020-01-01", end_date="2020-12-31")
+    with open(os.path.join(cache_dir, "year.grib"), "ab") as f:
+        f.write(os.urandom(1024))
+    month = _write_entry(cache_dir, "month")
+    _write_entry(cache_dir, "elsewhere", area_bounds={"north": 10.0, "west": 0.0, "south": 9.0, "east": 1.0})
+    catalog = CacheCatalog(cache_dir)
+
+    entries = catalog.find_covering(SUBSET, "2020-01-10T00:00", "2020-01-10T23:00")
+    assert [os.path.basename(e["data_path"]) for e in entries] == ["month.grib", "year.grib"]
+    assert entries[0]["data_path"] == month["data_path"]
+    assert catalog.find_covering(SUBSET, "2020-02-10T00:00", "2020-02-10T23:00")[0]["data_path"].endswith("year.grib")
+
+
+def test_serve_slices_a_covering_file(netcdf_cache):
+    catalog = CacheCatalog(netcdf_cache)
+    subset = catalog.serve(SUBSET, "2020-01-15", variables=["2m_temperature"], default_time="13:00")
+
+    assert list(subset.data_vars) == ["t2m"]
+    assert subset.sizes["valid_time"] == 1
+    assert float(subset.latitude.min()) >= SUBSET["south"] and float(subset.latitude.max()) <= SUBSET["north"]
+    assert catalog.serve(SUBSET, "2020-02-15", default_time="13:00") is None
+
+
+def test_serve_materializes_a_slice_once(netcdf_cache):
+    catalog = CacheCatalog(netcdf_cache)
+    variables = ["2m_temperature", "total_precipitation"]
+    doc = catalog.serve(SUBSET, "2020-1-15", variables=variables, materialize=True, default_time="13:00")
+
+    assert os.path.exists(doc["data_path"])
+    assert catalog.lookup(SUBSET, "2020-1-15")["data_path"] == doc["data_path"]
+    # The same request written another way reuses the slice
+    again = catalog.serve(SUBSET, "2020-01-15", variables=variables, materialize=True, default_time="13:00")
+    assert again["data_path"] == doc["data_path"]
+    assert len(glob.glob(os.path.join(netcdf_cache, "*_slice.nc"))) == 1
+    assert not glob.glob(os.path.join(netcdf_cache, "*.part"))
+
+
+def test_serve_into_another_catalog(netcdf_cache, tmp_path):
+    staging, target = CacheCatalog(netcdf_cache), CacheCatalog(str(tmp_path / "area"))
+    doc = staging.serve(SUBSET, "2020-1-15", materialize=True, default_time="13:00", target=target)
+
+    assert os.path.dirname(doc["data_path"]) == target.cache_dir
+    assert target.lookup(SUBSET, "2020-1-15")["data_path"] == doc["data_path"]
+    assert len(staging) == 1
+
+
+def test_commit_download(tmp_path):
+    cache_dir = str(tmp_path)
+    catalog = CacheCatalog(cache_dir)
+    part_path, data_path = os.path.join(cache_dir, ".x.part"), os.path.join(cache_dir, "x.grib")
+    meta_path = os.path.join(cache_dir, "x_meta.json")
+    with open(part_path, "wb") as f:
+        f.write(b"GRIB")
+    doc = {"area_bounds": AREA, "data_path": data_path, "start_date": "2020-01-01", "end_date": "2020-01-02"}
+
+    catalog.commit_download(part_path, data_path, doc, meta_path)
+    assert os.path.exists(data_path) and os.path.exists(meta_path) and not os.path.exists(part_path)
+    assert catalog.lookup(AREA, "2020-01-01", "2020-01-02")["data_path"] == data_path
+
+
+def test_commit_download_with_incomplete_metadata(tmp_path):
+    cache_dir = str(tmp_path)
+    catalog = CacheCatalog(cache_dir)
+    part_path, data_path = os.path.join(cache_dir, ".x.part"), os.path.join(cache_dir, "x.grib")
+    with open(part_path, "wb") as f:
+        f.write(b"GRIB")
+
+    with pytest.raises(ValueError, match="incomplete metadata"):
+        catalog.commit_download(part_path, data_path, {"area_bounds": AREA}, os.path.join(cache_dir, "x_meta.json"))
+    assert os.listdir(cache_dir) == ["catalog.sqlite"]
+
+    with pytest.raises(ValueError, match="is missing"):
+        catalog.commit_download(part_path, data_path, {"area_bounds": AREA, "start_date": "2020-01-01"},
+                                os.path.join(cache_dir, "x_meta.json"))
+
+
+def test_verify_drops_corrupted_files(tmp_path):
+    cache_dir = str(tmp_path)
+    doc = _write_entry(cache_dir, "a")
+    catalog = CacheCatalog(cache_dir)
+    with open(doc["data_path"], "r+b") as f:
+        f.write(b"\0" * 16)
+
+    assert catalog.verify() == [doc["data_path"]]
+    assert len(catalog) == 0
+    assert not os.path.exists(doc["data_path"])
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+import requests
+
+import era5_download
+from era5_download import DownloadError, grib_message_count, http_download, retrieve_verified, verify_download
+from era5_local_client import LocalClient
+from era5_synthetic import write_grib
+
+AREA = {"north": 40.0, "west": 20.0, "south": 39.5, "east": 20.5}
+
+
+@pytest.fixture
+def small_grib(tmp_path):
+    return write_grib(str(tmp_path / "day.grib"), days=1, area_bounds=AREA, variables=("2m_temperature",))
+
+
+class FakeResponse:
+    '''Streams ``body`` from the offset of a Range header, breaking off after ``fail_after`` bytes'''
+
+    def __init__(self, body, headers, fail_after=None):
+        offset = int(headers["Range"][6:-1]) if "Range" in headers else 0
+        self.status_code = 206 if offset else 200
+        self.body, self.fail_after = body[offset:], fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), 100):
+            if self.fail_after is not None and start >= self.fail_after:
+                raise requests.ConnectionError("connection reset")
+            yield self.body[start:start+100]
+
+
+def test_grib_message_count(small_grib):
+    assert grib_message_count(small_grib) == 24
+
+
+def test_truncated_grib_is_rejected(small_grib):
+    with open(small_grib, "r+b") as f:
+        f.truncate(os.path.getsize(small_grib) - 10)
+
+    with pytest.raises(DownloadError, match="truncated"):
+        verify_download(small_grib)
+
+
+def test_verify_download_checks_size_and_messages(small_grib):
+    info = verify_download(small_grib, expected_size=os.path.getsize(small_grib), expected_messages=24)
+    assert info["messages"] == 24 and len(info["checksum"]) == 64
+
+    with pytest.raises(DownloadError, match="does not match"):
+        verify_download(small_grib, expected_size=1)
+    with pytest.raises(DownloadError, match="expected 48"):
+        verify_download(small_grib, expected_messages=48)
+
+
+def test_http_download_resumes(tmp_path, monkeypatch):
+    body = os.urandom(1000)
+    calls = []
+
+    def fake_get(url, headers=None, **kwargs):
+        calls.append(dict(headers))
+        # The first transfer breaks off after 300 bytes
+        return FakeResponse(body, headers, fail_after=300 if len(calls) == 1 else None)
+
+    monkeypatch.setattr(era5_download.requests, "get", fake_get)
+    monkeypatch.setattr(era5_download.time, "sleep", lambda seconds: None)
+    part_path = str(tmp_path / "x.part")
+
+    http_download("http://example/x", part_path, expected_size=len(body))
+    assert calls == [{}, {"Range": "bytes=300-"}]
+    with open(part_path, "rb") as f:
+        assert f.read() == body
+
+
+def test_retrieve_verified_removes_corrupt_transfers(tmp_path, small_grib):
+    target = str(tmp_path / "cache" / "x.grib")
+    os.makedirs(os.path.dirname(target))
+
+    part_path, info = retrieve_verified(LocalClient(source=small_grib), "dataset", {"a": 1}, target,
+                                        expected_messages=24)
+    assert os.path.dirname(part_path) == os.path.dirname(target) and info["messages"] == 24
+
+    with pytest.raises(DownloadError):
+        retrieve_verified(LocalClient(source=small_grib), "dataset", {"a": 2}, target, expected_messages=12)
+    assert os.listdir(os.path.dirname(target)) == [os.path.basename(part_path)]
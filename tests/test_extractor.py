@@ -0,0 +1,60 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from era5_grib_extractor import ERA5GribExtractor, ExtractionError
+
+
+def _rasters(output_dir):
+    return {os.path.basename(p): p for p in glob.glob(os.path.join(output_dir, "raster", "*.TIF"))}
+
+
+def _read(path):
+    with rasterio.open(path) as src:
+        return src.read(1), src.dtypes[0], src.transform
+
+
+def test_array_mode_matches_dataframe_mode(grib_file, tmp_path):
+    ERA5GribExtractor(output_dir=str(tmp_path / "dataframe"), metadata_store=False).process(grib_file, mode="dataframe")
+    # The dataframe path averages tp, the array mode sums it by default
+    ERA5GribExtractor(output_dir=str(tmp_path / "array"), metadata_store=False).process(
+        grib_file, variables=("t2m", "tp"), statistics={"tp": ("mean",)})
+
+    reference, rasters = _rasters(tmp_path / "dataframe"), _rasters(tmp_path / "array")
+    assert sorted(rasters) == sorted(reference)
+    assert len(rasters) == 6
+    for name, path in reference.items():
+        expected, expected_dtype, expected_transform = _read(path)
+        values, dtype, transform = _read(rasters[name])
+        assert dtype == expected_dtype == "float32"
+        assert transform == expected_transform
+        if name.startswith("t2m"):
+            np.testing.assert_array_equal(values, expected)
+        else:
+            np.testing.assert_allclose(values, expected, rtol=1e-6, atol=1e-10)
+
+
+def test_windowed_matches_single_pass(grib_file, tmp_path):
+    ERA5GribExtractor(output_dir=str(tmp_path / "single"), metadata_store=False).process(grib_file)
+    # A budget this small decodes one day per window
+    ERA5GribExtractor(output_dir=str(tmp_path / "windowed"), memory_budget_mb=1e-6,
+                      metadata_store=False).process(grib_file)
+
+    reference, rasters = _rasters(tmp_path / "single"), _rasters(tmp_path / "windowed")
+    assert sorted(rasters) == sorted(reference)
+    for name, path in reference.items():
+        np.testing.assert_array_equal(_read(rasters[name])[0], _read(path)[0])
+
+
+def test_process_files_reports_failed_files(grib_file, tmp_path):
+    missing = str(tmp_path / "missing.grib")
+    extractor = ERA5GribExtractor(output_dir=str(tmp_path / "out"), metadata_store=False)
+
+    with pytest.raises(ExtractionError) as error:
+        extractor.process_files([missing, grib_file])
+    assert list(error.value.failed) == [missing]
+    # The other file is extracted all the same
+    assert len(_rasters(tmp_path / "out")) == 6
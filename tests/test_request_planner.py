@@ -0,0 +1,86 @@
+import glob
+import os
+
+import pytest
+
+from era5_cache_catalog import CacheCatalog
+from era5_download import grib_message_count
+from era5_local_client import LocalClient
+from era5_request_planner import RequestPlanner, merge_chunks, retrieve_chunk, retrieve_range
+from era5_synthetic import grib_source, write_grib
+
+AREA = {"north": 40.0, "west": 20.0, "south": 39.5, "east": 20.5}
+VARIABLES = ["2m_temperature"]
+
+
+def test_plan_splits_at_month_ends():
+    chunks = RequestPlanner().plan("2020-01-30", "2020-03-02", VARIABLES)
+
+    assert [c["key"] for c in chunks] == ["20200130_20200131", "20200201_20200229", "20200301_20200302"]
+    assert chunks[1]["day"][-1] == "29"
+    assert chunks[0]["start_date"] == "2020-01-30__00:00" and chunks[-1]["end_date"] == "2020-03-02__23:00"
+    assert sum(c["fields"] for c in chunks) == 33 * 24
+
+
+def test_plan_keeps_requests_under_the_field_limit():
+    planner = RequestPlanner(max_fields=24 * 10)
+    chunks = planner.plan("2021-02-01", "2021-02-28", ["2m_temperature", "total_precipitation"])
+
+    assert all(c["fields"] <= planner.max_fields for c in chunks)
+    assert [len(c["day"]) for c in chunks] == [5] * 5 + [3]
+
+
+def test_plan_groups_months_with_the_same_days():
+    chunks = RequestPlanner(max_months=3).plan("2021-01-01", "2021-12-31", VARIABLES)
+
+    # Months of 31 days can only be grouped when they follow each other
+    assert [c["month"] for c in chunks][:2] == [["01"], ["02"]]
+    assert ["07", "08"] in [c["month"] for c in chunks]
+    assert all(len(set(c["year"])) == 1 for c in chunks)
+
+
+def test_plan_rejects_reversed_range():
+    with pytest.raises(ValueError):
+        RequestPlanner().plan("2020-02-01", "2020-01-01", VARIABLES)
+
+
+def test_execute_uses_the_cache_first():
+    planner = RequestPlanner()
+    chunks = planner.plan("2020-01-01", "2020-02-29", VARIABLES)
+    cached = {chunks[0]["key"]: "cached.grib"}
+
+    planner.execute(chunks, lookup=lambda c: cached.get(c["key"]), retrieve=lambda c: f"{c['key']}.grib")
+    assert [c["status"] for c in chunks] == ["cached", "downloaded"]
+    assert chunks[1]["data_path"] == "20200201_20200229.grib"
+
+
+def test_merge_chunks_concatenates_grib(tmp_path):
+    first = write_grib(str(tmp_path / "a.grib"), start="2020-01-01", days=1, area_bounds=AREA, variables=VARIABLES)
+    second = write_grib(str(tmp_path / "b.grib"), start="2020-01-02", days=2, area_bounds=AREA, variables=VARIABLES)
+
+    merged = merge_chunks([first, second], str(tmp_path / "merged.grib"))
+    assert grib_message_count(merged) == 3 * 24
+    assert not glob.glob(str(tmp_path / "*.part"))
+
+
+def test_retrieve_range_merges_and_caches(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    catalog = CacheCatalog(cache_dir)
+    planner = RequestPlanner()
+    client = LocalClient(source=grib_source())
+
+    def lookup(chunk):
+        return catalog.lookup(AREA, chunk["start_date"], chunk["end_date"], chunk["variable"]).get("data_path")
+
+    def retrieve(chunk):
+        return retrieve_chunk(client, planner, catalog, cache_dir, AREA, chunk)
+
+    path = retrieve_range(planner, catalog, cache_dir, AREA, "2020-01-31", "2020-02-01", VARIABLES, lookup, retrieve)
+    assert grib_message_count(path) == 2 * 24
+    assert len(client.requests) == 2
+    assert catalog.lookup(AREA, "2020-01-31__00:00", "2020-02-01__23:00")["data_path"] == path
+    assert not glob.glob(os.path.join(cache_dir, "*.tmp")) and not glob.glob(os.path.join(cache_dir, ".*.part"))
+
+    # The chunks are served from the cache the second time
+    retrieve_range(planner, catalog, cache_dir, AREA, "2020-01-31", "2020-02-01", VARIABLES, lookup, retrieve)
+    assert len(client.requests) == 2
@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+
+from era5_scheduler import DownloadScheduler
+
+
+def test_jobs_run_concurrently_and_fail_on_their_own(tmp_path):
+    def task(job):
+        if job["params"]["n"] == 2:
+            raise ValueError("no data")
+        return f"{job['id']}.grib"
+
+    scheduler = DownloadScheduler(task=task, max_in_flight=2, queue_path=str(tmp_path / "queue.json"))
+    for n in range(4):
+        scheduler.submit(f"job{n}", n=n)
+    jobs = {job["id"]: job for job in scheduler.run()}
+
+    assert [jobs[f"job{n}"]["status"] for n in range(4)] == ["done", "done", "failed", "done"]
+    assert jobs["job0"]["result"] == "job0.grib" and jobs["job2"]["error"] == "no data"
+
+
+def test_restart_only_runs_unfinished_jobs(tmp_path):
+    queue_path = str(tmp_path / "queue.json")
+    ran = []
+    scheduler = DownloadScheduler(task=lambda job: ran.append(job["id"]), queue_path=queue_path)
+    for n in range(3):
+        scheduler.submit(f"job{n}")
+    scheduler.run()
+
+    # job1 was running when the previous run stopped
+    with open(queue_path) as f:
+        jobs = json.load(f)
+    jobs[1]["status"] = "running"
+    with open(queue_path, "w") as f:
+        json.dump(jobs, f)
+
+    ran.clear()
+    scheduler = DownloadScheduler(task=lambda job: ran.append(job["id"]), queue_path=queue_path)
+    scheduler.submit("job0")
+    scheduler.run()
+    assert ran == ["job1"]
+
+
+def test_hold_keeps_new_jobs_back():
+    lock = threading.Lock()
+    started, finished, peak = [0], [0], [0]
+
+    def task(job):
+        with lock:
+            peak[0] = max(peak[0], started[0] - finished[0])
+        time.sleep(0.05)
+        with lock:
+            finished[0] += 1
+
+    def hold():
+        # Held while a job runs, like a full pipeline queue. Every False starts a job
+        with lock:
+            if started[0] > finished[0]:
+                return True
+            started[0] += 1
+            return False
+
+    scheduler = DownloadScheduler(task=task, max_in_flight=4, hold=hold)
+    for n in range(4):
+        scheduler.submit(f"job{n}")
+    jobs = scheduler.run()
+
+    assert all(job["status"] == "done" for job in jobs)
+    assert started[0] == 4 and peak[0] == 1
+
+
+def test_timeout_frees_the_slot():
+    release = threading.Event()
+
+    def task(job):
+        if job["id"] == "slow":
+            release.wait(10)
+        return job["id"]
+
+    scheduler = DownloadScheduler(task=task, max_in_flight=1, timeout=0.5)
+    scheduler.submit("slow")
+    scheduler.submit("fast")
+    jobs = {job["id"]: job for job in scheduler.run()}
+    release.set()
+
+    assert jobs["slow"]["status"] == "timeout"
+    assert jobs["fast"]["status"] == "done"
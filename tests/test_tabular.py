@@ -0,0 +1,60 @@
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import era5_tabular
+from era5_metadata_store import METADATA_STORE_NAME
+from era5_synthetic import populate_metadata
+
+
+def _read(path):
+    return pd.read_csv(path, sep=";", index_col=0)
+
+
+@pytest.mark.parametrize("json_files", [False, True])
+def test_incremental_matches_full_build(tmp_path, json_files):
+    metadata, dataset = str(tmp_path / "metadata"), str(tmp_path / "dataset")
+    populate_metadata(metadata, days=5, json_files=json_files)
+    path = era5_tabular.process_incremental(metadata, dataset)
+    assert len(_read(path)) == 15
+
+    # Later dates are appended
+    populate_metadata(metadata, days=3, start="2015-01-06", json_files=json_files, seed=1)
+    era5_tabular.process_incremental(metadata, dataset)
+    df = _read(path)
+    assert len(df) == 24
+    assert df[era5_tabular.DATE_COLUMN].is_monotonic_increasing
+
+
+def test_removed_json_files_drop_their_rows(tmp_path):
+    metadata, dataset = str(tmp_path / "metadata"), str(tmp_path / "dataset")
+    populate_metadata(metadata, days=5, json_files=True)
+    path = era5_tabular.process_incremental(metadata, dataset)
+
+    os.remove(os.path.join(metadata, "metadata_t2m_20150103.json"))
+    era5_tabular.process_incremental(metadata, dataset)
+    df = _read(path)
+    assert len(df) == 14
+    assert "t2m_20150103.TIF" not in set(df["path"])
+
+
+def test_removed_store_rows_drop_their_rows(tmp_path):
+    metadata, dataset = str(tmp_path / "metadata"), str(tmp_path / "dataset")
+    populate_metadata(metadata, days=5)
+    path = era5_tabular.process_incremental(metadata, dataset)
+
+    with sqlite3.connect(os.path.join(metadata, METADATA_STORE_NAME)) as conn:
+        conn.execute("DELETE FROM raster_metadata WHERE path = 't2m_20150103.TIF'")
+    era5_tabular.process_incremental(metadata, dataset)
+    assert len(_read(path)) == 14
+
+    # A removal hidden by new rows of later dates
+    with sqlite3.connect(os.path.join(metadata, METADATA_STORE_NAME)) as conn:
+        conn.execute("DELETE FROM raster_metadata WHERE path = 'tp_20150101.TIF'")
+    populate_metadata(metadata, days=1, start="2015-01-06", seed=1)
+    era5_tabular.process_incremental(metadata, dataset)
+    df = _read(path)
+    assert len(df) == 16
+    assert "tp_20150101.TIF" not in set(df["path"])